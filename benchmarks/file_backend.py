@@ -0,0 +1,518 @@
+"""Benchmarks for the file based UGM implementation.
+
+Generates synthetic data directories with the given numbers of users and
+groups of varying size and times common operations on them. Results are
+written as JSON, which can be compared against the results of another run::
+
+    python benchmarks/file_backend.py --sizes 1000 10000 --output new.json
+    python benchmarks/file_backend.py --compare old.json new.json
+"""
+from node.ext.ugm.file import Ugm
+import argparse
+import base64
+import datetime
+import gc
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+
+PASSWORD = 'secret'
+SALT = b'saltsalt'
+CASES = list()
+
+
+def case(name, repeat=None, memory=False):
+    """Register benchmark case.
+
+    Case functions get called with a ``Context`` and a random number generator
+    and return a callable which is timed. ``repeat`` overrides the number of
+    timed calls given on the command line. If ``memory`` is True, the
+    callable is called once and the memory allocated by it is reported per
+    user instead.
+    """
+    def decorator(fn):
+        CASES.append((name, repeat, memory, fn))
+        return fn
+    return decorator
+
+
+class Context(object):
+    """Data directory with synthetic principals."""
+
+    def __init__(self, path, size, index):
+        self.path = path
+        self.size = size
+        self.index = index
+        self.user_ids = list()
+        self.group_ids = list()
+        self.group_members = dict()
+
+    def create_ugm(self, **kw):
+        index_attrs = ('login', 'mail', 'fullname') if self.index else ()
+        return Ugm(
+            name='ugm',
+            users_file=os.path.join(self.path, 'users'),
+            groups_file=os.path.join(self.path, 'groups'),
+            roles_file=os.path.join(self.path, 'roles'),
+            data_directory=os.path.join(self.path, 'data'),
+            user_index_attrs=index_attrs,
+            group_index_attrs=('description',) if self.index else (),
+            **kw
+        )
+
+    def fullname(self, i):
+        rnd = random.Random(i)
+        first = ''.join(rnd.choice(string.ascii_lowercase) for _ in range(6))
+        last = ''.join(rnd.choice(string.ascii_lowercase) for _ in range(8))
+        return u'{} {}'.format(first.capitalize(), last.capitalize())
+
+
+def generate(path, size, index, seed=0):
+    """Write users, groups, roles and principal data files in the format of
+    ``node.ext.ugm.file`` to ``path``.
+
+    Number of groups is ``size / 10``. Group sizes follow a power law, thus
+    there are a few groups containing a large fraction of all users and many
+    small groups.
+    """
+    ctx = Context(path, size, index)
+    rnd = random.Random(seed)
+    users_dir = os.path.join(path, 'data', 'users')
+    groups_dir = os.path.join(path, 'data', 'groups')
+    os.makedirs(users_dir)
+    os.makedirs(groups_dir)
+    hashed = base64.b64encode(
+        hashlib.sha256(PASSWORD.encode() + SALT).digest() + SALT
+    ).decode()
+    roles = list()
+    with open(os.path.join(path, 'users'), 'w') as users_file, \
+            open(os.path.join(path, 'data', 'logins'), 'w') as logins_file:
+        for i in range(size):
+            user_id = 'user{}'.format(i)
+            login = 'login{}'.format(i)
+            ctx.user_ids.append(user_id)
+            users_file.write('{}:{}\n'.format(user_id, hashed))
+            logins_file.write('{}:{}\n'.format(login, user_id))
+            with open(os.path.join(users_dir, user_id), 'w') as f:
+                f.write('login:{}\n'.format(login))
+                f.write('mail:{}@example.com\n'.format(user_id))
+                f.write('fullname:{}\n'.format(ctx.fullname(i)))
+            if i % 100 == 0:
+                roles.append('{}::manager'.format(user_id))
+    with open(os.path.join(path, 'groups'), 'w') as groups_file:
+        for i in range(max(size // 10, 1)):
+            group_id = 'group{}'.format(i)
+            ctx.group_ids.append(group_id)
+            count = min(size, int(size / (i + 1) ** 1.2) + 1)
+            members = sorted(rnd.sample(ctx.user_ids, count))
+            ctx.group_members[group_id] = members
+            groups_file.write('{}:{}\n'.format(group_id, ','.join(members)))
+            with open(os.path.join(groups_dir, group_id), 'w') as f:
+                f.write('description:Group {}\n'.format(i))
+            if i % 10 == 0:
+                roles.append('group:{}::editor'.format(group_id))
+    with open(os.path.join(path, 'roles'), 'w') as roles_file:
+        roles_file.write(''.join(['{}\n'.format(role) for role in roles]))
+    return ctx
+
+
+###############################################################################
+# Cases
+###############################################################################
+
+@case('cold_load')
+def cold_load(ctx, rnd):
+    def run():
+        ugm = ctx.create_ugm()
+        ugm.users.storage
+        ugm.groups.storage
+        ugm.attrs.storage
+    return run
+
+
+@case('authenticate')
+def authenticate(ctx, rnd):
+    ugm = ctx.create_ugm()
+    ugm.users.storage
+
+    def run():
+        user_id = rnd.choice(ctx.user_ids)
+        assert ugm.users.authenticate(user_id, PASSWORD)
+    return run
+
+
+@case('authenticate_cold')
+def authenticate_cold(ctx, rnd):
+    def run():
+        ugm = ctx.create_ugm()
+        i = rnd.randrange(len(ctx.user_ids))
+        user_id = ugm.users.id_for_login('login{}'.format(i))
+        assert user_id == ctx.user_ids[i]
+        assert ugm.users.authenticate(user_id, PASSWORD)
+    return run
+
+
+@case('authenticate_cold_mapped')
+def authenticate_cold_mapped(ctx, rnd):
+    def run():
+        ugm = ctx.create_ugm(mapped_read=True)
+        i = rnd.randrange(len(ctx.user_ids))
+        user_id = ugm.users.id_for_login('login{}'.format(i))
+        assert user_id == ctx.user_ids[i]
+        assert ugm.users.authenticate(user_id, PASSWORD)
+    return run
+
+
+@case('passwd')
+def passwd(ctx, rnd):
+    ugm = ctx.create_ugm()
+    users = ugm.users
+
+    def run():
+        users.passwd(rnd.choice(ctx.user_ids), None, PASSWORD)
+    return run
+
+
+def authenticate_threads(threads, calls=400, writes=4):
+    """Create case authenticating ``calls`` users spread over ``threads``
+    reader threads while another thread changes passwords and flushes.
+    """
+    def authenticate_threads(ctx, rnd):
+        ugm = ctx.create_ugm()
+        users = ugm.users
+        users.storage
+        user_ids = [rnd.choice(ctx.user_ids) for _ in range(calls)]
+        writer_ids = [rnd.choice(ctx.user_ids) for _ in range(writes)]
+
+        def read(ids):
+            for user_id in ids:
+                assert users.authenticate(user_id, PASSWORD)
+
+        def write():
+            for user_id in writer_ids:
+                users.passwd(user_id, None, PASSWORD)
+
+        def run():
+            workers = [
+                threading.Thread(target=read, args=(user_ids[i::threads],))
+                for i in range(threads)
+            ]
+            workers.append(threading.Thread(target=write))
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        return run
+    return authenticate_threads
+
+
+for threads in (1, 2, 4, 8):
+    case('authenticate_threads_{}'.format(threads), repeat=5)(
+        authenticate_threads(threads)
+    )
+
+
+@case('search_exact')
+def search_exact(ctx, rnd):
+    ugm = ctx.create_ugm()
+    users = ugm.users
+
+    def run():
+        i = rnd.randrange(ctx.size)
+        res = users.search(criteria={'mail': 'user{}@example.com'.format(i)})
+        assert res == ['user{}'.format(i)]
+    return run
+
+
+@case('search_wildcard')
+def search_wildcard(ctx, rnd):
+    ugm = ctx.create_ugm()
+    users = ugm.users
+
+    def run():
+        fullname = ctx.fullname(rnd.randrange(ctx.size))
+        assert users.search(criteria={'fullname': fullname[:3] + '*'})
+    return run
+
+
+@case('search_sorted_top50')
+def search_sorted_top50(ctx, rnd):
+    ugm = ctx.create_ugm()
+    users = ugm.users
+
+    def run():
+        res = users.search(
+            criteria={'mail': '*@example.com'},
+            sort_on='fullname',
+            limit=50
+        )
+        assert len(res) == min(50, ctx.size)
+    return run
+
+
+@case('group_ids')
+def group_ids(ctx, rnd):
+    ugm = ctx.create_ugm()
+    users = ugm.users
+
+    def run():
+        users[rnd.choice(ctx.user_ids)].group_ids
+    return run
+
+
+@case('membership_change')
+def membership_change(ctx, rnd):
+    ugm = ctx.create_ugm()
+    groups = ugm.groups
+
+    def run():
+        group = groups[ctx.group_ids[0]]
+        user_id = rnd.choice(ctx.user_ids)
+        if user_id in group.member_ids:
+            del group[user_id]
+        else:
+            group.add(user_id)
+    return run
+
+
+@case('full_flush')
+def full_flush(ctx, rnd):
+    ugm = ctx.create_ugm()
+    users = ugm.users
+
+    def run():
+        users[rnd.choice(ctx.user_ids)].attrs['phone'] = str(rnd.random())
+        ugm()
+    return run
+
+
+@case('flush_unchanged')
+def flush_unchanged(ctx, rnd):
+    ugm = ctx.create_ugm()
+    ugm.users.storage
+    ugm.groups.storage
+
+    def run():
+        assert ugm() == 0
+    return run
+
+
+@case('memory_nodes', memory=True)
+def memory_nodes(ctx, rnd):
+    ugm = ctx.create_ugm()
+    users = ugm.users
+    users.storage
+
+    def run():
+        for user_id in ctx.user_ids:
+            users[user_id].attrs['fullname']
+        return ugm
+    return run
+
+
+@case('memory_records', memory=True)
+def memory_records(ctx, rnd):
+    ugm = ctx.create_ugm()
+    users = ugm.users
+    users.storage
+
+    def run():
+        for user_id in ctx.user_ids:
+            users.record(user_id)['fullname']
+        return ugm
+    return run
+
+
+###############################################################################
+# Runner
+###############################################################################
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_memory_case(ctx, name, fn, seed):
+    rnd = random.Random(seed)
+    call = fn(ctx, rnd)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        # keep result referenced while measuring
+        result = call()
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return {
+        'case': name,
+        'size': ctx.size,
+        'index': ctx.index,
+        'bytes_per_user': (current - start) / ctx.size,
+        'peak': peak - start,
+    }
+
+
+def run_case(ctx, name, fn, repeat, seed):
+    rnd = random.Random(seed)
+    setup_start = time.perf_counter()
+    call = fn(ctx, rnd)
+    setup = time.perf_counter() - setup_start
+    # untimed first call, lazy index builds are not part of the timings
+    warmup_start = time.perf_counter()
+    call()
+    warmup = time.perf_counter() - warmup_start
+    timings = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - start)
+    return {
+        'case': name,
+        'size': ctx.size,
+        'index': ctx.index,
+        'repeat': repeat,
+        'setup': setup,
+        'warmup': warmup,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'max': max(timings),
+    }
+
+
+def run(sizes, cases=None, repeat=20, index_modes=(False, True), seed=0,
+        log=sys.stderr):
+    results = list()
+    for size in sizes:
+        for index in index_modes:
+            tempdir = tempfile.mkdtemp()
+            try:
+                ctx = generate(tempdir, size, index, seed=seed)
+                for name, case_repeat, memory, fn in CASES:
+                    if cases and name not in cases:
+                        continue
+                    if memory:
+                        result = run_memory_case(ctx, name, fn, seed)
+                        log.write(
+                            '{case:<24} size={size:<8} index={index!s:<6}'
+                            ' bytes_per_user={bytes_per_user:.0f}\n'.format(
+                                **result
+                            )
+                        )
+                    else:
+                        result = run_case(
+                            ctx, name, fn, case_repeat or repeat, seed
+                        )
+                        log.write(
+                            '{case:<24} size={size:<8} index={index!s:<6}'
+                            ' median={median:.6f}s\n'.format(**result)
+                        )
+                    results.append(result)
+            finally:
+                shutil.rmtree(tempdir)
+    return {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': datetime.datetime.now().isoformat(),
+        },
+        'results': results,
+    }
+
+
+def compare(old, new, out=sys.stdout):
+    """Print median and memory ratios of matching results of two runs."""
+    def key(result):
+        return result['case'], result['size'], result['index']
+    old_results = dict([(key(r), r) for r in old['results']])
+    for result in new['results']:
+        old_result = old_results.get(key(result))
+        if old_result is None:
+            continue
+        if 'bytes_per_user' in result:
+            old_value = old_result['bytes_per_user']
+            value = result['bytes_per_user']
+            fmt = '{:<24} size={:<8} index={!s:<6} {:.0f}B -> {:.0f}B '
+        else:
+            old_value = old_result['median']
+            value = result['median']
+            fmt = '{:<24} size={:<8} index={!s:<6} {:.6f}s -> {:.6f}s '
+        ratio = value / old_value if old_value else float('nan')
+        out.write((fmt + '({:.2f}x)\n').format(
+            result['case'], result['size'], result['index'],
+            old_value, value, ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[1000, 10000],
+        help='Number of users to generate, e.g. 1000 10000 100000')
+    parser.add_argument(
+        '--cases', nargs='+', help='Only run given cases')
+    parser.add_argument(
+        '--repeat', type=int, default=20, help='Number of timed calls')
+    parser.add_argument(
+        '--index', choices=['both', 'on', 'off'], default='both',
+        help='Run with or without search index')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write JSON results to file')
+    parser.add_argument(
+        '--compare', nargs=2, metavar=('OLD', 'NEW'),
+        help='Compare two JSON result files')
+    parser.add_argument('--list', action='store_true', help='List cases')
+    args = parser.parse_args(argv)
+    if args.list:
+        for name, _, _, _ in CASES:
+            print(name)
+        return
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        compare(old, new)
+        return
+    index_modes = {
+        'both': (False, True),
+        'on': (True,),
+        'off': (False,),
+    }[args.index]
+    results = run(
+        args.sizes,
+        cases=args.cases,
+        repeat=args.repeat,
+        index_modes=index_modes,
+        seed=args.seed
+    )
+    data = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data)
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import itertools
+
+
+class AsyncPrincipals(object):
+    """Asynchronous facade of a principals container.
+
+    Blocking calls are run in the executor of the ``AsyncUgm``. Principal
+    nodes returned by ``get`` and ``create`` should not be changed on the
+    event loop, as this blocks on file I/O and tree locks. Use the methods
+    of the facade instead.
+    """
+
+    def __init__(self, ugm, principals):
+        self.ugm = ugm
+        self.principals = principals
+
+    async def get(self, id, default=None):
+        return await self.ugm.run(self.principals.get, id, default)
+
+    async def contains(self, id):
+        return await self.ugm.run(self.principals.__contains__, id)
+
+    async def keys(self):
+        return await self.ugm.run(lambda: list(self.principals.keys()))
+
+    async def create(self, id, **kw):
+        return await self.ugm.run(self.principals.create, id, **kw)
+
+    async def delete(self, id):
+        await self.ugm.run(self.principals.__delitem__, id)
+
+    async def attrs(self, id):
+        """Return attributes of principal as dict."""
+        return await self.ugm.run(
+            lambda: dict(self.principals[id].attrs.items())
+        )
+
+    async def set_attrs(self, id, attrs):
+        """Set attributes of principal from ``attrs`` mapping."""
+        def set_attrs():
+            principal_attrs = self.principals[id].attrs
+            for key, value in attrs.items():
+                principal_attrs[key] = value
+        await self.ugm.run(set_attrs)
+
+    async def delete_attrs(self, id, *keys):
+        """Delete attributes ``keys`` of principal."""
+        def delete_attrs():
+            principal_attrs = self.principals[id].attrs
+            for key in keys:
+                del principal_attrs[key]
+        await self.ugm.run(delete_attrs)
+
+    async def search(self, **kw):
+        return await self.ugm.run(self.principals.search, **kw)
+
+    async def search_iter(self, batch_size=100, **kw):
+        """Asynchronous iterator over results of ``search_iter`` of the
+        principals container. Results are fetched in the executor in batches
+        of ``batch_size``.
+        """
+        results = self.principals.search_iter(**kw)
+        while True:
+            batch = await self.ugm.run(
+                lambda: list(itertools.islice(results, batch_size))
+            )
+            if not batch:
+                return
+            for result in batch:
+                yield result
+
+    async def flush(self):
+        return await self.ugm.flush(self.principals)
+
+
+class AsyncUsers(AsyncPrincipals):
+    """Asynchronous facade of users."""
+
+    async def authenticate(self, id=None, pw=None):
+        return await self.ugm.run(self.principals.authenticate, id, pw)
+
+    async def passwd(self, id, oldpw, newpw):
+        await self.ugm.run(self.principals.passwd, id, oldpw, newpw)
+
+    async def id_for_login(self, login):
+        return await self.ugm.run(self.principals.id_for_login, login)
+
+
+class AsyncGroups(AsyncPrincipals):
+    """Asynchronous facade of groups."""
+
+    async def member_ids(self, id):
+        return await self.ugm.run(lambda: self.principals[id].member_ids)
+
+    async def add_member(self, id, member_id):
+        await self.ugm.run(lambda: self.principals[id].add(member_id))
+
+    async def remove_member(self, id, member_id):
+        await self.ugm.run(lambda: self.principals[id].remove(member_id))
+
+
+class AsyncUgm(object):
+    """Asynchronous facade of an UGM for usage in ``asyncio`` applications.
+
+    File I/O and password hashing are run in a thread pool executor with at
+    most ``max_workers`` threads, thus the event loop is not blocked. If
+    ``executor`` is given, it is used instead and not shut down on
+    ``close``.
+
+    Flushes are serialized by an ``asyncio.Lock``. Concurrent flushes wait on
+    the event loop instead of occupying executor threads while waiting for
+    the write lock of the tree.
+    """
+
+    def __init__(self, ugm, executor=None, max_workers=4):
+        self.ugm = ugm
+        self._own_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=max_workers,
+                thread_name_prefix='ugm'
+            )
+        self.executor = executor
+        self._flush_lock = None
+        self.users = AsyncUsers(self, ugm.users)
+        self.groups = AsyncGroups(self, ugm.groups)
+
+    async def run(self, func, *args, **kw):
+        """Run ``func`` in executor and return its result."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            functools.partial(func, *args, **kw)
+        )
+
+    async def flush(self, node=None):
+        """Persist modified data of ``node`` or the UGM. Return the number
+        of written files.
+        """
+        # lock gets created lazily to bind it to the running loop
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            return await self.run(node if node is not None else self.ugm)
+
+    async def roles(self, principal):
+        return await self.run(self.ugm.roles, principal)
+
+    async def add_role(self, role, principal):
+        await self.run(self.ugm.add_role, role, principal)
+
+    async def remove_role(self, role, principal):
+        await self.run(self.ugm.remove_role, role, principal)
+
+    def close(self):
+        if self._own_executor:
+            self.executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        # waiting for running calls must not block the event loop
+        await asyncio.to_thread(self.close)
@@ -1,3 +1,6 @@
+from collections import OrderedDict
+from collections.abc import Mapping
+from contextlib import nullcontext
 from datetime import datetime
 from node.behaviors import Attributes
 from node.behaviors import DefaultInit
@@ -12,33 +15,247 @@ from node.ext.ugm import Groups as BaseGroupsBehavior
 from node.ext.ugm import Ugm as BaseUgmBehavior
 from node.ext.ugm import User as BaseUserBehavior
 from node.ext.ugm import Users as BaseUsersBehavior
+from node.ext.ugm.hashing import SHA256Hasher
+from node.ext.ugm.hashing import verify as verify_password
+from node.ext.ugm.interfaces import IGroup
+from node.ext.ugm.locking import DirectoryLock
+from node.ext.ugm.locking import readlocktree
+from node.ext.ugm.locking import tree_rwlock
+from node.ext.ugm.locking import writelocktree
 from node.interfaces import IInvalidate
-from node.locking import TreeLock
-from node.locking import locktree
 from node.utils import UNSET
 from odict import odict
 from plumber import Behavior
 from plumber import default
 from plumber import override
+from plumber import plumb
 from plumber import plumbing
 from zope.interface import implementer
 import base64
+import bisect
 import hashlib
+import heapq
+import hmac
+import itertools
+import mmap
 import os
+import sys
+import threading
 import time
+import weakref
 
 
 ENCODING = 'utf-8'
 
 
+class FileData(odict):
+    """Ordered key/value data of a ``FileStorage``.
+
+    Keeps track of the keys changed since data has been read from or written
+    to the file. Setting a key to its current value is not considered a
+    change.
+    """
+
+    def __init__(self, data=()):
+        self.changed = set()
+        super(FileData, self).__init__(data)
+
+    def __setitem__(self, key, val):
+        if key in self and self[key] == val:
+            return
+        super(FileData, self).__setitem__(key, val)
+        self.changed.add(key)
+
+    def __delitem__(self, key):
+        super(FileData, self).__delitem__(key)
+        self.changed.add(key)
+
+    def clear(self):
+        self.changed.update(self.keys())
+        super(FileData, self).clear()
+
+
+class FileOffsets(object):
+    """Key to line offset index of a memory mapped ``FileStorage`` file.
+
+    The index gets persisted sorted by key next to the file and is searched
+    binary, thus opening an existing index not scales with the file size.
+    It gets rebuilt if size or modification time of the file has changed.
+    """
+
+    def __init__(self, path, delimiter):
+        self.index_path = '{}.offsets'.format(path)
+        self.delimiter = delimiter
+        self._data, stat = self._map(path)
+        self._header = '{}:{}\n'.format(
+            stat.st_size,
+            stat.st_mtime_ns
+        ).encode(ENCODING)
+        self._offsets = None
+        try:
+            self._index, _ = self._map(self.index_path)
+        except (IOError, OSError):
+            self._index = None
+        index = self._index
+        if index is None or index[:len(self._header)] != self._header:
+            self._offsets = self._build()
+            self._write_index()
+
+    def __getitem__(self, key):
+        """Return line of key as bytes."""
+        k = key.encode(ENCODING) if isinstance(key, UNICODE_TYPE) else key
+        if self._offsets is not None:
+            offset = self._offsets.get(k)
+        else:
+            offset = self._search(k)
+        if offset is None:
+            raise KeyError(key)
+        data = self._data
+        end = data.find(b'\n', offset)
+        return data[offset:] if end == -1 else data[offset:end]
+
+    def close(self):
+        for mapped in (self._data, self._index):
+            if mapped is not None:
+                mapped.close()
+        self._data = self._index = None
+
+    def _map(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if not stat.st_size:
+                return None, stat
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), stat
+
+    def _build(self):
+        # later lines win like on ``FileStorage.read_file``
+        offsets = dict()
+        data = self._data
+        if data is None:
+            return offsets
+        delimiter = self.delimiter
+        size = len(data)
+        pos = 0
+        while pos < size:
+            end = data.find(b'\n', pos)
+            if end == -1:
+                end = size
+            idx = data.find(delimiter, pos, end)
+            if idx != -1:
+                offsets[data[pos:idx]] = pos
+            pos = end + 1
+        return offsets
+
+    def _write_index(self):
+        lines = [self._header]
+        for key, offset in sorted(self._offsets.items()):
+            lines.append(key + b'\x00' + str(offset).encode(ENCODING) + b'\n')
+        tmp_path = '{}.{}.tmp'.format(self.index_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.writelines(lines)
+            os.replace(tmp_path, self.index_path)
+        except (IOError, OSError):
+            # index is an optimization, lookups work without persisting it
+            pass
+
+    def _search(self, key):
+        index = self._index
+        lo = len(self._header)
+        hi = len(index)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = index.rfind(b'\n', lo, mid)
+            start = lo if pos == -1 else pos + 1
+            end = index.find(b'\n', start)
+            sep = index.find(b'\x00', start, end)
+            line_key = index[start:sep]
+            if line_key == key:
+                return int(index[sep + 1:end])
+            if line_key < key:
+                lo = end + 1
+            else:
+                hi = start
+        return None
+
+
+def _load_lock(node):
+    # Reentrant lock of node guarding lazy loading of its storage data and
+    # principals. Created on first usage, ``dict.setdefault`` is atomic.
+    lock = node.__dict__.get('_load_lock_instance')
+    if lock is None:
+        lock = node.__dict__.setdefault(
+            '_load_lock_instance',
+            threading.RLock()
+        )
+    return lock
+
+
+def _directory_lock(node):
+    # ``DirectoryLock`` of the UGM node belongs to or None
+    return getattr(node.root, 'directory_lock', None)
+
+
+def _replay_changes(value, changes):
+    # Apply ``changes`` mapping items to a flag whether they have been added
+    # or removed to comma separated ``value``. Return sorted comma separated
+    # result.
+    items = set([item for item in value.split(u',') if item])
+    for item, added in changes.items():
+        if added:
+            items.add(item)
+        else:
+            items.discard(item)
+    return u','.join(sorted(items))
+
+
+class DirectoryLocking(Behavior):
+    """Hold the exclusive directory lock of the UGM while persisting."""
+
+    @plumb
+    def __call__(_next, self, *args, **kw):
+        lock = _directory_lock(self)
+        if lock is None:
+            return _next(self, *args, **kw)
+        with lock.exclusive():
+            return _next(self, *args, **kw)
+
+
 @implementer(IInvalidate)
 class FileStorage(MappingStorage):
     """MappingStorage behavior handling key/value pairs in a file.
 
     Cannot contain node children. Useful for node attributes stored in a file.
+
+    If ``journal`` is True, changes are appended as records to a journal file
+    next to the file instead of rewriting it. The journal gets replayed over
+    the file on read and compacted into the file once ``journal_threshold``
+    records are reached, optionally in a background thread if
+    ``journal_compact_background`` is True.
+
+    If ``mapped_read`` is True, ``lookup`` memory maps the file and decodes
+    only the line of the requested key as long as storage data has not been
+    read.
+
+    If ``revalidate_interval`` is set, modification time, size and inode of
+    the file are recorded on read. On access, at most once per interval in
+    seconds, the file is checked and re-read if changed by another process.
+    Unwritten local changes are kept on top of the re-read data. The keys
+    changed by the other process are passed to ``_reloaded``.
     """
     child_constraints = override(None)
     delimiter = default(':')
+    journal = default(False)
+    journal_threshold = default(1000)
+    journal_compact_background = default(False)
+    mapped_read = default(False)
+    revalidate_interval = default(None)
+    _journal_records = default(0)
+    _compaction = default(None)
+    _offsets = default(None)
+    _file_signature = default(None)
+    _revalidated = default(0.)
+    _loading = default(False)
 
     @override
     def __init__(self, name=None, parent=None, file_path=None):
@@ -50,59 +267,416 @@ class FileStorage(MappingStorage):
     @default
     @property
     def storage(self):
-        if self._storage_data is None:
-            self._storage_data = odict()
-            if self.file_path and os.path.isfile(self.file_path):
-                self.read_file()
+        # data gets read without holding a lock if completely loaded
+        data = self._storage_data
+        reload = False
+        if data is not None and not self._loading:
+            reload = self._needs_reload()
+            if not reload:
+                return data
+        with _load_lock(self):
+            if self._storage_data is None:
+                self._loading = True
+                try:
+                    self._storage_data = FileData()
+                    if self.file_path and os.path.isfile(self.file_path):
+                        self.read_file()
+                finally:
+                    self._loading = False
+                self._close_offsets()
+            # file might have been re-read by another thread meanwhile
+            elif reload and self._stat_signature() != self._file_signature:
+                self._reload()
         return self._storage_data
 
+    @default
+    @property
+    def dirty(self):
+        data = self._storage_data
+        return data is not None and bool(data.changed)
+
+    @default
+    @property
+    def exists(self):
+        return os.path.exists(self.file_path)
+
+    @default
+    @property
+    def journal_path(self):
+        return '{}.journal'.format(self.file_path)
+
+    @default
+    def lookup(self, key):
+        """Return value for key. Raise ``KeyError`` if key not exists.
+
+        In ``mapped_read`` mode, storage data is not read if not done yet.
+        Files with pending journal records are always read entirely.
+        """
+        if self._storage_data is not None or not self.mapped_read:
+            return self.storage[key]
+        offsets = self._offsets
+        if offsets is not None and self._needs_reload():
+            self._close_offsets()
+            offsets = None
+        if offsets is None:
+            journal_path = self.journal_path
+            if not os.path.isfile(self.file_path) \
+                    or os.path.exists(journal_path) \
+                    or os.path.exists('{}.compacting'.format(journal_path)):
+                return self.storage[key]
+            with self._file_lock():
+                self._record_signature()
+                offsets = self._offsets = FileOffsets(
+                    self.file_path,
+                    self._delimiter
+                )
+        return self._parse_line(offsets[key])[1]
+
     @default
     def read_file(self):
+        with self._file_lock():
+            self._record_signature()
+            data = self._storage_data
+            for k, v in self._read_lines(self.file_path):
+                data[k] = v
+            if self.journal:
+                self._journal_records = 0
+                journal_path = self.journal_path
+                for path in [
+                    '{}.compacting'.format(journal_path),
+                    journal_path
+                ]:
+                    if os.path.isfile(path):
+                        self._replay_journal(path)
+            data.changed.clear()
+
+    @default
+    def write_file(self):
+        """Write storage data to file if it has changed or if file not exists
+        yet. Return flag whether file has been written.
+
+        In journal mode, changes are appended to the journal file and the
+        file gets compacted if ``journal_threshold`` is reached.
+
+        If the UGM uses a ``directory_lock``, the file is written while
+        holding the exclusive lock and changes written by other processes
+        since the file has been read are merged first.
+        """
+        lock = _directory_lock(self)
+        if lock is None:
+            return self._write_file()
+        with lock.exclusive():
+            data = self._storage_data
+            if data is not None and data.changed:
+                self._merge_file()
+            return self._write_file()
+
+    @default
+    def _write_file(self):
         data = self._storage_data
-        delimiter = self.delimiter.encode(ENCODING) \
-            if isinstance(self.delimiter, UNICODE_TYPE) \
-            else self.delimiter
-        with open(self.file_path, 'rb') as f:
+        if data is None or not data.changed:
+            if os.path.exists(self.file_path):
+                return False
+            if data is None:
+                with open(self.file_path, 'wb') as file:
+                    file.write(b'')
+                return True
+        if self.journal and os.path.exists(self.file_path):
+            self._append_journal()
+            if self._journal_records >= self.journal_threshold:
+                self.compact(background=self.journal_compact_background)
+            self._record_signature()
+            return True
+        lines = self._format_lines()
+        # replace file to not break memory maps of the previous file
+        tmp_path = '{}.{}.tmp'.format(self.file_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.writelines(lines)
+        os.replace(tmp_path, self.file_path)
+        data.changed.clear()
+        self._remove_offsets()
+        if self.journal and os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+            self._journal_records = 0
+        self._record_signature()
+        return True
+
+    @default
+    def write_key(self, key):
+        """Write the value of ``key`` to file without writing other unwritten
+        changes. Other keys are written as currently contained in the file.
+        """
+        self.storage
+        with self._file_lock(exclusive=True):
+            # changes of other processes are merged first, otherwise they
+            # would be overwritten from memory with the next write
+            self._merge_file()
+            data = self._storage_data
+            if self.journal and os.path.exists(self.file_path):
+                self._append_journal(keys=[key])
+            else:
+                file_data = FileData()
+                if os.path.isfile(self.file_path):
+                    for k, v in self._read_lines(self.file_path):
+                        file_data[k] = v
+                if key in data:
+                    file_data[key] = data[key]
+                else:
+                    file_data.pop(key, None)
+                format_line = self._format_line
+                tmp_path = '{}.{}.tmp'.format(self.file_path, os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    f.writelines([
+                        format_line(k, v) for k, v in file_data.items()
+                    ])
+                os.replace(tmp_path, self.file_path)
+                self._remove_offsets()
+                data.changed.discard(key)
+            self._record_signature()
+
+    @default
+    def compact(self, background=False):
+        """Rewrite the file from storage data and remove the journal.
+
+        Journal records written so far are moved aside and replayed on read
+        until the rewritten file is in place, thus compaction can run in a
+        background thread while further changes get appended to a new journal.
+        Return the compaction thread if ``background`` is True.
+        """
+        compaction = self._compaction
+        if compaction is not None and compaction.is_alive():
+            return compaction
+        data = self.storage
+        if data.changed:
+            raise RuntimeError('Cannot compact file with unwritten changes')
+        with self._file_lock(exclusive=True):
+            self._merge_file()
+            lines = self._format_lines()
+            journal_path = self.journal_path
+            compacting_path = '{}.compacting'.format(journal_path)
+            if os.path.exists(journal_path):
+                if os.path.exists(compacting_path):
+                    # leftover of an interrupted compaction
+                    with open(journal_path, 'rb') as f:
+                        records = f.read()
+                    with open(compacting_path, 'ab') as f:
+                        f.write(records)
+                    os.remove(journal_path)
+                else:
+                    os.rename(journal_path, compacting_path)
+            self._journal_records = 0
+        file_path = self.file_path
+
+        def compact():
+            with self._file_lock(exclusive=True):
+                tmp_path = '{}.tmp'.format(file_path)
+                with open(tmp_path, 'wb') as f:
+                    f.writelines(lines)
+                os.replace(tmp_path, file_path)
+                if os.path.exists(compacting_path):
+                    os.remove(compacting_path)
+                offsets_path = '{}.offsets'.format(file_path)
+                if os.path.exists(offsets_path):
+                    os.remove(offsets_path)
+
+        if not background:
+            compact()
+            return None
+        compaction = self._compaction = threading.Thread(target=compact)
+        compaction.daemon = True
+        compaction.start()
+        return compaction
+
+    @default
+    @property
+    def _delimiter(self):
+        delimiter = self.delimiter
+        if isinstance(delimiter, UNICODE_TYPE):
+            return delimiter.encode(ENCODING)
+        return delimiter
+
+    @default
+    def _read_lines(self, path, prefixed=False):
+        parse_line = self._parse_line
+        with open(path, 'rb') as f:
             for line in f:
-                idx = line.find(delimiter)
-                if idx == -1:
+                if prefixed:
+                    op, line = line[:1], line[1:]
+                kv = parse_line(line)
+                if kv is None:
                     # malformed line, ignore
                     continue
-                k = line[:idx]
-                v = line[idx + len(delimiter):].strip(b'\n')
-                if v.startswith(b'b64:'):
-                    v = base64.b64decode(v[4:])
+                if prefixed:
+                    yield op, kv[0], kv[1]
                 else:
-                    v = v.decode(ENCODING)
-                data[k.decode(ENCODING)] = v
+                    yield kv
 
     @default
-    def write_file(self):
-        lines = list()
+    def _parse_line(self, line):
+        delimiter = self._delimiter
+        idx = line.find(delimiter)
+        if idx == -1:
+            return None
+        k = line[:idx]
+        v = line[idx + len(delimiter):].strip(b'\n')
+        if v.startswith(b'b64:'):
+            v = base64.b64decode(v[4:])
+        else:
+            v = v.decode(ENCODING)
+        return k.decode(ENCODING), v
+
+    @default
+    def _stat_signature(self):
+        paths = [self.file_path]
+        if self.journal:
+            journal_path = self.journal_path
+            paths += ['{}.compacting'.format(journal_path), journal_path]
+        signature = list()
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                signature.append(None)
+                continue
+            signature.append((stat.st_mtime_ns, stat.st_size, stat.st_ino))
+        return tuple(signature)
+
+    @default
+    def _record_signature(self):
+        self._file_signature = self._stat_signature()
+        self._revalidated = time.monotonic()
+
+    @default
+    def _needs_reload(self):
+        interval = self.revalidate_interval
+        if interval is None:
+            return False
+        now = time.monotonic()
+        if now - self._revalidated < interval:
+            return False
+        self._revalidated = now
+        return self._stat_signature() != self._file_signature
+
+    @default
+    def _file_lock(self, exclusive=False):
+        # Context manager holding the directory lock of the UGM if used
+        lock = _directory_lock(self)
+        if lock is None:
+            return nullcontext()
+        return lock.exclusive() if exclusive else lock.shared()
+
+    @default
+    def _merge_file(self):
+        # Re-read file if changed since it has been read. Unwritten local
+        # changes are kept.
         if self._storage_data is None:
-            if not os.path.exists(self.file_path):
-                with open(self.file_path, 'wb') as file:
-                    file.write(b'')
             return
+        if self._stat_signature() != self._file_signature:
+            with _load_lock(self):
+                self._reload()
+
+    @default
+    def _prepare_reload(self):
+        # Hook for pushing pending changes to storage data before reload
+        pass
+
+    @default
+    def _reload(self):
+        self._prepare_reload()
+        old = self._storage_data
+        self._loading = True
+        try:
+            data = self._storage_data = FileData()
+            if os.path.isfile(self.file_path):
+                self.read_file()
+            else:
+                self._record_signature()
+            changed = set([
+                key for key, value in data.items()
+                if key not in old or old[key] != value
+            ])
+            changed.update([key for key in old if key not in data])
+            changed.difference_update(old.changed)
+            for key in old.changed:
+                self._merge_change(key, old, data)
+        finally:
+            self._loading = False
+        self._reloaded(old, changed)
+
+    @default
+    def _merge_change(self, key, old, data):
+        # Apply unwritten local change of ``key`` from previous storage data
+        # ``old`` to re-read storage data ``data``. Local change wins.
+        if key in old:
+            data[key] = old[key]
+        elif key in data:
+            del data[key]
+
+    @default
+    def _reloaded(self, old, changed):
+        # Hook called after file has been re-read with previous storage
+        # data and the keys changed by another process.
+        pass
+
+    @default
+    def _close_offsets(self):
+        offsets = self._offsets
+        if offsets is not None:
+            offsets.close()
+            self._offsets = None
+
+    @default
+    def _remove_offsets(self):
+        self._close_offsets()
+        offsets_path = '{}.offsets'.format(self.file_path)
+        if os.path.exists(offsets_path):
+            os.remove(offsets_path)
+
+    @default
+    def _format_line(self, k, v):
+        if isinstance(k, UNICODE_TYPE):
+            k = k.encode(ENCODING)
+        if isinstance(v, UNICODE_TYPE):
+            v = v.encode(ENCODING)
+        elif v is None:
+            v = b''
+        elif v is UNSET:
+            v = b''
+        else:
+            v = b'b64:' + base64.b64encode(v)
+        return self._delimiter.join([k, v]) + b'\n'
+
+    @default
+    def _format_lines(self):
+        format_line = self._format_line
+        return [format_line(k, v) for k, v in self._storage_data.items()]
+
+    @default
+    def _replay_journal(self, path):
         data = self._storage_data
-        delimiter = self.delimiter.encode(ENCODING) \
-            if isinstance(self.delimiter, UNICODE_TYPE) \
-            else self.delimiter
-        for k, v in data.items():
-            if isinstance(k, UNICODE_TYPE):
-                k = k.encode(ENCODING)
-            if isinstance(v, UNICODE_TYPE):
-                v = v.encode(ENCODING)
-            elif v is None:
-                v = b''
-            elif v is UNSET:
-                v = b''
+        for op, k, v in self._read_lines(path, prefixed=True):
+            if op == b'-':
+                data.pop(k, None)
             else:
-                v = b'b64:' + base64.b64encode(v)
-            line = delimiter.join([k, v]) + b'\n'
-            lines.append(line)
-        with open(self.file_path, 'wb') as f:
-            f.writelines(lines)
+                data[k] = v
+            self._journal_records += 1
+
+    @default
+    def _append_journal(self, keys=None):
+        # Append records of changed keys or of ``keys`` to journal
+        data = self._storage_data
+        if keys is None:
+            keys = list(data.changed)
+        records = list()
+        for k in keys:
+            if k in data:
+                records.append(b'+' + self._format_line(k, data[k]))
+            else:
+                records.append(b'-' + self._format_line(k, None))
+        with open(self.journal_path, 'ab') as f:
+            f.writelines(records)
+        self._journal_records += len(records)
+        data.changed.difference_update(keys)
 
     @override
     def keys(self):
@@ -114,13 +688,15 @@ class FileStorage(MappingStorage):
         # This storage not provides invalidation by key. always entire storage
         # gets invalidated
         self._storage_data = None
+        self._close_offsets()
 
     @default
     def __call__(self):
-        self.write_file()
+        return int(self.write_file())
 
 
 @plumbing(
+    DirectoryLocking,
     MappingConstraints,
     MappingAdopt,
     MappingNode,
@@ -129,7 +705,335 @@ class FileAttributes(object):
     pass
 
 
-class UserAttributes(FileAttributes):
+class PrincipalRecord(Mapping):
+    """Read only attributes of a principal.
+
+    Compact representation of principals used on read paths instead of
+    principal nodes. Attribute keys are interned and records with the same
+    attribute keys share one keys tuple.
+    """
+    __slots__ = ('name', '_keys', '_values')
+    _key_layouts = dict()
+
+    def __init__(self, name, items):
+        keys = list()
+        values = list()
+        for key, value in items:
+            keys.append(sys.intern(key))
+            values.append(value)
+        keys = tuple(keys)
+        self.name = name
+        self._keys = self._key_layouts.setdefault(keys, keys)
+        self._values = tuple(values)
+
+    @property
+    def attrs(self):
+        return self
+
+    def __getitem__(self, key):
+        try:
+            return self._values[self._keys.index(key)]
+        except ValueError:
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __eq__(self, other):
+        if not isinstance(other, PrincipalRecord):
+            return NotImplemented
+        return self.name == other.name \
+            and self._keys == other._keys \
+            and self._values == other._values
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __repr__(self):
+        return '<{} \'{}\'>'.format(self.__class__.__name__, self.name)
+
+
+class PrincipalCache(OrderedDict):
+    """Principals by id with least recently used eviction.
+
+    If ``maxsize`` is set, least recently used principals get evicted once
+    the cache grows beyond it. Hits, misses and evictions are counted on
+    item access.
+
+    Item access reorders the cache, thus it is guarded by a lock to allow
+    concurrent readers.
+    """
+
+    def __init__(self, maxsize=None):
+        super(PrincipalCache, self).__init__()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            try:
+                value = super(PrincipalCache, self).__getitem__(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self.hits += 1
+            self.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super(PrincipalCache, self).__setitem__(key, value)
+            self.move_to_end(key)
+            self.trim()
+
+    def __delitem__(self, key):
+        with self._lock:
+            super(PrincipalCache, self).__delitem__(key)
+
+    def pop(self, key, *args):
+        with self._lock:
+            return super(PrincipalCache, self).pop(key, *args)
+
+    def trim(self):
+        """Evict least recently used principals until size is within
+        ``maxsize``.
+        """
+        with self._lock:
+            if self.maxsize is None:
+                return
+            while len(self) > self.maxsize:
+                self.popitem(last=False)
+                self.evictions += 1
+
+
+class AuthCache(object):
+    """Successfully verified credentials with time to live and least
+    recently used eviction.
+
+    Entries are keyed by a HMAC digest of user id and password with a random
+    per instance key, thus plain passwords are never kept. An entry also
+    holds the password hash it has been verified against, a hit requires the
+    current password hash to be unchanged.
+    """
+
+    def __init__(self, ttl, maxsize=1000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._key = os.urandom(32)
+        self._entries = OrderedDict()
+        self._ids = dict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, id, pw, pw_hash):
+        """Return whether credentials are cached for ``pw_hash``."""
+        digest = self._digest(id, pw)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return False
+            _, cached_hash, deadline = entry
+            if cached_hash != pw_hash or deadline <= time.monotonic():
+                self._remove(digest)
+                self.misses += 1
+                return False
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return True
+
+    def add(self, id, pw, pw_hash, expires=None):
+        """Cache verified credentials. If ``expires`` datetime is given, the
+        entry does not live beyond it.
+        """
+        ttl = self.ttl
+        if expires is not None:
+            ttl = min(ttl, (expires - datetime.now()).total_seconds())
+        digest = self._digest(id, pw)
+        with self._lock:
+            self._remove(digest)
+            self._entries[digest] = (id, pw_hash, time.monotonic() + ttl)
+            self._ids.setdefault(id, set()).add(digest)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, id=None):
+        """Remove entries of user ``id`` or all entries if id is None."""
+        with self._lock:
+            if id is None:
+                self._entries.clear()
+                self._ids.clear()
+                return
+            for digest in list(self._ids.get(id, ())):
+                self._remove(digest)
+
+    def _digest(self, id, pw):
+        value = u'{}\x00{}'.format(id, pw).encode(ENCODING)
+        return hmac.new(self._key, value, hashlib.sha256).digest()
+
+    def _remove(self, digest):
+        entry = self._entries.pop(digest, None)
+        if entry is None:
+            return
+        digests = self._ids[entry[0]]
+        digests.discard(digest)
+        if not digests:
+            del self._ids[entry[0]]
+
+
+class PrincipalAttributes(FileAttributes):
+    """File attributes of a principal.
+
+    Lets the principals container check attribute values before they are
+    written and notifies it about attribute changes.
+
+    If ``_record`` is set, reading is done from this ``PrincipalRecord``
+    until storage data is required for writing.
+    """
+    _record = None
+
+    @property
+    def storage(self):
+        record = self._record
+        if record is not None and self._storage_data is None:
+            data = self._storage_data = FileData(record.items())
+            data.changed.clear()
+            self._record = None
+        return super(PrincipalAttributes, self).storage
+
+    def __getitem__(self, key):
+        record = self._record
+        if record is not None and self._storage_data is None:
+            return record[key]
+        return super(PrincipalAttributes, self).__getitem__(key)
+
+    def __iter__(self):
+        record = self._record
+        if record is not None and self._storage_data is None:
+            return iter(record)
+        return super(PrincipalAttributes, self).__iter__()
+
+    def keys(self):
+        return list(self.__iter__())
+
+    @writelocktree
+    def __setitem__(self, key, value):
+        principal, principals = self._principal_and_container()
+        if principals is not None:
+            principals._check_attribute(principal.name, key, value)
+        old = self.storage.get(key)
+        super(PrincipalAttributes, self).__setitem__(key, value)
+        if principals is not None:
+            principals._principal_changed(principal)
+            principals._attribute_changed(principal.name, key, old, value)
+
+    @writelocktree
+    def __delitem__(self, key):
+        principal, principals = self._principal_and_container()
+        old = self.storage.get(key)
+        super(PrincipalAttributes, self).__delitem__(key)
+        if principals is not None:
+            principals._principal_changed(principal)
+            principals._attribute_changed(principal.name, key, old, None)
+
+    def invalidate(self, key=None):
+        self._record = None
+        super(PrincipalAttributes, self).invalidate(key=key)
+
+    def _reloaded(self, old, changed):
+        # keep search index in sync with attributes changed by another
+        # process
+        principal, principals = self._principal_and_container()
+        if principals is None:
+            return
+        data = self._storage_data
+        for key in changed:
+            principals._reindex_attribute(
+                principal.name,
+                key,
+                old.get(key),
+                data.get(key)
+            )
+
+    def _principal_and_container(self):
+        principal = self.parent
+        if principal is None:
+            return None, None
+        return principal, principal.parent
+
+
+class RoleAttributes(FileAttributes):
+    """Roles of principals by principal id.
+
+    Notifies the UGM about role changes. Added and removed roles are
+    recorded until written, thus roles of the same principal changed by
+    another process meanwhile are kept if the file gets re-read.
+    """
+
+    _role_changes = None
+
+    def __setitem__(self, key, value):
+        old = self.storage.get(key)
+        super(RoleAttributes, self).__setitem__(key, value)
+        self._record_role_changes(key, old, value)
+        self._roles_changed(key, old, value)
+
+    def __delitem__(self, key):
+        old = self.storage.get(key)
+        super(RoleAttributes, self).__delitem__(key)
+        # deleting all roles of principal wins
+        if self._role_changes:
+            self._role_changes.pop(key, None)
+        self._roles_changed(key, old, None)
+
+    def write_file(self):
+        written = super(RoleAttributes, self).write_file()
+        self._role_changes = None
+        return written
+
+    def invalidate(self, key=None):
+        super(RoleAttributes, self).invalidate(key=key)
+        self._role_changes = None
+
+    def _record_role_changes(self, key, old, new):
+        # changes are only merged if file gets re-read before writing
+        if self.revalidate_interval is None \
+                and _directory_lock(self) is None:
+            return
+        role_changes = self._role_changes
+        if role_changes is None:
+            role_changes = self._role_changes = dict()
+        changes = role_changes.setdefault(key, dict())
+        old_roles = set((old or u'').split(u','))
+        new_roles = set((new or u'').split(u','))
+        for role in new_roles.symmetric_difference(old_roles):
+            if role:
+                changes[role] = role in new_roles
+
+    def _merge_change(self, key, old, data):
+        changes = (self._role_changes or {}).get(key)
+        if changes and key in old and key in data:
+            data[key] = _replay_changes(data[key], changes)
+            return
+        super(RoleAttributes, self)._merge_change(key, old, data)
+
+    def _roles_changed(self, id, old, new):
+        ugm = self.parent
+        if ugm is not None:
+            ugm._roles_changed(id, old, new)
+
+
+class UserAttributes(PrincipalAttributes):
 
     def __getitem__(self, key):
         # provide id attribute expected by cone.ugm
@@ -151,7 +1055,11 @@ class UserBehavior(BaseUserBehavior):
         if not os.path.exists(user_data_dir):
             os.makedirs(user_data_dir)
         user_data_path = os.path.join(user_data_dir, parent.name)
-        return UserAttributes(name, parent, user_data_path)
+        attrs = UserAttributes(name, parent, user_data_path)
+        attrs.revalidate_interval = getattr(
+            parent.parent, 'revalidate_interval', None
+        )
+        return attrs
 
     attributes_factory = default(user_data_attributes_factory)
 
@@ -162,12 +1070,19 @@ class UserBehavior(BaseUserBehavior):
         self.data_directory = data_directory
 
     @default
-    @locktree
+    @writelocktree
     def __call__(self, from_parent=False):
-        self.attrs()
+        written = self.attrs()
         if not from_parent:
-            self.parent()
-            self.parent.parent.attrs()
+            written += self.parent()
+            written += self.parent.parent.attrs()
+        return written
+
+    @default
+    @property
+    def dirty(self):
+        attrs = getattr(self, '__attrs__', None)
+        return attrs is not None and attrs.dirty
 
     @override
     @property
@@ -216,25 +1131,36 @@ class UserBehavior(BaseUserBehavior):
     @default
     @property
     def groups(self):
-        groups = self.parent.parent.groups
-        ret = list()
-        for group in groups.values():
-            if self.name in group.member_ids:
-                ret.append(group)
-        return ret
+        return self.get_groups()
 
     @default
     @property
     def group_ids(self):
+        return self.get_group_ids()
+
+    @default
+    def get_groups(self, inherited=False):
+        """Return groups the user is member of. If ``inherited`` is set,
+        groups containing these groups are included.
+        """
         groups = self.parent.parent.groups
-        ret = list()
-        for group in groups.values():
-            if self.name in group.member_ids:
-                ret.append(group.name)
-        return ret
+        return [groups[id] for id in self.get_group_ids(inherited)]
+
+    @default
+    @readlocktree
+    def get_group_ids(self, inherited=False):
+        """Return sorted ids of groups the user is member of. If
+        ``inherited`` is set, ids of groups containing these groups are
+        included.
+        """
+        groups = self.parent.parent.groups
+        if inherited:
+            return sorted(groups._inherited_group_ids(self.name))
+        return sorted(groups._member_index.get(self.name, ()))
 
 
 @plumbing(
+    DirectoryLocking,
     UserBehavior,
     MappingConstraints,
     Attributes,
@@ -243,7 +1169,7 @@ class User(object):
     pass
 
 
-class GroupAttributes(FileAttributes):
+class GroupAttributes(PrincipalAttributes):
 
     def __getitem__(self, key):
         # provide id attribute expected by cone.ugm
@@ -261,7 +1187,11 @@ class GroupBehavior(BaseGroupBehavior):
         if not os.path.exists(group_data_dir):
             os.makedirs(group_data_dir)
         group_data_path = os.path.join(group_data_dir, parent.name)
-        return GroupAttributes(name, parent, group_data_path)
+        attrs = GroupAttributes(name, parent, group_data_path)
+        attrs.revalidate_interval = getattr(
+            parent.parent, 'revalidate_interval', None
+        )
+        return attrs
 
     attributes_factory = default(group_data_attributes_factory)
 
@@ -273,14 +1203,15 @@ class GroupBehavior(BaseGroupBehavior):
 
     @default
     def __getitem__(self, key):
-        if key not in self.member_ids:
+        # member groups are not contained in mapping, see ``group_member_ids``
+        if key.startswith('group:') or key not in self._members:
             raise KeyError(key)
         return self.parent.parent.users[key]
 
     @default
-    @locktree
+    @writelocktree
     def __delitem__(self, key):
-        if key not in self.member_ids:
+        if key.startswith('group:') or key not in self._members:
             raise KeyError(key)
         self._remove_member(key)
 
@@ -290,67 +1221,455 @@ class GroupBehavior(BaseGroupBehavior):
             yield id
 
     @default
-    @locktree
+    @writelocktree
     def __call__(self, from_parent=False):
-        self.attrs()
+        written = self.attrs()
         if not from_parent:
-            self.parent()
-            self.parent.parent.attrs()
+            written += self.parent()
+            written += self.parent.parent.attrs()
+        return written
 
     @default
+    @property
+    def dirty(self):
+        if self.name in (self.parent._members_changed or ()):
+            return True
+        attrs = getattr(self, '__attrs__', None)
+        return attrs is not None and attrs.dirty
+
+    @default
+    @writelocktree
     def add(self, id):
-        if id not in self.member_ids:
+        """Add member. Groups are added as members by their id prefixed with
+        ``group:``. Raise ``ValueError`` if adding a group would create a
+        cycle.
+        """
+        if id in self._members:
+            return
+        if id.startswith('group:'):
+            groups = self.parent
+            group_id = id[6:]
+            # raises KeyError if group not exists
+            groups.lookup(group_id)
+            if group_id == self.name \
+                    or self.name in groups._group_closure[0].get(group_id, ()):
+                raise ValueError(
+                    u"Adding group '{}' to group '{}' creates a cycle".format(
+                        group_id, self.name
+                    )
+                )
+        else:
             self.parent.parent.users[id]
-            self._add_member(id)
+        self._add_member(id)
+
+    @default
+    @writelocktree
+    def remove(self, id):
+        """Remove member. Groups are removed by their id prefixed with
+        ``group:``. Raise ``KeyError`` if ``id`` is no member.
+        """
+        if id not in self._members:
+            raise KeyError(id)
+        self._remove_member(id)
 
     @default
     def add_role(self, role):
         self.parent.parent.add_role(role, self)
 
     @default
-    def remove_role(self, role):
-        self.parent.parent.remove_role(role, self)
+    def remove_role(self, role):
+        self.parent.parent.remove_role(role, self)
+
+    @default
+    @property
+    def roles(self):
+        return self.parent.parent.roles(self)
+
+    @default
+    @property
+    def users(self):
+        return self.get_users()
+
+    @default
+    @property
+    def member_ids(self):
+        return self.get_member_ids()
+
+    @default
+    @property
+    @readlocktree
+    def group_member_ids(self):
+        """Sorted ids of groups which are member of this group."""
+        return sorted(self.parent._subgroup_ids(self.name))
+
+    @default
+    def get_users(self, recursive=False):
+        """Return member users. If ``recursive`` is set, members of member
+        groups are included.
+        """
+        users = self.parent.parent.users
+        return [users[id] for id in self.get_member_ids(recursive)]
+
+    @default
+    @readlocktree
+    def get_member_ids(self, recursive=False):
+        """Return sorted ids of member users. If ``recursive`` is set, members
+        of member groups are included.
+        """
+        if recursive:
+            return sorted(self.parent._recursive_member_ids(self.name))
+        return sorted([
+            id for id in self._members if not id.startswith('group:')
+        ])
+
+    @default
+    @property
+    def _members(self):
+        return self.parent._group_members(self.name)
+
+    @default
+    def _add_member(self, id):
+        groups = self.parent
+        groups._group_members(self.name).add(id)
+        groups._members_changed.add(self.name)
+        groups._member_changes.setdefault(self.name, dict())[id] = True
+        groups._index_member(self.name, id)
+
+    @default
+    def _remove_member(self, id):
+        groups = self.parent
+        groups._group_members(self.name).remove(id)
+        groups._members_changed.add(self.name)
+        groups._member_changes.setdefault(self.name, dict())[id] = False
+        groups._unindex_member(self.name, id)
+
+
+@plumbing(
+    DirectoryLocking,
+    GroupBehavior,
+    MappingConstraints,
+    Attributes,
+    MappingNode)
+class Group(object):
+    pass
+
+
+class AttributeIndex(object):
+    """Inverted index mapping values of a principal attribute to the ids of
+    the principals having this value.
+
+    For wildcard terms the index additionally maintains a sorted list of
+    values for prefix queries, a sorted list of reversed values for suffix
+    queries and a trigram index for substring queries. These structures only
+    cover text values and get built lazily on first wildcard query. Binary
+    values only match exact terms and ``*``.
+    """
+    ngram_len = 3
+
+    def __init__(self):
+        self.values = dict()
+        self._sorted = None
+        self._reversed = None
+        self._ngrams = None
+
+    def add(self, id, value):
+        # empty values never match, thus not indexed
+        if not value:
+            return
+        ids = self.values.get(value)
+        if ids is None:
+            ids = self.values[value] = set()
+            if isinstance(value, UNICODE_TYPE):
+                self._add_value(value)
+        ids.add(id)
+
+    def remove(self, id, value):
+        ids = self.values.get(value)
+        if ids is None:
+            return
+        ids.discard(id)
+        if not ids:
+            del self.values[value]
+            if isinstance(value, UNICODE_TYPE):
+                self._remove_value(value)
+
+    def discard(self, id):
+        """Remove id from all values. Used if the indexed value of the
+        principal is not known.
+        """
+        for value, ids in list(self.values.items()):
+            if id in ids:
+                self.remove(id, value)
+
+    def lookup(self, value):
+        return self.values.get(value, frozenset())
+
+    def match(self, term, compare):
+        """Return ids of principals with values matching term.
+
+        ``compare`` is the fallback function used to match terms with
+        wildcards in other places than at the start or end.
+        """
+        values = self.values
+        if term == '*':
+            return set().union(*values.values())
+        if not term.strip('*'):
+            return set()
+        # strip exactly one wildcard from each side like ``_compare_value``
+        inner = term
+        if inner[0] == '*':
+            inner = inner[1:]
+        if inner[-1:] == '*':
+            inner = inner[:-1]
+        if '*' in inner:
+            matching = [
+                v for v in values
+                if isinstance(v, UNICODE_TYPE) and compare(term, v)
+            ]
+        elif term[0] == '*' and term[-1] == '*':
+            matching = self._substring_values(inner)
+        elif term[0] == '*':
+            matching = [
+                v[::-1] for v in self._prefix_values(
+                    self._sorted_reversed, inner[::-1]
+                )
+            ]
+        elif term[-1] == '*':
+            matching = self._prefix_values(self._sorted_values, inner)
+        else:
+            return set(self.lookup(term))
+        return set().union(*[values[v] for v in matching])
+
+    @property
+    def _sorted_values(self):
+        if self._sorted is None:
+            self._sorted = sorted(
+                [v for v in self.values if isinstance(v, UNICODE_TYPE)]
+            )
+        return self._sorted
+
+    @property
+    def _sorted_reversed(self):
+        if self._reversed is None:
+            self._reversed = sorted(
+                [v[::-1] for v in self.values if isinstance(v, UNICODE_TYPE)]
+            )
+        return self._reversed
+
+    @property
+    def _ngram_values(self):
+        if self._ngrams is None:
+            ngrams = self._ngrams = dict()
+            for value in self.values:
+                if isinstance(value, UNICODE_TYPE):
+                    for ngram in self._value_ngrams(value):
+                        ngrams.setdefault(ngram, set()).add(value)
+        return self._ngrams
+
+    def _value_ngrams(self, value):
+        n = self.ngram_len
+        return set([value[i:i + n] for i in range(len(value) - n + 1)])
+
+    def _prefix_values(self, sorted_values, prefix):
+        ret = list()
+        idx = bisect.bisect_left(sorted_values, prefix)
+        for value in itertools.islice(sorted_values, idx, None):
+            if not value.startswith(prefix):
+                break
+            ret.append(value)
+        return ret
+
+    def _substring_values(self, term):
+        if len(term) < self.ngram_len:
+            return [
+                v for v in self.values
+                if isinstance(v, UNICODE_TYPE) and v.find(term) > -1
+            ]
+        ngrams = self._ngram_values
+        candidates = sorted(
+            [ngrams.get(ngram, set()) for ngram in self._value_ngrams(term)],
+            key=len
+        )
+        return [v for v in candidates[0].intersection(*candidates[1:])
+                if v.find(term) > -1]
+
+    def _add_value(self, value):
+        if self._sorted is not None:
+            bisect.insort(self._sorted, value)
+        if self._reversed is not None:
+            bisect.insort(self._reversed, value[::-1])
+        if self._ngrams is not None:
+            for ngram in self._value_ngrams(value):
+                self._ngrams.setdefault(ngram, set()).add(value)
+
+    def _remove_value(self, value):
+        if self._sorted is not None:
+            self._sorted.pop(bisect.bisect_left(self._sorted, value))
+        if self._reversed is not None:
+            reversed_value = value[::-1]
+            self._reversed.pop(
+                bisect.bisect_left(self._reversed, reversed_value)
+            )
+        if self._ngrams is not None:
+            for ngram in self._value_ngrams(value):
+                values = self._ngrams[ngram]
+                values.discard(value)
+                if not values:
+                    del self._ngrams[ngram]
+
+
+class RecordsBehavior(Behavior):
+    """Read access to principals without creating principal nodes.
+
+    Principals not loaded as node are read into ``PrincipalRecord`` objects,
+    which get cached until storage data is invalidated. A principal node
+    created afterwards reads its attributes from the record until they
+    change.
+
+    Principal nodes and records are kept in ``PrincipalCache`` objects
+    bounded by ``cache_size``. Evicted principal nodes are found as long as
+    they are referenced elsewhere, thus a principal is represented by one
+    node at a time. Principal nodes with changes are registered until they
+    are written, independent of the cache.
+    """
+    _records_data = default(None)
+    _records_map = default(None)
+
+    @property
+    def cache_size(self):
+        return self._mem_storage.maxsize
+
+    @default
+    @cache_size.setter
+    def cache_size(self, size):
+        self._mem_storage.maxsize = size
+        self._mem_storage.trim()
+        self._records_map = None
+
+    @default
+    @property
+    def cache_stats(self):
+        """Dict containing size, maxsize, hits, misses and evictions of the
+        principal node cache.
+        """
+        cache = self._mem_storage
+        return dict(
+            size=len(cache),
+            maxsize=cache.maxsize,
+            hits=cache.hits,
+            misses=cache.misses,
+            evictions=cache.evictions
+        )
+
+    @default
+    def record(self, id):
+        """Return ``PrincipalRecord`` of principal by id. Raise ``KeyError``
+        if principal not exists.
+        """
+        principal = self._read_principal(id)
+        if isinstance(principal, PrincipalRecord):
+            return principal
+        return PrincipalRecord(id, principal.attrs.items())
+
+    @plumb
+    def invalidate(_next, self, key=None):
+        _next(self, key=key)
+        self._records_map = None
+
+    @default
+    def _rebind_records(self, old, changed):
+        # Keep records if principals file has been re-read. Records of
+        # changed principals get dropped.
+        if self._records_map is None or self._records_data is not old:
+            return
+        self._records_data = self._storage_data
+        for id in changed:
+            self._records_map.pop(id, None)
 
     @default
     @property
-    def roles(self):
-        return self.parent.parent.roles(self)
+    def _records(self):
+        data = self._storage_data
+        if self._records_map is None or self._records_data is not data:
+            self._records_map = PrincipalCache(self.cache_size)
+            self._records_data = data
+        return self._records_map
 
     @default
-    @property
-    def users(self):
-        return [self.parent.parent.users[id] for id in self.member_ids]
+    def _loaded_principal(self, id):
+        # Return loaded principal node or None
+        try:
+            return self._mem_storage[id]
+        except KeyError:
+            principal = self._principal_refs.get(id)
+            if principal is not None:
+                # evicted but still referenced, add to cache again
+                self._mem_storage[id] = principal
+            return principal
 
     @default
-    @property
-    def member_ids(self):
-        return [id for id in self.parent.storage[self.name].split(u',') if id]
+    def _cache_principal(self, principal):
+        self._mem_storage[principal.name] = principal
+        self._principal_refs[principal.name] = principal
 
     @default
-    def _add_member(self, id):
-        member_ids = self.member_ids
-        member_ids.append(id)
-        member_ids = sorted(member_ids)
-        self.parent.storage[self.name] = u','.join(member_ids)
+    def _forget_principal(self, id):
+        self._mem_storage.pop(id, None)
+        self._principal_refs.pop(id, None)
+        self._changed_principals.pop(id, None)
 
     @default
-    def _remove_member(self, id):
-        member_ids = self.member_ids
-        member_ids.remove(id)
-        member_ids = sorted(member_ids)
-        self.parent.storage[self.name] = u','.join(member_ids)
+    def _principal_changed(self, principal):
+        # Register principal node to be written on next flush
+        self._changed_principals[principal.name] = principal
 
+    @default
+    def _write_principals(self):
+        # Write registered principal nodes. Return number of written files.
+        written = 0
+        changed = self._changed_principals
+        for id, principal in list(changed.items()):
+            written += principal(from_parent=True)
+            if changed.get(id) is principal:
+                del changed[id]
+        return written
 
-@plumbing(
-    GroupBehavior,
-    MappingConstraints,
-    Attributes,
-    MappingNode)
-class Group(object):
-    pass
+    @default
+    def _read_principal(self, id):
+        # Return principal node if loaded, otherwise principal record
+        principal = self._loaded_principal(id)
+        if principal is not None:
+            return principal
+        self.lookup(id)
+        records = self._records
+        record = records.get(id)
+        if record is None:
+            principal = self.principal_factory(
+                name=id,
+                parent=self,
+                data_directory=self.data_directory
+            )
+            record = PrincipalRecord(id, principal.attrs.storage.items())
+            records[id] = record
+        return record
+
+    @default
+    def _load_principal(self, id):
+        principal = self.principal_factory(
+            name=id,
+            parent=self,
+            data_directory=self.data_directory
+        )
+        record = self._records.pop(id, None)
+        if record is not None:
+            principal.attrs._record = record
+        return principal
 
 
 class SearchBehavior(Behavior):
+    index_attrs = default(())
+    _search_index_data = default(None)
+    _search_index_map = default(None)
 
     @default
     def _compare_value(self, term, value):
@@ -376,74 +1695,374 @@ class SearchBehavior(Behavior):
         return False
 
     @default
+    def _match_principal(self, principal, criteria, or_search):
+        # or search
+        if or_search:
+            for key, term in criteria.items():
+                if key == 'id':
+                    if self._compare_value(term, principal.name):
+                        return True
+                    # continue never executed due to cpython peephole
+                    # optimization, thus not counted in coverage
+                    continue                                 # pragma: no cover
+                value = principal.attrs.get(key)
+                if value and self._compare_value(term, value):
+                    return True
+            return False
+        # and search
+        for key, term in criteria.items():
+            if key == 'id':
+                if not self._compare_value(term, principal.name):
+                    return False
+                # continue never executed due to cpython peephole
+                # optimization, thus not counted in coverage
+                continue                                     # pragma: no cover
+            value = principal.attrs.get(key)
+            if not value or not self._compare_value(term, value):
+                return False
+        return True
+
+    @default
+    @readlocktree
     def search(self, criteria=None, attrlist=None,
-               exact_match=False, or_search=False):
-        """This is very slow and primary supposed to be used for testing or
-        setups with just a few users and groups.
+               exact_match=False, or_search=False,
+               sort_on=None, reverse=False, limit=None):
+        """Search principals.
+
+        Without an index this is very slow and primary supposed to be used for
+        testing or setups with just a few users and groups. If ``index_attrs``
+        is set, criteria on these attributes and on ``id`` are answered from
+        the search index.
+
+        Results are ordered by id, or by the value of attribute ``sort_on``
+        if given. Principals without value for ``sort_on`` are sorted last.
+        ``reverse`` reverts the order, ``limit`` restricts the number of
+        results. If ``sort_on`` is indexed and there are at least as many
+        candidates as distinct values, sorted values are taken from the
+        index, otherwise the top ``limit`` results are selected with a
+        bounded heap.
         """
-        found = set()
-        for principal in self.values():
-            # exact match too many
-            if exact_match and len(found) > 1:
-                raise ValueError('Exact match asked but result not unique')
-            # no criteria, all principals match
-            if not criteria:
-                found.add(principal)
-                continue
-            # or search
-            if or_search:
-                for key, term in criteria.items():
-                    if key == 'id':
-                        if self._compare_value(term, principal.name):
-                            found.add(principal)
-                        # continue never executed due to cpython peephole
-                        # optimization, thus not counted in coverage
-                        continue                             # pragma: no cover
-                    value = principal.attrs.get(key)
-                    if value:
-                        if self._compare_value(term, value):
-                            found.add(principal)
-                            continue
-            # and search
+        ids, criteria = self._search_candidates(criteria, or_search)
+        sort_index = None
+        if sort_on is not None and self.index_attrs:
+            sort_index = self._search_index.get(sort_on)
+            # walking the sorted values does not pay off if there are fewer
+            # candidates than distinct values
+            if sort_index is not None and len(ids) < len(sort_index.values):
+                sort_index = None
+        if sort_index is not None:
+            found = list(itertools.islice(
+                self._sorted_from_index(
+                    ids,
+                    criteria,
+                    or_search,
+                    sort_on,
+                    reverse
+                ),
+                limit
+            ))
+        elif sort_on is not None:
+            found = self._matching_principals(ids, criteria, or_search)
+            key = self._sort_key(sort_on, reverse)
+            if limit is None:
+                found = sorted(found, key=key, reverse=reverse)
+            elif reverse:
+                found = heapq.nlargest(limit, found, key=key)
             else:
-                matches = True
-                for key, term in criteria.items():
-                    if key == 'id':
-                        if not self._compare_value(term, principal.name):
-                            matches = False
-                            break
-                        # continue never executed due to cpython peephole
-                        # optimization, thus not counted in coverage
-                        continue                             # pragma: no cover
-                    value = principal.attrs.get(key)
-                    if not value or not self._compare_value(term, value):
-                        matches = False
-                        break
-                if matches:
-                    found.add(principal)
+                found = heapq.nsmallest(limit, found, key=key)
+        else:
+            if reverse:
+                ids = ids[::-1]
+            found = list()
+            for principal in self._matching_principals(
+                ids,
+                criteria,
+                or_search
+            ):
+                # exact match too many
+                if exact_match and len(found) > 1:
+                    raise ValueError(
+                        'Exact match asked but result not unique'
+                    )
+                if limit is not None and len(found) >= limit:
+                    break
+                found.append(principal)
+        # exact match too many
+        if exact_match and len(found) > 1:
+            raise ValueError('Exact match asked but result not unique')
         # exact match zero found
         if exact_match and len(found) == 0:
             raise ValueError('Exact match asked but result length is zero')
-        # attr list
-        if attrlist:
-            ret = list()
-            for principal in found:
-                pdata = dict()
-                for key in attrlist:
-                    if key == 'id':
-                        pdata[key] = principal.name
-                        continue
-                    pdata[key] = principal.attrs.get(key, '')
-                ret.append((principal.name, pdata))
-        # keys only
-        else:
-            ret = [principal.name for principal in found]
-        return ret
+        return [
+            self._search_result(principal, attrlist) for principal in found
+        ]
+
+    @default
+    def search_iter(self, criteria=None, attrlist=None, or_search=False,
+                    limit=None, offset=0, after=None):
+        """Iterate principals matching ``criteria`` ordered by id.
+
+        Principals are read while iterating, thus consumers can stop after
+        the results they need. ``offset`` matching principals are skipped
+        and at most ``limit`` results are returned. ``after`` is a cursor
+        id, only principals with a greater id are considered. Pass the id of
+        the last result of a page to get the next page.
+        """
+        with tree_rwlock(self).read():
+            ids, criteria = self._search_candidates(
+                criteria,
+                or_search,
+                after=after
+            )
+        if not criteria:
+            # no need to read skipped principals
+            ids = ids[offset:]
+            offset = 0
+        count = 0
+        for id in ids:
+            if limit is not None and count >= limit:
+                return
+            try:
+                principal = self._read_principal(id)
+            except KeyError:
+                # principal has been deleted meanwhile
+                continue
+            matches = not criteria \
+                or self._match_principal(principal, criteria, or_search)
+            if not matches:
+                continue
+            if offset:
+                offset -= 1
+                continue
+            count += 1
+            yield self._search_result(principal, attrlist)
+
+    @default
+    def _matching_principals(self, ids, criteria, or_search):
+        # Generator of principals with ids from ``ids`` matching criteria
+        for id in ids:
+            principal = self._read_principal(id)
+            # no criteria left, principal matches
+            if not criteria \
+                    or self._match_principal(principal, criteria, or_search):
+                yield principal
+
+    @default
+    def _sort_key(self, sort_on, reverse):
+        # Sort key function. Principals without text value are sorted last
+        # in both directions.
+        def key(principal):
+            value = self._index_value(principal, sort_on)
+            if not value or not isinstance(value, UNICODE_TYPE):
+                return (int(not reverse), u'', principal.name)
+            return (int(reverse), value, principal.name)
+        return key
+
+    @default
+    def _sorted_from_index(self, ids, criteria, or_search, sort_on, reverse):
+        # Generator of principals with ids from ``ids`` matching criteria
+        # in order of the sorted values of the ``sort_on`` attribute index.
+        attr_index = self._search_index[sort_on]
+        values = attr_index._sorted_values
+        if reverse:
+            values = reversed(values)
+        candidates = set(ids)
+        for value in values:
+            matching = sorted(attr_index.values[value] & candidates)
+            if reverse:
+                matching = reversed(matching)
+            for principal in self._matching_principals(
+                matching,
+                criteria,
+                or_search
+            ):
+                yield principal
+            candidates.difference_update(attr_index.values[value])
+        # principals without value for ``sort_on``
+        missing = sorted(candidates)
+        if reverse:
+            missing = reversed(missing)
+        for principal in self._matching_principals(
+            missing,
+            criteria,
+            or_search
+        ):
+            yield principal
+
+    @default
+    def _search_candidates(self, criteria, or_search, after=None):
+        # Return tuple of sorted candidate ids and criteria still to be
+        # checked on candidates. If ``after`` is given, only ids greater than
+        # it are returned.
+        candidates = None
+        if criteria:
+            candidates, criteria = self._index_lookup(criteria, or_search)
+        ids = sorted(self.storage if candidates is None else candidates)
+        if after is not None:
+            ids = ids[bisect.bisect_right(ids, after):]
+        return ids, criteria
+
+    @default
+    def _search_result(self, principal, attrlist):
+        # principal id or tuple of id and requested attributes
+        if not attrlist:
+            return principal.name
+        pdata = dict()
+        for key in attrlist:
+            if key == 'id':
+                pdata[key] = principal.name
+                continue
+            pdata[key] = principal.attrs.get(key, '')
+        return principal.name, pdata
+
+    @default
+    @property
+    def _search_index(self):
+        # Mapping of indexed attribute names to ``AttributeIndex`` objects.
+        # Gets built once from principal attributes and rebuilt if storage
+        # data has been invalidated.
+        data = self.storage
+        if self._search_index_data is not data:
+            index = dict()
+            if self.index_attrs:
+                index = dict([
+                    (attr, AttributeIndex())
+                    for attr in set(self.index_attrs) | {'id'}
+                ])
+                id_index = index.pop('id')
+                for id in data:
+                    id_index.add(id, id)
+                if index:
+                    for id in data:
+                        principal = self._read_principal(id)
+                        for attr, attr_index in index.items():
+                            attr_index.add(
+                                principal.name,
+                                principal.attrs.get(attr)
+                            )
+                index['id'] = id_index
+            self._search_index_map = index
+            self._search_index_data = data
+        return self._search_index_map
+
+    @default
+    def _index_lookup(self, criteria, or_search):
+        # Return tuple of candidate ids found in index and criteria still to
+        # be checked on candidates. Candidate ids are None if index is not
+        # applicable and all principals need to be checked.
+        if not self.index_attrs:
+            return None, criteria
+        index = self._search_index
+        results = list()
+        remaining = dict()
+        for key, term in criteria.items():
+            if key not in index:
+                remaining[key] = term
+                continue
+            results.append(index[key].match(term, self._compare_value))
+        if or_search:
+            if remaining:
+                return None, criteria
+            return set().union(*results), dict()
+        if not results:
+            return None, criteria
+        results = sorted(results, key=len)
+        return set(results[0]).intersection(*results[1:]), remaining
+
+    @default
+    @property
+    def _search_index_built(self):
+        data = self._search_index_data
+        return data is not None and data is self._storage_data
+
+    @default
+    def _rebind_search_index(self, old, changed):
+        # Keep search index if principals file has been re-read. It depends
+        # on principal ids and attributes, thus only added and removed
+        # principals need to be reindexed.
+        if self._search_index_data is not old:
+            return
+        data = self._storage_data
+        self._search_index_data = data
+        for id in changed:
+            if id in data and id in old:
+                continue
+            for attr, attr_index in self._search_index_map.items():
+                if attr == 'id':
+                    attr_index.remove(id, id)
+                else:
+                    attr_index.discard(id)
+            if id in data:
+                self._index_principal(self._read_principal(id))
+
+    @default
+    def _index_principal(self, principal):
+        if not self._search_index_built:
+            return
+        for attr, attr_index in self._search_index_map.items():
+            attr_index.add(principal.name, self._index_value(principal, attr))
+
+    @default
+    def _index_value(self, principal, attr):
+        if attr == 'id':
+            return principal.name
+        return principal.attrs.get(attr)
+
+    @default
+    def _unindex_principal(self, id):
+        if not self._search_index_built:
+            return
+        principal = self._read_principal(id)
+        for attr, attr_index in self._search_index_map.items():
+            attr_index.remove(id, self._index_value(principal, attr))
+
+    @default
+    def _check_attribute(self, id, key, value):
+        # Called by ``PrincipalAttributes`` before principal attribute gets
+        # written. Raise ``ValueError`` if value is not acceptable.
+        pass
+
+    @default
+    def _record_attrs(self, id, attrs):
+        # Return attributes of a ``create_many`` record as dict. Raise
+        # ``TypeError`` or ``ValueError`` if attributes cannot be written.
+        attrs = dict(attrs or {})
+        for key, value in attrs.items():
+            if not isinstance(key, UNICODE_TYPE) or not isinstance(
+                value,
+                (UNICODE_TYPE, bytes, type(None))
+            ):
+                raise TypeError(
+                    u"Invalid attribute '{}' of principal '{}'".format(
+                        key, id
+                    )
+                )
+            self._check_attribute(id, key, value)
+        return attrs
+
+    @default
+    def _attribute_changed(self, id, key, old, new):
+        # Called by ``PrincipalAttributes`` if principal attribute changes
+        self._reindex_attribute(id, key, old, new)
+
+    @default
+    def _reindex_attribute(self, id, key, old, new):
+        if not self._search_index_built or key == 'id':
+            return
+        attr_index = self._search_index_map.get(key)
+        if attr_index is not None:
+            attr_index.remove(id, old)
+            attr_index.add(id, new)
 
 
-class UsersBehavior(SearchBehavior, BaseUsersBehavior):
+class UsersBehavior(SearchBehavior, RecordsBehavior, BaseUsersBehavior):
+    principal_factory = default(User)
     salt_len = default(8)
     hash_func = default(hashlib.sha256)
+    password_hasher = default(None)
+    auth_cache_ttl = default(None)
+    auth_cache_size = default(1000)
+    _auth_cache_storage = default(None)
 
     @override
     def __init__(self, name=None, parent=None,
@@ -453,109 +2072,399 @@ class UsersBehavior(SearchBehavior, BaseUsersBehavior):
         self.file_path = file_path
         self.data_directory = data_directory
         self._storage_data = None
-        self._mem_storage = dict()
+        self._mem_storage = PrincipalCache()
+        self._principal_refs = weakref.WeakValueDictionary()
+        self._changed_principals = dict()
         self._user_data_to_remove = list()
+        self._login_index_data = None
+        self._login_index_storage = None
+        self._login_index_mapped = None
+        self._user_logins = None
+        self._user_logins_data = None
 
     @override
+    @readlocktree
     def __getitem__(self, key):
-        # access storage, if key not contained, KeyError is raised
-        self.storage[key]
-        try:
-            return self._mem_storage[key]
-        except KeyError:
-            with TreeLock(self):
-                user = self._mem_storage[key] = User(
-                    name=key,
-                    parent=self,
-                    data_directory=self.data_directory
-                )
-                return user
+        # lookup key in storage, if key not contained, KeyError is raised
+        self.lookup(key)
+        user = self._loaded_principal(key)
+        if user is None:
+            with _load_lock(self):
+                user = self._principal_refs.get(key)
+                if user is None:
+                    user = self._load_principal(key)
+                self._cache_principal(user)
+        return user
 
     @override
-    @locktree
+    @writelocktree
     def __setitem__(self, key, value):
         # set empty password on new added user.
         if key not in self.storage:
             self.storage[key] = u''
-        self._mem_storage[key] = value
+        elif self._principal_refs.get(key, value) is not value:
+            self._unindex_principal(key)
+        self._records.pop(key, None)
+        self._cache_principal(value)
+        self._principal_changed(value)
+        self._index_principal(value)
 
     @override
-    @locktree
+    @writelocktree
     def __delitem__(self, key):
         user = self[key]
         for group in user.groups:
             del group[user.name]
+        self._unindex_principal(key)
+        self._unindex_login(key)
+        self._invalidate_auth(key)
+        self.parent._invalidate_effective_roles(key)
         del self.storage[key]
-        del self._mem_storage[key]
+        self._forget_principal(key)
         if key in self.parent.attrs:
             del self.parent.attrs[key]
         self._user_data_to_remove.append(key)
 
     @override
-    @locktree
+    @writelocktree
     def __call__(self, from_parent=False):
-        self.write_file()
-        for value in self.values():
-            value(from_parent=True)
+        written = int(self.write_file())
+        if self._login_index_built:
+            # data directory not exists yet if no principal data was written
+            directory = self.data_directory
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            written += self._login_index_storage()
+            # mapped lookups of the rewritten file get reopened
+            self._close_mapped_login_index()
+        written += self._write_principals()
         if not from_parent:
-            self.parent.attrs()
-            self.parent.groups(from_parent=True)
+            written += self.parent.attrs()
+            written += self.parent.groups(from_parent=True)
         for userid in self._user_data_to_remove:
-            user_data_path = os.path.join(self.data_directory, 'users', userid)
-            if os.path.exists(user_data_path):
-                os.remove(user_data_path)
+            self._remove_principal_data(userid)
         self._user_data_to_remove = list()
+        return written
+
+    @override
+    def _reloaded(self, old, changed):
+        # users file contains passwords, login index and search index only
+        # depend on user ids and attributes
+        self._rebind_records(old, changed)
+        self._rebind_search_index(old, changed)
+        if self._login_index_data is old:
+            self._login_index_data = self._storage_data
+
+    @default
+    def _remove_principal_data(self, id):
+        user_data_path = os.path.join(self.data_directory, 'users', id)
+        if os.path.exists(user_data_path):
+            os.remove(user_data_path)
 
     @default
+    @writelocktree
     def create(self, id, **kw):
-        user = User(name=id, parent=self, data_directory=self.data_directory)
+        if id not in self.storage:
+            user_id = self._login_index.get(id, id)
+            if user_id != id:
+                raise ValueError(
+                    u"Login '{}' is already used by user '{}'".format(
+                        id, user_id
+                    )
+                )
+        # nothing gets indexed if an attribute is not acceptable
+        for k, v in kw.items():
+            self._check_attribute(id, k, v)
+        user = self.principal_factory(
+            name=id,
+            parent=self,
+            data_directory=self.data_directory
+        )
         for k, v in kw.items():
             user.attrs[k] = v
         self[id] = user
         return user
 
     @default
+    @readlocktree
     def id_for_login(self, login):
-        # XXX
-        return login
+        """Return id of user with login. Users without ``login`` attribute
+        login with their id, thus login is returned if not found in login
+        index.
+        """
+        if self.mapped_read and not self._login_index_built:
+            index = self._mapped_login_index()
+            if index is not None:
+                try:
+                    return index.lookup(login)
+                except KeyError:
+                    return login
+        return self._login_index.get(login, login)
+
+    @default
+    def _mapped_login_index(self):
+        # Login index file in ``mapped_read`` mode, kept for subsequent
+        # lookups. None if file not exists.
+        index = self._login_index_mapped
+        if index is None:
+            with _load_lock(self):
+                index = self._login_index_mapped
+                if index is None:
+                    index = self.login_index_factory()
+                    if not index.exists:
+                        return None
+                    index.mapped_read = True
+                    self._login_index_mapped = index
+        return index
+
+    @default
+    def _close_mapped_login_index(self):
+        index = self._login_index_mapped
+        if index is not None:
+            self._login_index_mapped = None
+            index.invalidate()
+
+    @default
+    def login_index_factory(self):
+        path = os.path.join(self.data_directory, 'logins')
+        index = FileAttributes('__logins__', self, path)
+        index.revalidate_interval = self.revalidate_interval
+        return index
+
+    @default
+    @property
+    def _login_index(self):
+        # Persistent login to user id index stored in ``logins`` file inside
+        # data directory. If file not exists, index gets built from user
+        # attributes. Rebuilt if storage data has been invalidated.
+        data = self.storage
+        if self._login_index_data is not data:
+            index = self.login_index_factory()
+            if not index.exists:
+                for id in data:
+                    user = self._read_principal(id)
+                    login = user.attrs.get('login')
+                    if login:
+                        index[login] = user.name
+            self._login_index_storage = index
+            self._login_index_data = data
+        index = self._login_index_storage
+        # reverse mapping, rebuilt if logins file has been re-read
+        logins = index.storage
+        if self._user_logins_data is not logins:
+            self._user_logins = dict([(v, k) for k, v in logins.items()])
+            self._user_logins_data = logins
+        return index
+
+    @default
+    @property
+    def _login_index_built(self):
+        data = self._login_index_data
+        return data is not None and data is self._storage_data
+
+    @default
+    def _unindex_login(self, id):
+        # if index has not been persisted yet, it gets built from the
+        # remaining users on first usage, otherwise it needs to be loaded
+        if not self._login_index_built \
+                and not self.login_index_factory().exists:
+            return
+        index = self._login_index
+        login = self._user_logins.pop(id, None)
+        if login is not None:
+            del index[login]
+
+    @override
+    def _check_attribute(self, id, key, value):
+        if key != 'login' or not value:
+            return
+        user_id = self._login_index.get(value)
+        if user_id is None and value != id and value in self.storage \
+                and value not in self._user_logins:
+            # user without login attribute logs in with its id
+            user_id = value
+        if user_id is not None and user_id != id:
+            raise ValueError(
+                u"Login '{}' is already used by user '{}'".format(
+                    value, user_id
+                )
+            )
+
+    @override
+    def _attribute_changed(self, id, key, old, new):
+        self._reindex_attribute(id, key, old, new)
+        if key == getattr(self.parent, 'user_expires_attr', None):
+            self._invalidate_auth(id)
+        if key != 'login':
+            return
+        self._unindex_login(id)
+        if new and self._login_index_built:
+            self._login_index_storage[new] = id
+            self._user_logins[id] = new
 
     @default
     def authenticate(self, id=None, pw=None):
-        if id not in self.storage:
-            return False
-        # cannot authenticate user with unset password
-        if not self.storage[id]:
-            return False
-        if self[id].expired:
+        """Authenticate user. The password gets rehashed if it has been
+        hashed with another hasher or cost than ``password_hasher``.
+        """
+        cache = self._auth_cache
+        if cache is not None:
+            try:
+                pw_hash = self.lookup(id)
+            except KeyError:
+                return False
+            if pw_hash and cache.get(id, pw, pw_hash):
+                return True
+        pw_hash = self._verify_pw(id, pw)
+        if pw_hash is None:
             return False
-        return self._chk_pw(pw, self.storage[id])
+        if self._password_hasher.needs_rehash(pw_hash):
+            self._rehash_pw(id, pw, pw_hash)
+        if cache is not None:
+            cache.add(id, pw, self.lookup(id), expires=self._expires(id))
+        return True
+
+    @default
+    @property
+    def _auth_cache(self):
+        # ``AuthCache`` if ``auth_cache_ttl`` is set, otherwise None
+        if self.auth_cache_ttl is None:
+            return None
+        cache = self._auth_cache_storage
+        if cache is None:
+            cache = self._auth_cache_storage = AuthCache(
+                self.auth_cache_ttl,
+                maxsize=self.auth_cache_size
+            )
+        return cache
+
+    @default
+    def _invalidate_auth(self, id):
+        cache = self._auth_cache_storage
+        if cache is not None:
+            cache.invalidate(id)
 
     @default
+    @writelocktree
     def passwd(self, id, oldpw, newpw):
         if id not in self.storage:
             raise ValueError(u"User with id '{}' does not exist.".format(id))
         if oldpw is not None:
             if not self._chk_pw(oldpw, self.storage[id]):
                 raise ValueError('Old password does not match.')
-        salt = os.urandom(self.salt_len)
-        newpw = newpw.encode(ENCODING) \
-            if isinstance(newpw, UNICODE_TYPE) \
-            else newpw
-        hashed = base64.b64encode(self.hash_func(newpw + salt).digest() + salt)
-        self.storage[id] = hashed.decode()
+        self._set_pw(id, newpw)
         self()
 
+    @default
+    @writelocktree
+    def create_many(self, records):
+        """Create users from an iterable of ``(id, attrs, password,
+        group_ids)`` records and persist them with a single flush.
+
+        ``password`` may be None. Records failing validation are skipped.
+        Return list of ``(id, exception)`` tuples for skipped records.
+        """
+        errors = list()
+        for record in records:
+            try:
+                id, attrs, password, group_ids = record
+            except (TypeError, ValueError) as e:
+                errors.append((None, e))
+                continue
+            try:
+                self._create_from_record(id, attrs, password, group_ids)
+            except (KeyError, TypeError, ValueError) as e:
+                errors.append((id, e))
+        self.parent()
+        return errors
+
+    @default
+    def _create_from_record(self, id, attrs, password, group_ids):
+        if not id or not isinstance(id, UNICODE_TYPE):
+            raise ValueError(u"Invalid user id '{}'".format(id))
+        if id in self.storage:
+            raise ValueError(u"User with id '{}' already exists.".format(id))
+        if password is not None \
+                and not isinstance(password, (UNICODE_TYPE, bytes)):
+            raise TypeError(u"Invalid password for user '{}'".format(id))
+        attrs = self._record_attrs(id, attrs)
+        groups = self.parent.groups
+        group_ids = list(group_ids or [])
+        for group_id in group_ids:
+            # raises KeyError if group not exists
+            groups.storage[group_id]
+        user = self.create(id, **attrs)
+        if password is not None:
+            self._set_pw(id, password)
+        for group_id in group_ids:
+            groups[group_id].add(user.name)
+
+    @default
+    @property
+    def _password_hasher(self):
+        hasher = self.password_hasher
+        if hasher is None:
+            hasher = SHA256Hasher(self.salt_len, self.hash_func)
+        return hasher
+
+    @default
+    @readlocktree
+    def _verify_pw(self, id, pw):
+        # return password hash if user authenticates, otherwise None
+        try:
+            pw_hash = self.lookup(id)
+        except KeyError:
+            return None
+        # cannot authenticate user with unset password
+        if not pw_hash:
+            return None
+        expires = self._expires(id)
+        if expires and datetime.now() >= expires:
+            return None
+        if not self._chk_pw(pw, pw_hash):
+            return None
+        return pw_hash
+
+    @default
+    def _expires(self, id):
+        # Expiration datetime of user or None. Read from principal record,
+        # thus no user node gets created.
+        expires_attr = getattr(self.parent, 'user_expires_attr', None)
+        if not expires_attr:
+            return None
+        expires = self._read_principal(id).attrs.get(expires_attr)
+        if not expires:
+            return None
+        return datetime.fromtimestamp(float(expires))
+
+    @default
+    @writelocktree
+    def _rehash_pw(self, id, pw, pw_hash):
+        # skip if password has been changed meanwhile
+        if self.storage.get(id) != pw_hash:
+            return
+        self._set_pw(id, pw)
+        # other unwritten changes are not persisted as side effect
+        self.write_key(id)
+
+    @default
+    def _set_pw(self, id, pw):
+        self.storage[id] = self._password_hasher.hash(pw)
+        self._invalidate_auth(id)
+
     @default
     def _chk_pw(self, plain, hashed):
-        hashed = base64.b64decode(hashed)
-        salt = hashed[-self.salt_len:]
-        plain = plain.encode(ENCODING) \
-            if isinstance(plain, UNICODE_TYPE) \
-            else plain
-        return hashed == self.hash_func(plain + salt).digest() + salt
+        # legacy hashes are verified with ``salt_len`` and ``hash_func``
+        return verify_password(
+            plain,
+            hashed,
+            self._password_hasher,
+            [SHA256Hasher(self.salt_len, self.hash_func)]
+        )
 
 
 @plumbing(
+    DirectoryLocking,
     UsersBehavior,
     MappingConstraints,
     MappingAdopt,
@@ -566,7 +2475,8 @@ class Users(object):
     pass
 
 
-class GroupsBehavior(SearchBehavior, BaseGroupsBehavior):
+class GroupsBehavior(SearchBehavior, RecordsBehavior, BaseGroupsBehavior):
+    principal_factory = default(Group)
 
     @override
     def __init__(self, name=None, parent=None,
@@ -576,69 +2486,355 @@ class GroupsBehavior(SearchBehavior, BaseGroupsBehavior):
         self.file_path = file_path
         self.data_directory = data_directory
         self._storage_data = None
-        self._mem_storage = dict()
+        self._mem_storage = PrincipalCache()
+        self._principal_refs = weakref.WeakValueDictionary()
+        self._changed_principals = dict()
         self._group_data_to_remove = list()
+        self._members_data = None
+        self._members_map = None
+        self._closure_data = None
+        self._closure_map = None
+        self._members_changed = None
+        self._member_changes = dict()
+        self._member_index_data = None
+        self._member_index_map = None
 
     @override
+    @readlocktree
     def __getitem__(self, key):
-        # access storage, if key not contained, KeyError is raised
-        self.storage[key]
-        try:
-            return self._mem_storage[key]
-        except KeyError:
-            with TreeLock(self):
-                group = self._mem_storage[key] = Group(
-                    name=key,
-                    parent=self,
-                    data_directory=self.data_directory
-                )
-                return group
+        # lookup key in storage, if key not contained, KeyError is raised
+        self.lookup(key)
+        group = self._loaded_principal(key)
+        if group is None:
+            with _load_lock(self):
+                group = self._principal_refs.get(key)
+                if group is None:
+                    group = self._load_principal(key)
+                self._cache_principal(group)
+        return group
 
     @override
-    @locktree
+    @writelocktree
     def __setitem__(self, key, value):
         # set empty group members on new added group.
         if key not in self.storage:
             self.storage[key] = u''
-        self._mem_storage[key] = value
+        elif self._principal_refs.get(key, value) is not value:
+            self._unindex_principal(key)
+        self._records.pop(key, None)
+        self._cache_principal(value)
+        self._principal_changed(value)
+        self._index_principal(value)
 
     @override
-    @locktree
+    @writelocktree
     def __delitem__(self, key):
-        del self.storage[key]
-        if key in self._mem_storage:
-            del self._mem_storage[key]
+        self._unindex_principal(key)
         id = 'group:{}'.format(key)
+        for group_id in list(self._member_index.get(id, ())):
+            self[group_id].remove(id)
+        members = self._group_members(key)
+        for member_id in list(members):
+            members.remove(member_id)
+            self._unindex_member(key, member_id)
+        del self._members_map[key]
+        self._members_changed.discard(key)
+        self._member_changes.pop(key, None)
+        del self.storage[key]
+        self._forget_principal(key)
         if id in self.parent.attrs:
             del self.parent.attrs[id]
         self._group_data_to_remove.append(key)
 
     @override
-    @locktree
+    @writelocktree
     def __call__(self, from_parent=False):
-        self.write_file()
-        for value in self.values():
-            value(from_parent=True)
+        self._write_members()
+        written = int(self.write_file())
+        self._member_changes = dict()
+        written += self._write_principals()
         if not from_parent:
-            self.parent.attrs()
-            self.parent.users(from_parent=True)
+            written += self.parent.attrs()
+            written += self.parent.users(from_parent=True)
         for groupid in self._group_data_to_remove:
-            group_data_path = os.path.join(
-                self.data_directory, 'groups', groupid)
-            if os.path.exists(group_data_path):
-                os.remove(group_data_path)
+            self._remove_principal_data(groupid)
         self._group_data_to_remove = list()
+        return written
+
+    @override
+    def _reloaded(self, old, changed):
+        # membership caches depend on the groups file and get rebuilt, search
+        # index only depends on group ids and attributes. Recorded membership
+        # changes are kept until written.
+        if self._members_data is old:
+            self._members_map = dict()
+            self._members_data = self._storage_data
+        self._rebind_records(old, changed)
+        self._rebind_search_index(old, changed)
+
+    @default
+    def _remove_principal_data(self, id):
+        group_data_path = os.path.join(self.data_directory, 'groups', id)
+        if os.path.exists(group_data_path):
+            os.remove(group_data_path)
 
     @default
+    @writelocktree
     def create(self, id, **kw):
-        group = Group(name=id, parent=self, data_directory=self.data_directory)
+        for k, v in kw.items():
+            self._check_attribute(id, k, v)
+        group = self.principal_factory(
+            name=id,
+            parent=self,
+            data_directory=self.data_directory
+        )
         for k, v in kw.items():
             group.attrs[k] = v
         self[id] = group
         return group
 
+    @default
+    @writelocktree
+    def create_many(self, records):
+        """Create groups from an iterable of ``(id, attrs, member_ids)``
+        records and persist them with a single flush.
+
+        Records failing validation are skipped. Return list of
+        ``(id, exception)`` tuples for skipped records.
+        """
+        errors = list()
+        for record in records:
+            try:
+                id, attrs, member_ids = record
+            except (TypeError, ValueError) as e:
+                errors.append((None, e))
+                continue
+            try:
+                self._create_from_record(id, attrs, member_ids)
+            except (KeyError, TypeError, ValueError) as e:
+                errors.append((id, e))
+        self.parent()
+        return errors
+
+    @default
+    def _create_from_record(self, id, attrs, member_ids):
+        if not id or not isinstance(id, UNICODE_TYPE):
+            raise ValueError(u"Invalid group id '{}'".format(id))
+        if id in self.storage:
+            raise ValueError(u"Group with id '{}' already exists.".format(id))
+        attrs = self._record_attrs(id, attrs)
+        users = self.parent.users
+        member_ids = list(member_ids or [])
+        for member_id in member_ids:
+            # raises KeyError if user or group not exists
+            if member_id.startswith('group:'):
+                self.storage[member_id[6:]]
+            else:
+                users.storage[member_id]
+        group = self.create(id, **attrs)
+        for member_id in member_ids:
+            group.add(member_id)
+
+    @default
+    def _group_members(self, group_id):
+        # Parsed member ids of group as set. Modified groups are tracked in
+        # ``_members_changed`` and the comma separated storage value only gets
+        # rebuilt in ``_write_members`` right before the groups file is
+        # written. Added and removed members are recorded in
+        # ``_member_changes`` until written. Raises ``KeyError`` if group not
+        # exists.
+        data = self.storage
+        if self._members_data is not data:
+            self._members_map = dict()
+            self._members_changed = set()
+            self._member_changes = dict()
+            self._members_data = data
+        members = self._members_map.get(group_id)
+        if members is None:
+            members = self._members_map[group_id] = set(
+                [id for id in data[group_id].split(u',') if id]
+            )
+        return members
+
+    @override
+    def _prepare_reload(self):
+        # keep unwritten membership changes when groups file gets re-read
+        self._write_members()
+
+    @override
+    def _merge_change(self, key, old, data):
+        # replay membership changes on members written by another process
+        changes = self._member_changes.get(key)
+        if changes and key in old and key in data:
+            data[key] = _replay_changes(data[key], changes)
+        elif key in old:
+            data[key] = old[key]
+        elif key in data:
+            del data[key]
+
+    @default
+    def _write_members(self):
+        data = self._storage_data
+        if data is None or self._members_data is not data:
+            return
+        members_map = self._members_map
+        for group_id in self._members_changed:
+            data[group_id] = u','.join(sorted(members_map[group_id]))
+        self._members_changed = set()
+
+    @default
+    @property
+    def _member_index(self):
+        # Reverse membership index mapping user ids to the set of group ids
+        # the user is member of. Gets built once from storage and rebuilt if
+        # storage data has been invalidated.
+        data = self.storage
+        if self._member_index_data is not data:
+            index = dict()
+            for group_id in data:
+                for member_id in self._group_members(group_id):
+                    index.setdefault(member_id, set()).add(group_id)
+            self._member_index_map = index
+            self._member_index_data = data
+        return self._member_index_map
+
+    @default
+    def _index_member(self, group_id, member_id):
+        self._member_index.setdefault(member_id, set()).add(group_id)
+        self._membership_changed(member_id)
+        if member_id.startswith('group:'):
+            self._closure_add(group_id, member_id[6:])
+
+    @default
+    def _unindex_member(self, group_id, member_id):
+        index = self._member_index
+        group_ids = index.get(member_id)
+        if group_ids is None:
+            return
+        group_ids.discard(group_id)
+        if not group_ids:
+            del index[member_id]
+        self._membership_changed(member_id)
+        if member_id.startswith('group:'):
+            self._closure_remove(group_id)
+
+    @default
+    def _subgroup_ids(self, group_id):
+        return [
+            id[6:] for id in self._group_members(group_id)
+            if id.startswith('group:')
+        ]
+
+    @default
+    @property
+    def _group_closure(self):
+        # Tuple of transitive closure mappings of group ids to the ids of
+        # all groups contained in and all groups containing the group. Built
+        # once and rebuilt if storage data has been invalidated. Membership
+        # changes of groups update the affected entries.
+        data = self.storage
+        if self._closure_data is not data:
+            descendants = dict()
+            ancestors = dict()
+            for group_id in data:
+                found = self._contained_group_ids(group_id)
+                for id in found:
+                    ancestors.setdefault(id, set()).add(group_id)
+                if found:
+                    descendants[group_id] = found
+            self._closure_map = (descendants, ancestors)
+            self._closure_data = data
+        return self._closure_map
+
+    @default
+    def _contained_group_ids(self, group_id):
+        # Ids of groups contained in group directly or by nested groups
+        data = self.storage
+        found = set()
+        stack = self._subgroup_ids(group_id)
+        while stack:
+            id = stack.pop()
+            # skip cycles and dangling members in groups file
+            if id in found or id == group_id or id not in data:
+                continue
+            found.add(id)
+            stack.extend(self._subgroup_ids(id))
+        return found
+
+    @default
+    def _closure_add(self, group_id, member_group_id):
+        # Update closure after group ``member_group_id`` has been added to
+        # group ``group_id``. Containing groups of ``group_id`` gain the
+        # added group and its contained groups and vice versa.
+        if self._closure_data is not self._storage_data \
+                or member_group_id not in self._storage_data:
+            return
+        descendants, ancestors = self._closure_map
+        upper = ancestors.get(group_id, set()) | {group_id}
+        lower = descendants.get(member_group_id, set()) | {member_group_id}
+        for id in upper:
+            found = lower - {id}
+            if found:
+                descendants.setdefault(id, set()).update(found)
+        for id in lower:
+            found = upper - {id}
+            if found:
+                ancestors.setdefault(id, set()).update(found)
+
+    @default
+    def _closure_remove(self, group_id):
+        # Update closure after a group has been removed from group
+        # ``group_id``. Only contained groups of ``group_id`` and its
+        # containing groups are affected, they get computed anew.
+        if self._closure_data is not self._storage_data:
+            return
+        descendants, ancestors = self._closure_map
+        upper = ancestors.get(group_id, set()) | {group_id}
+        for id in upper:
+            found = self._contained_group_ids(id)
+            for removed in descendants.get(id, set()) - found:
+                group_ids = ancestors[removed]
+                group_ids.discard(id)
+                if not group_ids:
+                    del ancestors[removed]
+            if found:
+                descendants[id] = found
+            else:
+                descendants.pop(id, None)
+
+    @default
+    def _inherited_group_ids(self, member_id):
+        # Ids of groups containing member directly or by nested groups
+        group_ids = self._member_index.get(member_id, ())
+        ancestors = self._group_closure[1]
+        result = set(group_ids)
+        for group_id in group_ids:
+            result.update(ancestors.get(group_id, ()))
+        return result
+
+    @default
+    def _recursive_member_ids(self, group_id):
+        # Ids of users which are member of group or of contained groups.
+        # Raises ``KeyError`` if group not exists.
+        result = set()
+        group_ids = [group_id]
+        group_ids.extend(self._group_closure[0].get(group_id, ()))
+        for id in group_ids:
+            result.update([
+                member_id for member_id in self._group_members(id)
+                if not member_id.startswith('group:')
+            ])
+        return result
+
+    @default
+    def _membership_changed(self, member_id):
+        ugm = self.parent
+        if ugm is not None:
+            ugm._invalidate_effective_roles(member_id)
+
 
 @plumbing(
+    DirectoryLocking,
     GroupsBehavior,
     MappingConstraints,
     MappingAdopt,
@@ -650,11 +2846,20 @@ class Groups(object):
 
 
 class UgmBehavior(BaseUgmBehavior):
+    users_factory = default(Users)
+    groups_factory = default(Groups)
+    _role_index_data = default(None)
+    _role_index_map = default(None)
+    _effective_roles_data = default(None)
+    _effective_roles_map = default(None)
 
     @default
     def role_attributes_factory(self, name=None, parent=None):
-        attrs = FileAttributes(name, parent, parent.roles_file)
+        attrs = RoleAttributes(name, parent, parent.roles_file)
         attrs.delimiter = '::'
+        attrs.journal = parent.journal
+        attrs.mapped_read = parent.mapped_read
+        attrs.revalidate_interval = parent.revalidate_interval
         return attrs
 
     attributes_factory = default(role_attributes_factory)
@@ -667,7 +2872,18 @@ class UgmBehavior(BaseUgmBehavior):
                  groups_file=None,
                  roles_file=None,
                  data_directory=None,
-                 user_expires_attr=None):
+                 user_expires_attr=None,
+                 journal=False,
+                 user_index_attrs=(),
+                 group_index_attrs=(),
+                 mapped_read=False,
+                 cache_size=None,
+                 revalidate_interval=None,
+                 locking=False,
+                 lock_timeout=None,
+                 password_hasher=None,
+                 auth_cache_ttl=None,
+                 auth_cache_size=1000):
         # XXX: remove name and parent once using ``NodeInit`` behavior
         self.__name__ = name
         self.__parent__ = parent
@@ -676,24 +2892,71 @@ class UgmBehavior(BaseUgmBehavior):
         self.roles_file = roles_file
         self.data_directory = data_directory
         self.user_expires_attr = user_expires_attr
+        self.journal = journal
+        self.user_index_attrs = user_index_attrs
+        self.group_index_attrs = group_index_attrs
+        self.mapped_read = mapped_read
+        self.cache_size = cache_size
+        self.revalidate_interval = revalidate_interval
+        self.locking = locking
+        self.lock_timeout = lock_timeout
+        self.password_hasher = password_hasher
+        self.auth_cache_ttl = auth_cache_ttl
+        self.auth_cache_size = auth_cache_size
+        self._directory_lock = None
+
+    @default
+    @property
+    def directory_lock(self):
+        """``DirectoryLock`` on ``data_directory`` if ``locking`` is set.
+
+        Files are read with the shared lock held, the exclusive lock is held
+        while persisting.
+        """
+        if not self.locking:
+            return None
+        if self._directory_lock is None:
+            directory = self.data_directory
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            self._directory_lock = DirectoryLock(
+                directory,
+                timeout=self.lock_timeout
+            )
+        return self._directory_lock
 
     @override
     def __getitem__(self, key):
         if key not in self.storage:
             if key == 'users':
-                self['users'] = Users(
+                users = self.users_factory(
                     file_path=self.users_file,
                     data_directory=self.data_directory
                 )
+                users.journal = self.journal
+                users.mapped_read = self.mapped_read
+                users.cache_size = self.cache_size
+                users.revalidate_interval = self.revalidate_interval
+                users.password_hasher = self.password_hasher
+                users.auth_cache_ttl = self.auth_cache_ttl
+                users.auth_cache_size = self.auth_cache_size
+                users.index_attrs = self.user_index_attrs
+                self['users'] = users
             else:
-                self['groups'] = Groups(
+                groups = self.groups_factory(
                     file_path=self.groups_file,
                     data_directory=self.data_directory
                 )
+                groups.journal = self.journal
+                groups.mapped_read = self.mapped_read
+                groups.cache_size = self.cache_size
+                groups.revalidate_interval = self.revalidate_interval
+                groups.index_attrs = self.group_index_attrs
+                self['groups'] = groups
         return self.storage[key]
 
     @override
-    @locktree
+    @writelocktree
     def __setitem__(self, key, value):
         self._chk_key(key)
         self.storage[key] = value
@@ -708,11 +2971,13 @@ class UgmBehavior(BaseUgmBehavior):
             yield key
 
     @override
-    @locktree
+    @writelocktree
     def __call__(self):
-        self.attrs()
-        self.users(from_parent=True)
-        self.groups(from_parent=True)
+        """Persist modified data. Return the number of written files."""
+        written = self.attrs()
+        written += self.users(from_parent=True)
+        written += self.groups(from_parent=True)
+        return written
 
     @default
     @property
@@ -725,6 +2990,7 @@ class UgmBehavior(BaseUgmBehavior):
         return self['groups']
 
     @default
+    @readlocktree
     def roles(self, principal):
         id = self._principal_id(principal)
         return self._roles(id)
@@ -735,7 +3001,7 @@ class UgmBehavior(BaseUgmBehavior):
         return self.attrs
 
     @default
-    @locktree
+    @writelocktree
     def add_role(self, role, principal):
         roles = self.roles(principal)
         if role in roles:
@@ -745,7 +3011,7 @@ class UgmBehavior(BaseUgmBehavior):
         self.attrs[self._principal_id(principal)] = u','.join(roles)
 
     @default
-    @locktree
+    @writelocktree
     def remove_role(self, role, principal):
         roles = self.roles(principal)
         if role not in roles:
@@ -754,19 +3020,127 @@ class UgmBehavior(BaseUgmBehavior):
         roles = sorted(roles)
         self.attrs[self._principal_id(principal)] = u','.join(roles)
 
+    @default
+    @readlocktree
+    def principals_with_role(self, role):
+        """Return tuple of sorted user ids and sorted group ids of principals
+        having ``role``.
+        """
+        users = list()
+        groups = list()
+        for id in sorted(self._role_index.get(role, ())):
+            if id.startswith('group:'):
+                groups.append(id[6:])
+            else:
+                users.append(id)
+        return users, groups
+
+    @default
+    @readlocktree
+    def effective_roles(self, user):
+        """Return sorted roles of ``user`` including the roles of the groups
+        the user is member of.
+        """
+        return sorted(self._effective_roles(user.name))
+
+    @default
+    @readlocktree
+    def has_role(self, user, role):
+        """Flag whether ``user`` has ``role`` directly or by group
+        membership.
+        """
+        return role in self._effective_roles(user.name)
+
     @default
     def _principal_id(self, principal):
         id = principal.name
-        if isinstance(principal, Group):
+        if IGroup.providedBy(principal):
             id = 'group:{}'.format(id)
         return id
 
+    @default
+    @property
+    def _role_index(self):
+        # Mapping of roles to ids of principals having this role. Built once
+        # from roles storage and rebuilt if storage data has been re-read.
+        data = self.attrs.storage
+        if self._role_index_data is not data:
+            index = dict()
+            for id, roles in data.items():
+                for role in self._split_roles(roles):
+                    index.setdefault(role, set()).add(id)
+            self._role_index_map = index
+            self._role_index_data = data
+        return self._role_index_map
+
+    @default
+    def _effective_roles(self, id):
+        # Effective roles of user as frozenset. Cached per user, the cache
+        # gets reset if roles or groups storage data has been re-read.
+        groups = self.groups
+        data = (self.attrs.storage, groups.storage)
+        cached = self._effective_roles_data
+        if cached is None \
+                or cached[0] is not data[0] \
+                or cached[1] is not data[1]:
+            self._effective_roles_map = dict()
+            self._effective_roles_data = data
+        cache = self._effective_roles_map
+        roles = cache.get(id)
+        if roles is None:
+            roles = set(self._roles(id))
+            for group_id in groups._inherited_group_ids(id):
+                roles.update(self._roles('group:{}'.format(group_id)))
+            roles = cache[id] = frozenset(roles)
+        return roles
+
+    @default
+    def _invalidate_effective_roles(self, id):
+        # Drop cached effective roles affected by changes of principal
+        cache = self._effective_roles_map
+        if not cache:
+            return
+        if not id.startswith('group:'):
+            cache.pop(id, None)
+            return
+        try:
+            member_ids = self.groups._recursive_member_ids(id[6:])
+        except KeyError:
+            # deleted group, members have been unindexed already
+            return
+        for member_id in member_ids:
+            cache.pop(member_id, None)
+
+    @default
+    def _roles_changed(self, id, old, new):
+        # Called by ``RoleAttributes`` if roles of principal change
+        self._invalidate_effective_roles(id)
+        data = self._role_index_data
+        if data is None or data is not self.attrs._storage_data:
+            return
+        index = self._role_index_map
+        for role in self._split_roles(old):
+            ids = index.get(role)
+            if ids is not None:
+                ids.discard(id)
+                if not ids:
+                    del index[role]
+        for role in self._split_roles(new):
+            index.setdefault(role, set()).add(id)
+
+    @default
+    def _split_roles(self, roles):
+        if not roles:
+            return []
+        return [role for role in roles.split(',') if role]
+
     @default
     def _roles(self, id):
-        attrs = self.attrs
-        if id not in attrs:
+        try:
+            roles = self.attrs.lookup(id)
+        except KeyError:
             return list()
-        return [role for role in attrs[id].split(',') if role]
+        return self._split_roles(roles)
 
     @default
     def _chk_key(self, key):
@@ -775,6 +3149,7 @@ class UgmBehavior(BaseUgmBehavior):
 
 
 @plumbing(
+    DirectoryLocking,
     UgmBehavior,
     MappingConstraints,
     MappingAdopt,
@@ -0,0 +1,187 @@
+from node.compat import UNICODE_TYPE
+import base64
+import hashlib
+import hmac
+import os
+
+
+ENCODING = 'utf-8'
+HASHERS = dict()
+
+
+def register_hasher(hasher):
+    """Register hasher class by its ``name``, which is used as algorithm tag
+    in stored hashes. Can be used as class decorator.
+    """
+    HASHERS[hasher.name] = hasher
+    return hasher
+
+
+def identify(hashed):
+    """Return tuple of hasher class and params stored in ``hashed``.
+
+    Hashes in format ``$<name>$<params>$<salt>$<hash>`` are tagged with the
+    name of the hasher. Untagged hashes are legacy salted SHA256 hashes.
+    Raise ``ValueError`` if hasher is unknown.
+    """
+    if not hashed.startswith('$'):
+        return SHA256Hasher, None
+    parts = hashed.split('$')
+    if len(parts) != 5:
+        raise ValueError('Invalid password hash')
+    hasher = HASHERS.get(parts[1])
+    if hasher is None:
+        raise ValueError(u"Unknown password hasher '{}'".format(parts[1]))
+    params = dict()
+    for param in filter(None, parts[2].split(',')):
+        key, value = param.split('=')
+        params[key] = int(value)
+    return hasher, params
+
+
+def verify(pw, hashed, hasher, hashers=()):
+    """Check ``pw`` against ``hashed``. ``hasher`` or the first of
+    ``hashers`` is used if ``hashed`` has been created by a hasher of the same
+    class, otherwise the hasher class identified by ``hashed`` is used with
+    default parameters. Pass a configured ``SHA256Hasher`` in ``hashers`` if
+    legacy hashes use other settings than the defaults.
+    """
+    hasher_class = identify(hashed)[0]
+    for candidate in [hasher] + list(hashers):
+        if candidate.__class__ is hasher_class:
+            return candidate.verify(pw, hashed)
+    return hasher_class().verify(pw, hashed)
+
+
+def _encode(value):
+    if isinstance(value, UNICODE_TYPE):
+        return value.encode(ENCODING)
+    return value
+
+
+def _b64encode(value):
+    return base64.b64encode(value).decode()
+
+
+class Hasher(object):
+    """Base class for password hashers.
+
+    Subclasses define ``name`` and the cost parameters in ``params`` and
+    implement ``digest``.
+    """
+    name = None
+    salt_len = 16
+
+    @property
+    def params(self):
+        return dict()
+
+    def digest(self, pw, salt, params):
+        raise NotImplementedError(
+            'Abstract ``Hasher`` does not implement ``digest``'
+        )
+
+    def hash(self, pw):
+        """Return tagged hash of ``pw`` with random salt."""
+        salt = os.urandom(self.salt_len)
+        params = self.params
+        return '${}${}${}${}'.format(
+            self.name,
+            ','.join([
+                '{}={}'.format(key, params[key]) for key in sorted(params)
+            ]),
+            _b64encode(salt),
+            _b64encode(self.digest(_encode(pw), salt, params))
+        )
+
+    def verify(self, pw, hashed):
+        """Check ``pw`` against ``hashed`` which is in the tagged format of
+        this hasher.
+        """
+        params = identify(hashed)[1]
+        salt, digest = hashed.split('$')[3:]
+        expected = self.digest(_encode(pw), base64.b64decode(salt), params)
+        return hmac.compare_digest(base64.b64decode(digest), expected)
+
+    def needs_rehash(self, hashed):
+        """Flag whether ``hashed`` has been created by another hasher or with
+        other cost parameters than configured.
+        """
+        hasher, params = identify(hashed)
+        if hasher is not self.__class__:
+            return True
+        return params is not None and params != self.params
+
+
+@register_hasher
+class SHA256Hasher(Hasher):
+    """Single round of salted ``hash_func``.
+
+    Also verifies untagged legacy hashes in format
+    ``base64(hash_func(pw + salt) + salt)``. They are not considered for
+    rehashing, as the algorithm does not change.
+    """
+    name = 'sha256'
+
+    def __init__(self, salt_len=8, hash_func=hashlib.sha256):
+        self.salt_len = salt_len
+        self.hash_func = hash_func
+
+    def digest(self, pw, salt, params):
+        return self.hash_func(pw + salt).digest()
+
+    def verify(self, pw, hashed):
+        if hashed.startswith('$'):
+            return super(SHA256Hasher, self).verify(pw, hashed)
+        hashed = base64.b64decode(hashed)
+        salt = hashed[-self.salt_len:]
+        expected = self.digest(_encode(pw), salt, None) + salt
+        return hmac.compare_digest(hashed, expected)
+
+
+@register_hasher
+class PBKDF2Hasher(Hasher):
+    """PBKDF2 with HMAC-SHA256 and configurable number of ``iterations``."""
+    name = 'pbkdf2-sha256'
+
+    def __init__(self, iterations=600000, salt_len=16):
+        self.iterations = iterations
+        self.salt_len = salt_len
+
+    @property
+    def params(self):
+        return dict(i=self.iterations)
+
+    def digest(self, pw, salt, params):
+        return hashlib.pbkdf2_hmac('sha256', pw, salt, params['i'])
+
+
+@register_hasher
+class ScryptHasher(Hasher):
+    """Scrypt with configurable CPU/memory cost ``n``, block size ``r`` and
+    parallelization ``p``.
+    """
+    name = 'scrypt'
+    dklen = 64
+
+    def __init__(self, n=2 ** 14, r=8, p=1, salt_len=16):
+        self.n = n
+        self.r = r
+        self.p = p
+        self.salt_len = salt_len
+
+    @property
+    def params(self):
+        return dict(n=self.n, r=self.r, p=self.p)
+
+    def digest(self, pw, salt, params):
+        n, r, p = params['n'], params['r'], params['p']
+        return hashlib.scrypt(
+            pw,
+            salt=salt,
+            n=n,
+            r=r,
+            p=p,
+            maxmem=128 * n * r * p + 1024 * 1024,
+            dklen=self.dklen
+        )
@@ -0,0 +1,277 @@
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+
+try:  # pragma: no cover
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+class DirectoryLock(object):
+    """Inter process reader/writer lock on a directory.
+
+    Uses ``fcntl.flock`` on a lock file inside the directory. Shared locks
+    are used for reading, exclusive locks for writing. The lock is held per
+    process, threads of the process join the lock held by the process. It is
+    released once all acquisitions of the process are released. A process
+    holding a shared lock converts it to an exclusive one if a thread
+    acquires the exclusive lock.
+
+    If ``timeout`` is set, ``TimeoutError`` is raised if the lock cannot be
+    acquired within ``timeout`` seconds. Wait times are recorded in
+    ``metrics``.
+    """
+    lock_name = '.lock'
+    poll_interval = 0.01
+
+    def __init__(self, directory, timeout=None):
+        if fcntl is None:  # pragma: no cover
+            raise RuntimeError('Directory locking requires ``fcntl``')
+        self.path = os.path.join(directory, self.lock_name)
+        self.timeout = timeout
+        self._mutex = threading.Lock()
+        self._fd = None
+        self._mode = None
+        self._shared = 0
+        self._exclusive = 0
+        self._metrics = dict([(mode, dict(
+            acquired=0,
+            wait_time=0.,
+            max_wait=0.,
+            timeouts=0
+        )) for mode in ['shared', 'exclusive']])
+
+    @property
+    def metrics(self):
+        """Dict containing number of acquisitions, total and max time waited
+        for the lock and number of timeouts per lock mode.
+        """
+        with self._mutex:
+            return dict([
+                (mode, dict(metrics))
+                for mode, metrics in self._metrics.items()
+            ])
+
+    @contextmanager
+    def shared(self):
+        self.acquire(exclusive=False)
+        try:
+            yield self
+        finally:
+            self.release(exclusive=False)
+
+    @contextmanager
+    def exclusive(self):
+        self.acquire(exclusive=True)
+        try:
+            yield self
+        finally:
+            self.release(exclusive=True)
+
+    def acquire(self, exclusive=False):
+        with self._mutex:
+            if exclusive:
+                self._exclusive += 1
+            else:
+                self._shared += 1
+            try:
+                if self._mode != fcntl.LOCK_EX:
+                    mode = fcntl.LOCK_EX if self._exclusive else fcntl.LOCK_SH
+                    if self._mode != mode:
+                        self._lock(mode)
+            except BaseException:
+                if exclusive:
+                    self._exclusive -= 1
+                else:
+                    self._shared -= 1
+                self._release_unused()
+                raise
+            self._metrics['exclusive' if exclusive else 'shared'][
+                'acquired'
+            ] += 1
+
+    def release(self, exclusive=False):
+        with self._mutex:
+            if exclusive:
+                self._exclusive -= 1
+            else:
+                self._shared -= 1
+            self._release_unused()
+
+    def _lock(self, mode):
+        metrics = self._metrics[
+            'exclusive' if mode == fcntl.LOCK_EX else 'shared'
+        ]
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        timeout = self.timeout
+        start = time.monotonic()
+        if timeout is None:
+            fcntl.flock(self._fd, mode)
+        else:
+            while True:
+                try:
+                    fcntl.flock(self._fd, mode | fcntl.LOCK_NB)
+                    break
+                except (BlockingIOError, PermissionError):
+                    if time.monotonic() - start >= timeout:
+                        metrics['timeouts'] += 1
+                        self._record_wait(metrics, start)
+                        if self._mode == fcntl.LOCK_SH:
+                            # failed conversion dropped the shared lock
+                            fcntl.flock(self._fd, fcntl.LOCK_SH)
+                        raise TimeoutError(
+                            'Cannot acquire lock {} within {}s'.format(
+                                self.path,
+                                timeout
+                            )
+                        )
+                    time.sleep(self.poll_interval)
+        self._mode = mode
+        self._record_wait(metrics, start)
+
+    def _record_wait(self, metrics, start):
+        wait = time.monotonic() - start
+        metrics['wait_time'] += wait
+        metrics['max_wait'] = max(metrics['max_wait'], wait)
+
+    def _release_unused(self):
+        if self._shared or self._exclusive or self._fd is None:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+        self._mode = None
+
+
+class ReadWriteLock(object):
+    """Reentrant reader/writer lock for threads.
+
+    Any number of threads may hold the read lock at the same time, the write
+    lock is held by a single thread exclusively. Waiting writers are
+    preferred over new readers. A thread holding the write lock may acquire
+    the read lock. A thread holding the read lock may upgrade to the write
+    lock, which waits until all other readers released the lock. If two
+    threads try to upgrade at the same time, ``RuntimeError`` is raised in
+    the second one, as they would wait for each other forever.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = dict()
+        self._writer = None
+        self._writes = 0
+        self._waiting_writers = 0
+        self._upgrading = None
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield self
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield self
+        finally:
+            self.release_write()
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        with self._cond:
+            readers = self._readers
+            if self._writer == me or me in readers:
+                readers[me] = readers.get(me, 0) + 1
+                return
+            while self._writer is not None or self._waiting_writers:
+                self._cond.wait()
+            readers[me] = 1
+
+    def release_read(self):
+        me = threading.get_ident()
+        with self._cond:
+            readers = self._readers
+            count = readers[me] - 1
+            if count:
+                readers[me] = count
+                return
+            del readers[me]
+            # wake up writers, including one upgrading from read lock
+            self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writes += 1
+                return
+            readers = self._readers
+            upgrade = me in readers
+            if upgrade:
+                if self._upgrading is not None:
+                    raise RuntimeError(
+                        'Concurrent upgrade from read to write lock'
+                    )
+                self._upgrading = me
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None \
+                        or len(readers) > int(upgrade):
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+                if upgrade:
+                    self._upgrading = None
+            self._writer = me
+            self._writes = 1
+
+    def release_write(self):
+        with self._cond:
+            if self._writer != threading.get_ident():
+                raise RuntimeError('Write lock not held by current thread')
+            self._writes -= 1
+            if not self._writes:
+                self._writer = None
+                self._cond.notify_all()
+
+
+_tree_lock_mutex = threading.Lock()
+
+
+def tree_rwlock(node):
+    """Return ``ReadWriteLock`` of the tree ``node`` belongs to."""
+    root = node.root
+    lock = getattr(root, '_tree_rwlock', None)
+    if lock is None:
+        with _tree_lock_mutex:
+            lock = getattr(root, '_tree_rwlock', None)
+            if lock is None:
+                lock = root._tree_rwlock = ReadWriteLock()
+    return lock
+
+
+def readlocktree(fn):
+    """Decorator for holding the read lock of the tree while calling a
+    method.
+    """
+    def _readlocktree_decorator(self, *args, **kwargs):
+        with tree_rwlock(self).read():
+            return fn(self, *args, **kwargs)
+    return _readlocktree_decorator
+
+
+def writelocktree(fn):
+    """Decorator for holding the write lock of the tree while calling a
+    method.
+    """
+    def _writelocktree_decorator(self, *args, **kwargs):
+        with tree_rwlock(self).write():
+            return fn(self, *args, **kwargs)
+    return _writelocktree_decorator
@@ -0,0 +1,460 @@
+from contextlib import contextmanager
+from node.behaviors import Attributes
+from node.behaviors import DefaultInit
+from node.behaviors import MappingAdopt
+from node.behaviors import MappingConstraints
+from node.behaviors import MappingNode
+from node.behaviors import MappingStorage
+from node.behaviors import OdictStorage
+from node.ext.ugm.file import FileAttributes
+from node.ext.ugm.file import FileData
+from node.ext.ugm.file import GroupAttributes
+from node.ext.ugm.file import GroupBehavior
+from node.ext.ugm.file import GroupsBehavior
+from node.ext.ugm.file import PrincipalAttributes
+from node.ext.ugm.file import RoleAttributes
+from node.ext.ugm.file import UgmBehavior
+from node.ext.ugm.file import UserAttributes
+from node.ext.ugm.file import UserBehavior
+from node.ext.ugm.file import UsersBehavior
+from node.ext.ugm.locking import tree_rwlock
+from node.interfaces import IInvalidate
+from node.utils import UNSET
+from plumber import Behavior
+from plumber import default
+from plumber import override
+from plumber import plumb
+from plumber import plumbing
+from zope.interface import implementer
+import sqlite3
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    key TEXT PRIMARY KEY,
+    value BLOB
+);
+CREATE TABLE IF NOT EXISTS groups (
+    key TEXT PRIMARY KEY,
+    value BLOB
+);
+CREATE TABLE IF NOT EXISTS roles (
+    key TEXT PRIMARY KEY,
+    value BLOB
+);
+CREATE TABLE IF NOT EXISTS logins (
+    key TEXT PRIMARY KEY,
+    value BLOB
+);
+CREATE TABLE IF NOT EXISTS attributes (
+    owner TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB,
+    PRIMARY KEY (owner, key)
+);
+"""
+
+
+@implementer(IInvalidate)
+class SqliteStorage(Behavior):
+    """Storage behavior handling key/value pairs in a SQLite table.
+
+    Drop-in replacement for ``node.ext.ugm.file.FileStorage``. Rows of
+    ``sql_table`` are loaded on first access, changed keys get written on
+    ``write_file``. If ``sql_owner`` is set, only rows with this owner are
+    handled, which is used for principal attributes.
+
+    The connection is looked up on the root node, which is expected to be a
+    ``node.ext.ugm.sqlite.Ugm``. Statements are executed inside the
+    transaction of the root node, which gets committed once the outermost
+    flush is done.
+    """
+    child_constraints = override(None)
+    sql_table = default(None)
+    sql_owner = default(None)
+
+    @override
+    def __init__(self, name=None, parent=None, sql_owner=None):
+        self.__name__ = name
+        self.__parent__ = parent
+        self.sql_owner = sql_owner
+        self._storage_data = None
+
+    @override
+    @property
+    def storage(self):
+        if self._storage_data is None:
+            self._storage_data = FileData()
+            self.read_file()
+        return self._storage_data
+
+    @override
+    @property
+    def dirty(self):
+        data = self._storage_data
+        return data is not None and bool(data.changed)
+
+    @override
+    @property
+    def exists(self):
+        query = 'SELECT 1 FROM {}{} LIMIT 1'.format(
+            self.sql_table,
+            self._sql_where
+        )
+        return self._sql_execute(query).fetchone() is not None
+
+    @override
+    def lookup(self, key):
+        """Return value for key. Raise ``KeyError`` if key not exists.
+
+        Selects the single row if storage data has not been read yet.
+        """
+        data = self._storage_data
+        if data is not None:
+            return data[key]
+        query = 'SELECT value FROM {} WHERE key = ?{}'.format(
+            self.sql_table,
+            '' if self.sql_owner is None else ' AND owner = ?'
+        )
+        row = self._sql_execute(query, (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    @override
+    def read_file(self):
+        data = self._storage_data
+        query = 'SELECT key, value FROM {}{} ORDER BY rowid'.format(
+            self.sql_table,
+            self._sql_where
+        )
+        for key, value in self._sql_execute(query):
+            data[key] = value
+        data.changed.clear()
+
+    @override
+    def write_file(self):
+        """Write changed keys to database. Return flag whether statements
+        have been executed.
+
+        Written keys are no longer considered changed. If the transaction
+        gets rolled back, they are considered changed again.
+        """
+        data = self._storage_data
+        if data is None or not data.changed:
+            return False
+        for key in data.changed:
+            self._sql_write(key)
+        self.root._written_changes.append((self, data, set(data.changed)))
+        data.changed.clear()
+        return True
+
+    @override
+    def write_key(self, key):
+        """Write the value of ``key`` to database without writing other
+        unwritten changes. The transaction of the root node gets committed.
+        """
+        data = self.storage
+        with self.root.transaction():
+            self._sql_write(key)
+            self.root._written_changes.append((self, data, set([key])))
+            data.changed.discard(key)
+
+    @override
+    def keys(self):
+        # Make pypy happy by overriding ``keys``
+        return self.storage.keys()
+
+    @override
+    def invalidate(self, key=None):
+        self._storage_data = None
+
+    @override
+    def __call__(self):
+        return int(self.write_file())
+
+    @override
+    @property
+    def _sql_where(self):
+        if self.sql_owner is None:
+            return ''
+        return ' WHERE owner = ?'
+
+    @override
+    def _sql_write(self, key):
+        # insert, update or delete row of key
+        data = self._storage_data
+        table = self.sql_table
+        owner = self.sql_owner
+        if key not in data:
+            self._sql_execute(
+                'DELETE FROM {} WHERE key = ?{}'.format(
+                    table,
+                    '' if owner is None else ' AND owner = ?'
+                ),
+                (key,)
+            )
+            return
+        value = data[key]
+        if value is None or value is UNSET:
+            value = u''
+        if owner is None:
+            self._sql_execute(
+                'INSERT INTO {} (key, value) VALUES (?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET value = '
+                'excluded.value'.format(table),
+                (key, value)
+            )
+        else:
+            self._sql_execute(
+                'INSERT INTO {} (owner, key, value) VALUES (?, ?, ?) '
+                'ON CONFLICT(owner, key) DO UPDATE SET value = '
+                'excluded.value'.format(table),
+                (owner, key, value)
+            )
+
+    @override
+    def _sql_execute(self, query, params=()):
+        # owner gets appended to parameters of statements filtering by owner
+        if self.sql_owner is not None and 'owner = ?' in query:
+            params = tuple(params) + (self.sql_owner,)
+        return self.root.connection.execute(query, params)
+
+
+class SqliteTransaction(Behavior):
+    """Run ``__call__`` inside the transaction of the root node."""
+
+    @plumb
+    def __call__(_next, self, *args, **kw):
+        with self.root.transaction():
+            return _next(self, *args, **kw)
+
+
+@plumbing(SqliteTransaction, SqliteStorage)
+class SqliteAttributes(FileAttributes):
+    pass
+
+
+@plumbing(SqliteTransaction, SqliteStorage)
+class SqliteRoleAttributes(RoleAttributes):
+    sql_table = 'roles'
+
+
+@plumbing(SqliteTransaction, SqliteStorage)
+class SqliteUserAttributes(UserAttributes):
+    sql_table = 'attributes'
+
+
+@plumbing(SqliteTransaction, SqliteStorage)
+class SqliteGroupAttributes(GroupAttributes):
+    sql_table = 'attributes'
+
+
+@plumbing(
+    SqliteTransaction,
+    UserBehavior,
+    MappingConstraints,
+    Attributes,
+    MappingNode)
+class User(object):
+
+    def attributes_factory(self, name=None, parent=None):
+        owner = 'users/{}'.format(parent.name)
+        return SqliteUserAttributes(name, parent, owner)
+
+
+@plumbing(
+    SqliteTransaction,
+    GroupBehavior,
+    MappingConstraints,
+    Attributes,
+    MappingNode)
+class Group(object):
+
+    def attributes_factory(self, name=None, parent=None):
+        owner = 'groups/{}'.format(parent.name)
+        return SqliteGroupAttributes(name, parent, owner)
+
+
+@plumbing(
+    SqliteTransaction,
+    UsersBehavior,
+    MappingConstraints,
+    MappingAdopt,
+    Attributes,
+    MappingNode,
+    SqliteStorage,
+    MappingStorage)
+class Users(object):
+    principal_factory = User
+    sql_table = 'users'
+
+    def login_index_factory(self):
+        index = SqliteAttributes('__logins__', self)
+        index.sql_table = 'logins'
+        return index
+
+    def _remove_principal_data(self, id):
+        self.root.connection.execute(
+            'DELETE FROM attributes WHERE owner = ?',
+            ('users/{}'.format(id),)
+        )
+
+
+@plumbing(
+    SqliteTransaction,
+    GroupsBehavior,
+    MappingConstraints,
+    MappingAdopt,
+    Attributes,
+    MappingNode,
+    SqliteStorage,
+    MappingStorage)
+class Groups(object):
+    principal_factory = Group
+    sql_table = 'groups'
+
+    def _remove_principal_data(self, id):
+        self.root.connection.execute(
+            'DELETE FROM attributes WHERE owner = ?',
+            ('groups/{}'.format(id),)
+        )
+
+
+@plumbing(
+    SqliteTransaction,
+    UgmBehavior,
+    MappingConstraints,
+    MappingAdopt,
+    Attributes,
+    DefaultInit,
+    MappingNode,
+    OdictStorage)
+class Ugm(object):
+    """User and group management storing users, groups, memberships, roles
+    and principal attributes in a SQLite database.
+
+    Provides the same API as ``node.ext.ugm.file.Ugm``. Changes are persisted
+    in a single transaction when calling the ugm or one of its contained
+    nodes.
+    """
+    users_factory = Users
+    groups_factory = Groups
+
+    def __init__(self,
+                 name=None,
+                 parent=None,
+                 db_path=None,
+                 user_expires_attr=None,
+                 user_index_attrs=(),
+                 group_index_attrs=(),
+                 cache_size=None,
+                 password_hasher=None,
+                 auth_cache_ttl=None,
+                 auth_cache_size=1000):
+        self.__name__ = name
+        self.__parent__ = parent
+        self.db_path = db_path
+        self.users_file = None
+        self.groups_file = None
+        self.roles_file = None
+        self.data_directory = None
+        self.user_expires_attr = user_expires_attr
+        self.journal = False
+        self.mapped_read = False
+        self.revalidate_interval = None
+        self.locking = False
+        self.lock_timeout = None
+        self._directory_lock = None
+        self.user_index_attrs = user_index_attrs
+        self.group_index_attrs = group_index_attrs
+        self.cache_size = cache_size
+        self.password_hasher = password_hasher
+        self.auth_cache_ttl = auth_cache_ttl
+        self.auth_cache_size = auth_cache_size
+        self._connection = None
+        self._transaction_depth = 0
+        self._written_changes = list()
+
+    def attributes_factory(self, name=None, parent=None):
+        return SqliteRoleAttributes(name, parent)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.storage.clear()
+            return
+        del self.storage[key]
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            connection = sqlite3.connect(
+                self.db_path,
+                check_same_thread=False
+            )
+            connection.executescript(SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    @contextmanager
+    def transaction(self):
+        """Context manager for a database transaction. Nested usage joins the
+        outer transaction, which gets committed if no error occurs and rolled
+        back otherwise. On rollback, keys written during the transaction are
+        marked as changed again, thus a later flush writes them.
+        """
+        with tree_rwlock(self).write():
+            self._transaction_depth += 1
+            try:
+                yield self.connection
+            except BaseException:
+                self._transaction_depth -= 1
+                if not self._transaction_depth:
+                    self.connection.rollback()
+                    self._restore_changes()
+                raise
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                self.connection.commit()
+                self._written_changes = list()
+
+    def _restore_changes(self):
+        # Mark keys written in rolled back transaction as changed again and
+        # register principals with changes to be written on next flush
+        for storage, data, keys in self._written_changes:
+            data.changed.update(keys)
+            if isinstance(storage, PrincipalAttributes):
+                principal, principals = storage._principal_and_container()
+                if principals is not None:
+                    principals._principal_changed(principal)
+        self._written_changes = list()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def migrate(source, target):
+    """Copy users, groups, memberships, roles and principal attributes from
+    ``source`` to ``target`` UGM and persist ``target``.
+
+    Used to migrate an existing ``node.ext.ugm.file.Ugm`` data directory to a
+    ``node.ext.ugm.sqlite.Ugm`` database.
+    """
+    source_groups = source.groups
+    source_groups._write_members()
+    for src, dst in [
+        (source.users, target.users),
+        (source_groups, target.groups)
+    ]:
+        for id, value in src.storage.items():
+            dst.storage[id] = value
+            dst_attrs = dst[id].attrs
+            for key, value in src[id].attrs.storage.items():
+                dst_attrs[key] = value
+    target_roles = target.attrs.storage
+    for id, value in source.attrs.storage.items():
+        target_roles[id] = value
+    target()
+    target.invalidate()
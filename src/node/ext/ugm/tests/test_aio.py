@@ -0,0 +1,120 @@
+from node.ext.ugm.aio import AsyncUgm
+from node.ext.ugm.file import Ugm
+from node.tests import NodeTestCase
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+
+
+class TestAio(NodeTestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _create_ugm(self, **kw):
+        datadir = os.path.join(self.tempdir, 'data')
+        if not os.path.exists(datadir):
+            os.mkdir(datadir)
+        return Ugm(
+            name='ugm',
+            users_file=os.path.join(self.tempdir, 'users'),
+            groups_file=os.path.join(self.tempdir, 'groups'),
+            roles_file=os.path.join(self.tempdir, 'roles'),
+            data_directory=datadir,
+            **kw
+        )
+
+    def test_async_ugm(self):
+        async def run():
+            async with AsyncUgm(self._create_ugm()) as ugm:
+                users = ugm.users
+                groups = ugm.groups
+                user = await users.create('max', mail=u'max@example.com')
+                self.assertEqual(user.name, 'max')
+                await users.create('sepp', login=u'sepp@example.com')
+                await groups.create('group1')
+                await ugm.add_role('manager', user)
+                self.assertEqual(await ugm.flush(), 7)
+                await users.passwd('max', None, 'secret')
+                await users.passwd('sepp', None, 'secret')
+
+                self.assertTrue(await users.authenticate('max', 'secret'))
+                self.assertFalse(await users.authenticate('max', 'wrong'))
+                self.assertEqual(
+                    await users.id_for_login('sepp@example.com'),
+                    'sepp'
+                )
+                self.assertTrue(await users.contains('max'))
+                self.assertEqual(await users.get('inexistent'), None)
+                self.assertEqual(sorted(await users.keys()), ['max', 'sepp'])
+                self.assertEqual(await ugm.roles(user), ['manager'])
+                await ugm.remove_role('manager', user)
+                self.assertEqual(await ugm.roles(user), [])
+
+                self.assertEqual(
+                    await users.search(criteria={'mail': 'max@example.com'}),
+                    ['max']
+                )
+                ids = [
+                    id async for id in users.search_iter(
+                        batch_size=1,
+                        criteria={'id': '*'}
+                    )
+                ]
+                self.assertEqual(sorted(ids), ['max', 'sepp'])
+
+                await users.set_attrs('max', {'fullname': u'Max'})
+                await users.delete_attrs('max', 'mail')
+                self.assertEqual(
+                    await users.attrs('max'),
+                    {'fullname': 'Max'}
+                )
+                # attributes of max and removed role
+                self.assertEqual(await ugm.flush(), 2)
+
+                await groups.add_member('group1', 'max')
+                await groups.add_member('group1', 'sepp')
+                await groups.remove_member('group1', 'sepp')
+                self.assertEqual(await groups.member_ids('group1'), ['max'])
+                self.assertEqual(await groups.flush(), 1)
+                await users.delete('sepp')
+                await groups.delete('group1')
+                await ugm.flush()
+
+        asyncio.run(run())
+        ugm = self._create_ugm()
+        self.assertEqual(list(ugm.users.keys()), ['max'])
+        self.assertEqual(ugm.users['max'].attrs['fullname'], 'Max')
+        self.assertEqual(list(ugm.groups.keys()), [])
+
+    def test_executor(self):
+        threads = set()
+        main = threading.current_thread()
+
+        async def run(ugm):
+            await ugm.users.create('max')
+
+            def flush():
+                threads.add(threading.current_thread())
+                return ugm.ugm()
+
+            # Flushes in executor threads get serialized by the tree lock
+            results = await asyncio.gather(*[
+                ugm.run(flush) for _ in range(3)
+            ])
+            self.assertEqual(sorted(results), [0, 0, 5])
+            self.assertEqual(
+                await asyncio.gather(ugm.flush(), ugm.flush()),
+                [0, 0]
+            )
+
+        ugm = AsyncUgm(self._create_ugm(), max_workers=2)
+        asyncio.run(run(ugm))
+        ugm.close()
+        self.assertFalse(main in threads)
+        self.assertTrue(len(threads) <= 2)
@@ -6,14 +6,25 @@ from node.behaviors import DefaultInit
 from node.behaviors import MappingAdopt
 from node.behaviors import MappingConstraints
 from node.behaviors import MappingNode
+from node.ext.ugm.file import AttributeIndex
+from node.ext.ugm.file import AuthCache
+from node.ext.ugm.file import FileData
+from node.ext.ugm.file import FileOffsets
 from node.ext.ugm.file import FileStorage
+from node.ext.ugm.file import PrincipalCache
+from node.ext.ugm.file import PrincipalRecord
 from node.ext.ugm.file import Ugm
+from node.ext.ugm.hashing import PBKDF2Hasher
 from node.tests import NodeTestCase
 from node.utils import UNSET
 from plumber import plumbing
+import base64
+import hashlib
 import os
 import shutil
 import tempfile
+import threading
+import time
 
 
 ###############################################################################
@@ -57,7 +68,7 @@ class TestFile(NodeTestCase):
             lines = f.readlines()
         return lines
 
-    def _create_ugm(self):
+    def _create_ugm(self, **kw):
         # Create principal data directory
         datadir = os.path.join(self.tempdir, 'principal_data')
         if not os.path.exists(datadir):
@@ -68,7 +79,8 @@ class TestFile(NodeTestCase):
             users_file=os.path.join(self.tempdir, 'users'),
             groups_file=os.path.join(self.tempdir, 'groups'),
             roles_file=os.path.join(self.tempdir, 'roles'),
-            data_directory=datadir
+            data_directory=datadir,
+            **kw
         )
 
     def test_file_storage(self):
@@ -173,7 +185,7 @@ class TestFile(NodeTestCase):
         expected = '<Groups object \'groups\' at '
         self.assertTrue(str(ugm.groups).startswith(expected))
 
-        expected = '<FileAttributes object \'__attrs__\' at'
+        expected = '<RoleAttributes object \'__attrs__\' at'
         self.assertTrue(str(ugm.attrs).startswith(expected))
         self.assertTrue(str(ugm.roles_storage).startswith(expected))
         self.assertTrue(ugm.attrs is ugm.roles_storage)
@@ -859,7 +871,7 @@ class TestFile(NodeTestCase):
         # Recreate ugm object
         ugm = self._create_ugm()
 
-        # XXX: id_for_login actually just returns given login name
+        # Users without login attribute login with their id
         self.assertEqual(ugm.users.id_for_login('max'), 'max')
 
         with self.assertRaises(KeyError) as arc:
@@ -960,3 +972,2067 @@ class TestFile(NodeTestCase):
             os.listdir(os.path.join(ugm.data_directory, 'groups')),
             []
         )
+
+    def test_member_index(self):
+        ugm = self._create_ugm()
+        ugm.users.create('max')
+        ugm.users.create('sepp')
+        ugm.groups.create('group1')
+        ugm.groups.create('group2')
+        ugm.groups['group1'].add('max')
+        ugm.groups['group2'].add('max')
+        ugm.groups['group2'].add('sepp')
+        ugm()
+
+        # Index gets built from groups file
+        ugm = self._create_ugm()
+        groups = ugm.groups
+        self.assertEqual(groups._member_index, {
+            'max': {'group1', 'group2'},
+            'sepp': {'group2'}
+        })
+        self.assertEqual(ugm.users['max'].group_ids, ['group1', 'group2'])
+        self.assertEqual(ugm.users['sepp'].group_ids, ['group2'])
+
+        # Membership changes are reflected in index
+        groups['group1'].add('sepp')
+        self.assertEqual(ugm.users['sepp'].group_ids, ['group1', 'group2'])
+        del groups['group2']['max']
+        self.assertEqual(ugm.users['max'].group_ids, ['group1'])
+
+        # New groups have no members
+        groups.create('group3')
+        self.assertEqual(ugm.users['max'].group_ids, ['group1'])
+
+        # Group deletion is reflected in index
+        del groups['group1']
+        self.assertEqual(groups._member_index, {'sepp': {'group2'}})
+        self.assertEqual(ugm.users['max'].group_ids, [])
+        self.assertEqual(ugm.users['max'].groups, [])
+        self.assertEqual(ugm.users['sepp'].groups, [groups['group2']])
+
+        # User deletion is reflected in index
+        del ugm.users['sepp']
+        self.assertEqual(groups._member_index, {})
+
+        # Index gets rebuilt after invalidation
+        groups.invalidate()
+        self.assertEqual(groups._member_index, {
+            'max': {'group1', 'group2'},
+            'sepp': {'group2'}
+        })
+
+    def test_group_members(self):
+        ugm = self._create_ugm()
+        ugm.users.create('max')
+        ugm.users.create('sepp')
+        ugm.groups.create('group1')
+        ugm()
+
+        # Members are kept as parsed set on groups container
+        groups = ugm.groups
+        group = groups['group1']
+        self.assertEqual(group._members, set())
+        self.assertTrue(group._members is groups._group_members('group1'))
+
+        group.add('sepp')
+        group.add('max')
+        self.assertEqual(group._members, {'max', 'sepp'})
+        self.assertEqual(group.member_ids, ['max', 'sepp'])
+        self.assertEqual(list(group), ['max', 'sepp'])
+        self.assertEqual(groups._members_changed, {'group1'})
+
+        # Storage value gets rebuilt when groups file gets written
+        self.assertEqual(groups.storage['group1'], '')
+        ugm()
+        self.assertEqual(groups.storage['group1'], 'max,sepp')
+        self.assertEqual(groups._members_changed, set())
+        lines = self._read_file(groups.file_path)
+        self.assertEqual(lines, ['group1:max,sepp\n'])
+
+        del group['max']
+        self.assertEqual(group.member_ids, ['sepp'])
+        groups()
+        lines = self._read_file(groups.file_path)
+        self.assertEqual(lines, ['group1:sepp\n'])
+
+        # Unflushed changes get discarded on invalidation
+        group.add('max')
+        groups.invalidate()
+        self.assertEqual(group.member_ids, ['sepp'])
+        self.assertEqual(groups._members_changed, set())
+
+        # Parsed members of deleted groups get removed
+        del groups['group1']
+        self.assertEqual(groups._members_map, {})
+        with self.assertRaises(KeyError):
+            groups._group_members('group1')
+
+    def test_file_data(self):
+        data = FileData()
+        data['a'] = u'1'
+        data['b'] = u'2'
+        self.assertEqual(data.changed, {'a', 'b'})
+        data.changed.clear()
+
+        # Setting unchanged value is not considered a change
+        data['a'] = u'1'
+        self.assertEqual(data.changed, set())
+
+        data['a'] = u'3'
+        del data['b']
+        self.assertEqual(data.changed, {'a', 'b'})
+        data.changed.clear()
+
+        data.clear()
+        self.assertEqual(data.changed, {'a'})
+
+    def test_dirty_tracking(self):
+        ugm = self._create_ugm()
+        ugm.users.create('max', fullname=u'Max')
+        ugm.users.create('sepp', fullname=u'Sepp')
+        ugm.groups.create('group1', description=u'Group 1')
+        ugm.groups['group1'].add('max')
+        self.assertTrue(ugm.users.dirty)
+        self.assertTrue(ugm.users['max'].dirty)
+        self.assertTrue(ugm.groups['group1'].dirty)
+
+        # Users, groups, roles, logins and principal data files written
+        self.assertEqual(ugm(), 7)
+        self.assertFalse(ugm.users.dirty)
+        self.assertFalse(ugm.users['max'].dirty)
+        self.assertFalse(ugm.groups['group1'].dirty)
+
+        # Nothing changed, nothing written
+        self.assertEqual(ugm(), 0)
+
+        # Only modified principal data gets written
+        ugm.users['max'].attrs['fullname'] = u'Max Muster'
+        self.assertTrue(ugm.users['max'].dirty)
+        self.assertFalse(ugm.users['sepp'].dirty)
+        self.assertEqual(ugm(), 1)
+
+        # Setting unchanged values not causes a write
+        ugm.users['max'].attrs['fullname'] = u'Max Muster'
+        self.assertEqual(ugm(), 0)
+
+        # Only users file gets written on password change
+        mtime = os.stat(ugm.groups.file_path).st_mtime_ns
+        ugm.users.passwd('max', None, 'secret')
+        self.assertEqual(ugm(), 0)
+        self.assertEqual(os.stat(ugm.groups.file_path).st_mtime_ns, mtime)
+        self.assertTrue(ugm.users.authenticate('max', 'secret'))
+
+        # Membership change only writes groups file
+        ugm.groups['group1'].add('sepp')
+        self.assertTrue(ugm.groups['group1'].dirty)
+        self.assertEqual(ugm.groups(), 1)
+        self.assertEqual(
+            self._read_file(ugm.groups.file_path),
+            ['group1:max,sepp\n']
+        )
+
+        # Role change only writes roles file
+        ugm.users['max'].add_role('manager')
+        self.assertEqual(ugm.users['max'](), 1)
+        self.assertEqual(
+            self._read_file(ugm.roles_file),
+            ['max::manager\n']
+        )
+
+    def test_file_storage_journal(self):
+        file_path = os.path.join(self.tempdir, 'filestorage')
+        journal_path = file_path + '.journal'
+        fsn = FileStorageNode(file_path)
+        fsn.journal = True
+        fsn['foo'] = u'foo'
+        fsn['bar'] = u'bar'
+
+        # File gets written entirely if not exists yet
+        self.assertTrue(fsn.write_file())
+        self.assertEqual(
+            self._read_file(file_path),
+            ['foo:foo\n', 'bar:bar\n']
+        )
+        self.assertFalse(os.path.exists(journal_path))
+
+        # Changes are appended to journal
+        fsn['foo'] = u'changed'
+        self.assertTrue(fsn.write_file())
+        del fsn['bar']
+        fsn['binary'] = b'Hello'
+        fsn()
+        self.assertEqual(
+            self._read_file(file_path),
+            ['foo:foo\n', 'bar:bar\n']
+        )
+        self.assertEqual(self._read_file(journal_path)[0], '+foo:changed\n')
+        self.assertEqual(
+            sorted(self._read_file(journal_path)[1:]),
+            ['+binary:b64:SGVsbG8=\n', '-bar:\n']
+        )
+        self.assertEqual(fsn._journal_records, 3)
+
+        # Journal gets replayed on read
+        fsn = FileStorageNode(file_path)
+        fsn.journal = True
+        self.assertEqual(
+            list(fsn.items()),
+            [('foo', 'changed'), ('binary', b'Hello')]
+        )
+        self.assertFalse(fsn.dirty)
+        self.assertEqual(fsn._journal_records, 3)
+
+        # Compaction rewrites file and removes journal
+        fsn.compact()
+        self.assertEqual(
+            self._read_file(file_path),
+            ['foo:changed\n', 'binary:b64:SGVsbG8=\n']
+        )
+        self.assertFalse(os.path.exists(journal_path))
+        self.assertEqual(fsn._journal_records, 0)
+
+        # Compaction fails with unwritten changes
+        fsn['foo'] = u'foo'
+        with self.assertRaises(RuntimeError) as arc:
+            fsn.compact()
+        self.assertEqual(
+            str(arc.exception),
+            'Cannot compact file with unwritten changes'
+        )
+
+        # Compaction happens if threshold is reached
+        fsn.journal_threshold = 2
+        fsn()
+        self.assertTrue(os.path.exists(journal_path))
+        fsn['bar'] = u'bar'
+        fsn()
+        self.assertFalse(os.path.exists(journal_path))
+        self.assertEqual(
+            self._read_file(file_path),
+            ['foo:foo\n', 'binary:b64:SGVsbG8=\n', 'bar:bar\n']
+        )
+
+        # Background compaction. Records written while compacting go to new
+        # journal, moved records get replayed until compaction is done
+        fsn['baz'] = u'baz'
+        fsn()
+        compaction = fsn.compact(background=True)
+        fsn['foo'] = u'new'
+        fsn()
+        compaction.join()
+        self.assertEqual(self._read_file(journal_path), ['+foo:new\n'])
+        self.assertFalse(os.path.exists(journal_path + '.compacting'))
+        fsn = FileStorageNode(file_path)
+        fsn.journal = True
+        self.assertEqual(list(fsn.items()), [
+            ('foo', 'new'),
+            ('binary', b'Hello'),
+            ('bar', 'bar'),
+            ('baz', 'baz')
+        ])
+
+        # Leftover of interrupted compaction gets replayed
+        os.rename(journal_path, journal_path + '.compacting')
+        with open(journal_path, 'wb') as f:
+            f.write(b'-baz:\n')
+        fsn = FileStorageNode(file_path)
+        fsn.journal = True
+        self.assertEqual(list(fsn.keys()), ['foo', 'binary', 'bar'])
+        self.assertEqual(fsn['foo'], 'new')
+        fsn.compact()
+        self.assertFalse(os.path.exists(journal_path))
+        self.assertFalse(os.path.exists(journal_path + '.compacting'))
+        fsn = FileStorageNode(file_path)
+        self.assertEqual(list(fsn.keys()), ['foo', 'binary', 'bar'])
+
+    def test_ugm_journal(self):
+        ugm = self._create_ugm(journal=True)
+        self.assertTrue(ugm.users.journal)
+        self.assertTrue(ugm.groups.journal)
+        self.assertTrue(ugm.attrs.journal)
+        ugm.users.create('max')
+        ugm.users.create('sepp')
+        ugm()
+
+        ugm.users.passwd('sepp', None, 'secret')
+        self.assertEqual(self._read_file(ugm.users.file_path), [
+            'max:\n',
+            'sepp:\n'
+        ])
+        self.checkOutput("""\
+        ['+sepp:...\\n']
+        """, str(self._read_file(ugm.users.journal_path)))
+
+        ugm.invalidate()
+        self.assertTrue(ugm.users.authenticate('sepp', 'secret'))
+
+    def test_search_index(self):
+        ugm = self._create_ugm(
+            user_index_attrs=('login', 'mail', 'fullname'),
+            group_index_attrs=('description',)
+        )
+        users = ugm.users
+        users.create('max', login=u'max', mail=u'max@example.com',
+                     fullname=u'Max Muster')
+        users.create('sepp', login=u'sepp', mail=u'sepp@example.com',
+                     fullname=u'Sepp Muster', phone=u'123')
+        users.create('moritz', mail=u'moritz@example.com', fullname=u'')
+        ugm.groups.create('group1', description=u'Group')
+        ugm.groups.create('group2', description=u'Group')
+        ugm()
+
+        # Index gets built from principal attributes
+        ugm = self._create_ugm(
+            user_index_attrs=('login', 'mail', 'fullname'),
+            group_index_attrs=('description',)
+        )
+        users = ugm.users
+        index = users._search_index
+        self.assertEqual(
+            sorted(index.keys()),
+            ['fullname', 'id', 'login', 'mail']
+        )
+        self.assertEqual(index['login'].values, {
+            'max': {'max'},
+            'sepp': {'sepp'}
+        })
+        # Empty values are not indexed
+        self.assertEqual(index['fullname'].values, {
+            'Max Muster': {'max'},
+            'Sepp Muster': {'sepp'}
+        })
+
+        # Exact matches are answered from index
+        lookup = users._index_lookup
+        self.assertEqual(
+            lookup({'mail': 'sepp@example.com'}, False),
+            ({'sepp'}, {})
+        )
+        self.assertEqual(
+            lookup({'mail': 'sepp@example.com', 'id': 'max'}, False),
+            (set(), {})
+        )
+        self.assertEqual(
+            lookup({'mail': 'sepp@example.com', 'id': 'max'}, True),
+            ({'max', 'sepp'}, {})
+        )
+        # Not indexed criteria are checked on candidates
+        self.assertEqual(
+            lookup({'login': 'sepp', 'phone': '123'}, False),
+            ({'sepp'}, {'phone': '123'})
+        )
+        self.assertEqual(
+            lookup({'login': 'sepp', 'fullname': '*Muster'}, False),
+            ({'sepp'}, {})
+        )
+        # Or search with not indexed criteria needs full scan
+        self.assertEqual(
+            lookup({'login': 'sepp', 'phone': '123'}, True),
+            (None, {'login': 'sepp', 'phone': '123'})
+        )
+
+        self.assertEqual(users.search(criteria={'login': 'max'}), ['max'])
+        self.assertEqual(
+            sorted(users.search(
+                criteria={'login': 'max', 'mail': 'sepp@example.com'},
+                or_search=True
+            )),
+            ['max', 'sepp']
+        )
+        self.assertEqual(
+            users.search(criteria={'fullname': 'Sepp Muster', 'phone': '123'}),
+            ['sepp']
+        )
+        self.assertEqual(
+            users.search(criteria={'fullname': 'Max Muster', 'phone': '123'}),
+            []
+        )
+        self.assertEqual(
+            users.search(
+                criteria={'mail': 'moritz@example.com'},
+                attrlist=['fullname', 'mail']
+            ),
+            [('moritz', {'fullname': '', 'mail': 'moritz@example.com'})]
+        )
+        with self.assertRaises(ValueError) as arc:
+            users.search(
+                criteria={'fullname': 'Max Muster', 'login': 'sepp'},
+                or_search=True,
+                exact_match=True
+            )
+        self.assertEqual(
+            str(arc.exception),
+            'Exact match asked but result not unique'
+        )
+        self.assertEqual(
+            sorted(ugm.groups.search(criteria={'description': 'Group'})),
+            ['group1', 'group2']
+        )
+
+        # Index gets updated on attribute changes
+        users['moritz'].attrs['fullname'] = u'Moritz Muster'
+        self.assertEqual(
+            users.search(criteria={'fullname': 'Moritz Muster'}),
+            ['moritz']
+        )
+        users['max'].attrs['login'] = u'maximilian'
+        self.assertEqual(users.search(criteria={'login': 'max'}), [])
+        self.assertEqual(
+            users.search(criteria={'login': 'maximilian'}),
+            ['max']
+        )
+        del users['max'].attrs['login']
+        self.assertEqual(users.search(criteria={'login': 'maximilian'}), [])
+
+        # Index gets updated on principal creation and deletion
+        users.create('hans', login=u'hans')
+        self.assertEqual(users.search(criteria={'login': 'hans'}), ['hans'])
+        del users['hans']
+        self.assertEqual(users.search(criteria={'login': 'hans'}), [])
+        self.assertEqual(index['login'].values, {'sepp': {'sepp'}})
+
+        del ugm.groups['group1']
+        self.assertEqual(
+            ugm.groups.search(criteria={'description': 'Group'}),
+            ['group2']
+        )
+
+    def test_attribute_index(self):
+        index = AttributeIndex()
+        values = [
+            u'max', u'maxii', u'sepp', u'123sepp', u'Max Muster',
+            u'Sepp Muster', u'muster', u'a', u'ab', u'abc', u'\xe4\xf6\xfc'
+        ]
+        for i, value in enumerate(values):
+            index.add('p{}'.format(i), value)
+        index.add('p11', u'max')
+        index.add('p12', u'')
+        index.add('p13', b'binary')
+
+        self.assertEqual(index.lookup(u'max'), {'p0', 'p11'})
+        self.assertEqual(index.lookup(u''), set())
+        self.assertEqual(index.lookup(u'inexistent'), set())
+
+        # Wildcard matches are identical to ``_compare_value``
+        ugm = self._create_ugm()
+        compare = ugm.users._compare_value
+        terms = [
+            '*', '**', 'max', 'max*', '*max', '*max*', 'Max*', '*ster',
+            '*uste*', '*ep*', '*p*', 'a*', '*b', '*abc*', '*abcd*', 'sep*p',
+            '*a*b', 'm*x*', u'\xe4*', u'*\xfc', u'*\xf6*', 'inexistent*',
+            '*inexistent', '*inexistent*', 'z*'
+        ]
+
+        def expected(term):
+            return set([
+                'p{}'.format(i) for i, value in enumerate(values)
+                if compare(term, value)
+            ] + (['p11'] if compare(term, u'max') else [])
+              + (['p13'] if term == '*' else []))
+
+        for term in terms:
+            self.assertEqual(
+                index.match(term, compare),
+                expected(term),
+                'Term {} not matches'.format(term)
+            )
+
+        # Structures are kept up to date once built
+        index.add('p20', u'maximilian')
+        index.remove('p4', u'Max Muster')
+        index.remove('p6', u'muster')
+        index.remove('p6', u'inexistent')
+        self.assertEqual(
+            index.match('max*', compare),
+            {'p0', 'p1', 'p11', 'p20'}
+        )
+        self.assertEqual(index.match('*ster', compare), {'p5'})
+        self.assertEqual(index.match('*ust*', compare), {'p5'})
+        self.assertEqual(index.match('*ilia*', compare), {'p20'})
+        index.remove('p20', u'maximilian')
+        self.assertEqual(index.match('*ilia*', compare), set())
+        self.assertEqual(index._sorted, sorted(index._sorted))
+        self.assertFalse(u'maximilian' in index._sorted)
+        self.assertFalse(u'nailimixam' in index._reversed)
+        self.assertFalse(u'ili' in index._ngrams)
+
+    def test_search_index_wildcards(self):
+        ugm = self._create_ugm(user_index_attrs=('fullname',))
+        users = ugm.users
+        users.create('max', fullname=u'Max Muster')
+        users.create('sepp', fullname=u'Sepp Muster')
+        users.create('maxii')
+        users.create('123sepp')
+        ugm()
+
+        # Wildcard criteria on indexed attributes and id are answered from
+        # index
+        lookup = users._index_lookup
+        self.assertEqual(
+            lookup({'id': 'max*'}, False),
+            ({'max', 'maxii'}, {})
+        )
+        self.assertEqual(
+            lookup({'id': '*sep*', 'fullname': '*Muster'}, False),
+            ({'sepp'}, {})
+        )
+        self.assertEqual(
+            lookup({'id': '*sep*', 'fullname': '*Muster'}, True),
+            ({'max', 'sepp', '123sepp'}, {})
+        )
+        self.assertEqual(
+            lookup({'id': '*'}, False),
+            ({'max', 'sepp', 'maxii', '123sepp'}, {})
+        )
+        self.assertEqual(
+            sorted(users.search(criteria=dict(fullname='*Muster*', id='max*'),
+                                or_search=True)),
+            ['max', 'maxii', 'sepp']
+        )
+        self.assertEqual(
+            users.search(criteria=dict(fullname='*Muster*', id='max*')),
+            ['max']
+        )
+
+        # Id index is kept up to date
+        users.create('maximilian')
+        self.assertEqual(
+            sorted(users.search(criteria=dict(id='max*'))),
+            ['max', 'maxii', 'maximilian']
+        )
+        del users['maxii']
+        self.assertEqual(
+            sorted(users.search(criteria=dict(id='max*'))),
+            ['max', 'maximilian']
+        )
+
+        # Only one wildcard gets stripped from each side of the term, like
+        # unindexed search does
+        users.create('mo', fullname=u'*Mo*')
+        for term in ['**Mo', 'Mo**', '***Mo**', '**M*', '*Mo*']:
+            self.assertEqual(
+                lookup({'fullname': term}, False)[0],
+                set([
+                    id for id in users.storage
+                    if users._compare_value(
+                        term,
+                        users.record(id).get('fullname', '')
+                    )
+                ])
+            )
+        self.assertEqual(lookup({'fullname': '**Mo*'}, False), ({'mo'}, {}))
+
+    def test_id_for_login(self):
+        ugm = self._create_ugm()
+        users = ugm.users
+        users.create('max', login=u'max@example.com')
+        users.create('sepp')
+        ugm()
+
+        # Login index gets persisted in data directory
+        logins_path = os.path.join(ugm.data_directory, 'logins')
+        self.assertEqual(
+            self._read_file(logins_path),
+            ['max@example.com:max\n']
+        )
+
+        ugm = self._create_ugm()
+        users = ugm.users
+        self.assertEqual(users.id_for_login('max@example.com'), 'max')
+        # Users without login attribute login with their id
+        self.assertEqual(users.id_for_login('sepp'), 'sepp')
+        self.assertEqual(users.id_for_login('inexistent'), 'inexistent')
+
+        # Login must be unique
+        with self.assertRaises(ValueError) as arc:
+            users['sepp'].attrs['login'] = u'max@example.com'
+        self.assertEqual(
+            str(arc.exception),
+            'Login \'max@example.com\' is already used by user \'max\''
+        )
+        self.assertEqual(users['sepp'].attrs.get('login'), None)
+        with self.assertRaises(ValueError) as arc:
+            users['max'].attrs['login'] = u'sepp'
+        self.assertEqual(
+            str(arc.exception),
+            'Login \'sepp\' is already used by user \'sepp\''
+        )
+        with self.assertRaises(ValueError) as arc:
+            users.create('max@example.com')
+        self.assertEqual(
+            str(arc.exception),
+            'Login \'max@example.com\' is already used by user \'max\''
+        )
+        with self.assertRaises(ValueError) as arc:
+            users.create('hans', login=u'max@example.com')
+        self.assertFalse('hans' in users.storage)
+
+        # Nothing of a failing create gets indexed or written
+        other = self._create_ugm(user_index_attrs=('fullname',))
+        self.assertEqual(other.users.search(criteria={'fullname': 'Bee'}), [])
+        with self.assertRaises(ValueError):
+            other.users.create(
+                'bee',
+                fullname=u'Bee',
+                login=u'max@example.com'
+            )
+        self.assertEqual(other.users.search(criteria={'fullname': 'Bee'}), [])
+        other()
+        self.assertFalse(
+            os.path.exists(os.path.join(ugm.data_directory, 'users', 'bee'))
+        )
+
+        # Setting own id or current login is fine
+        users['max'].attrs['login'] = u'max@example.com'
+        users['sepp'].attrs['login'] = u'sepp'
+        self.assertEqual(users.id_for_login('sepp'), 'sepp')
+
+        # Index gets updated on login change
+        users['max'].attrs['login'] = u'maximilian'
+        self.assertEqual(users.id_for_login('maximilian'), 'max')
+        self.assertEqual(
+            users.id_for_login('max@example.com'),
+            'max@example.com'
+        )
+        users.create('hans', login=u'max@example.com')
+        self.assertEqual(users.id_for_login('max@example.com'), 'hans')
+        del users['hans'].attrs['login']
+        self.assertEqual(
+            users.id_for_login('max@example.com'),
+            'max@example.com'
+        )
+        users['hans'].attrs['login'] = u'hans@example.com'
+
+        # Index gets updated on user deletion
+        del users['max']
+        self.assertEqual(users.id_for_login('maximilian'), 'maximilian')
+        ugm()
+        self.assertEqual(sorted(self._read_file(logins_path)), [
+            'hans@example.com:hans\n',
+            'sepp:sepp\n'
+        ])
+
+        # Index gets built from user attributes if file is missing
+        os.remove(logins_path)
+        ugm = self._create_ugm()
+        self.assertEqual(ugm.users.id_for_login('hans@example.com'), 'hans')
+        ugm()
+        self.assertEqual(sorted(self._read_file(logins_path)), [
+            'hans@example.com:hans\n',
+            'sepp:sepp\n'
+        ])
+
+        # Login of user deleted before index has been loaded gets removed
+        # from persisted index
+        ugm = self._create_ugm()
+        del ugm.users['hans']
+        ugm()
+        self.assertEqual(self._read_file(logins_path), ['sepp:sepp\n'])
+        ugm = self._create_ugm()
+        ugm.users.create('otto', login=u'hans@example.com')
+        self.assertEqual(ugm.users.id_for_login('hans@example.com'), 'otto')
+
+        # Data directory gets created if login index is written first
+        data_directory = os.path.join(self.tempdir, 'fresh')
+        ugm = Ugm(
+            name='ugm',
+            users_file=os.path.join(self.tempdir, 'fresh_users'),
+            groups_file=os.path.join(self.tempdir, 'fresh_groups'),
+            roles_file=os.path.join(self.tempdir, 'fresh_roles'),
+            data_directory=data_directory
+        )
+        ugm.users.create('u0')
+        ugm()
+        self.assertEqual(
+            self._read_file(os.path.join(data_directory, 'logins')),
+            []
+        )
+
+    def test_create_many(self):
+        ugm = self._create_ugm()
+        ugm.users.create('max')
+        ugm.groups.create('group1')
+        ugm.groups.create('group2')
+        ugm()
+
+        # Count file writes
+        writes = list()
+
+        def counting(storage):
+            write_file = storage.write_file
+
+            def wrapper():
+                writes.append(storage.file_path)
+                return write_file()
+            storage.write_file = wrapper
+
+        counting(ugm.users)
+        counting(ugm.groups)
+        counting(ugm.attrs)
+
+        def records():
+            yield ('sepp', {'fullname': u'Sepp'}, 'secret', ['group1'])
+            yield ('max', {}, None, [])
+            yield ('hans', {}, None, ['inexistent'])
+            yield ('', {}, None, [])
+            yield ('franz', {}, 123, [])
+            yield ('moritz',)
+            yield ('fritz', None, None, None)
+            yield ('karl', {'login': u'sepp'}, None, [])
+            yield ('willi', {'age': 42}, None, ['group1'])
+            yield ('otto', {'login': u'otto@example.com'}, u'otto',
+                   ['group1', 'group2'])
+
+        errors = ugm.users.create_many(records())
+        self.assertEqual(
+            [(id, str(e)) for id, e in errors],
+            [
+                ('max', "User with id 'max' already exists."),
+                ('hans', "'inexistent'"),
+                ('', "Invalid user id ''"),
+                ('franz', "Invalid password for user 'franz'"),
+                (None, 'not enough values to unpack (expected 4, got 1)'),
+                ('karl', "Login 'sepp' is already used by user 'sepp'"),
+                ('willi', "Invalid attribute 'age' of principal 'willi'"),
+            ]
+        )
+        self.assertEqual(sorted(writes), [
+            ugm.groups.file_path,
+            ugm.roles_file,
+            ugm.users.file_path
+        ])
+
+        # Failing records have no side effects
+        self.assertEqual(
+            sorted(ugm.users.keys()),
+            ['fritz', 'max', 'otto', 'sepp']
+        )
+        self.assertEqual(ugm.users.id_for_login('otto@example.com'), 'otto')
+
+        ugm = self._create_ugm()
+        self.assertTrue(ugm.users.authenticate('sepp', 'secret'))
+        self.assertTrue(ugm.users.authenticate('otto', 'otto'))
+        self.assertFalse(ugm.users.authenticate('fritz', ''))
+        self.assertEqual(ugm.users['sepp'].attrs['fullname'], 'Sepp')
+        self.assertEqual(ugm.users['sepp'].group_ids, ['group1'])
+        self.assertEqual(ugm.users['otto'].group_ids, ['group1', 'group2'])
+        self.assertEqual(
+            sorted(self._read_file(ugm.groups.file_path)),
+            ['group1:otto,sepp\n', 'group2:otto\n']
+        )
+
+        # Bulk group creation
+        errors = ugm.groups.create_many([
+            ('group3', {'description': u'Group 3'}, ['max', 'sepp']),
+            ('group1', {}, []),
+            ('group4', {}, ['inexistent']),
+            ('group5', None, None),
+            ('group6', {'size': 1}, []),
+            (None, {}, []),
+        ])
+        self.assertEqual(
+            [(id, str(e)) for id, e in errors],
+            [
+                ('group1', "Group with id 'group1' already exists."),
+                ('group4', "'inexistent'"),
+                ('group6', "Invalid attribute 'size' of principal 'group6'"),
+                (None, "Invalid group id 'None'"),
+            ]
+        )
+        ugm = self._create_ugm()
+        self.assertEqual(
+            sorted(ugm.groups.keys()),
+            ['group1', 'group2', 'group3', 'group5']
+        )
+        self.assertEqual(ugm.groups['group3'].member_ids, ['max', 'sepp'])
+        self.assertEqual(ugm.groups['group3'].attrs['description'], 'Group 3')
+
+    def test_file_offsets(self):
+        file_path = os.path.join(self.tempdir, 'data')
+        with open(file_path, 'wb') as f:
+            for i in range(100):
+                f.write('key{}:value{}\n'.format(i, i).encode())
+            f.write(b'malformed\n')
+            f.write(b'key1:duplicate\n')
+            f.write(b'\xc3\xa4:\xc3\xb6')
+
+        # Index gets built and persisted
+        offsets = FileOffsets(file_path, b':')
+        self.assertEqual(len(offsets._offsets), 101)
+        self.assertEqual(offsets['key0'], b'key0:value0')
+        self.assertEqual(offsets['key1'], b'key1:duplicate')
+        self.assertEqual(offsets[u'\xe4'], b'\xc3\xa4:\xc3\xb6')
+        self.expectError(KeyError, offsets.__getitem__, 'malformed')
+        offsets.close()
+        index_path = file_path + '.offsets'
+        self.assertTrue(os.path.exists(index_path))
+
+        # Persisted index gets searched
+        offsets = FileOffsets(file_path, b':')
+        self.assertEqual(offsets._offsets, None)
+        for i in range(100):
+            key = 'key{}'.format(i)
+            expected = b'key1:duplicate' if i == 1 \
+                else 'key{}:value{}'.format(i, i).encode()
+            self.assertEqual(offsets[key], expected)
+        self.assertEqual(offsets[u'\xe4'], b'\xc3\xa4:\xc3\xb6')
+        for key in ['', 'a', 'key', 'key100', 'z', 'malformed']:
+            self.expectError(KeyError, offsets.__getitem__, key)
+        offsets.close()
+
+        # Index gets rebuilt if file changed
+        with open(file_path, 'ab') as f:
+            f.write(b'\nkey100:value100\n')
+        offsets = FileOffsets(file_path, b':')
+        self.assertEqual(len(offsets._offsets), 102)
+        self.assertEqual(offsets['key100'], b'key100:value100')
+        offsets.close()
+
+        # Empty file
+        with open(file_path, 'wb') as f:
+            f.write(b'')
+        offsets = FileOffsets(file_path, b':')
+        self.expectError(KeyError, offsets.__getitem__, 'key0')
+        offsets.close()
+
+    def test_mapped_read(self):
+        ugm = self._create_ugm()
+        user = ugm.users.create('max', login=u'max@example.com')
+        ugm.users.create('sepp')
+        ugm.users.passwd('max', None, 'secret')
+        ugm.add_role('manager', user)
+        ugm()
+
+        # Single lookups do not read storage data
+        ugm = self._create_ugm(mapped_read=True)
+        users = ugm.users
+        self.assertTrue(users.authenticate('max', 'secret'))
+        self.assertFalse(users.authenticate('max', 'wrong'))
+        self.assertFalse(users.authenticate('sepp', ''))
+        self.assertFalse(users.authenticate('inexistent', 'secret'))
+        self.assertEqual(users['max'].name, 'max')
+        self.expectError(KeyError, users.__getitem__, 'inexistent')
+        self.assertEqual(users.id_for_login('max@example.com'), 'max')
+        self.assertEqual(users.id_for_login('sepp'), 'sepp')
+        # Mapped login index is kept
+        logins = users._login_index_mapped
+        offsets = logins._offsets
+        self.assertEqual(users.id_for_login('max@example.com'), 'max')
+        self.assertTrue(users._login_index_mapped is logins)
+        self.assertTrue(logins._offsets is offsets)
+        self.assertEqual(ugm.roles(users['max']), ['manager'])
+        self.assertEqual(ugm.roles(users['sepp']), [])
+        self.assertEqual(users._storage_data, None)
+        self.assertEqual(ugm.attrs._storage_data, None)
+        self.assertFalse(users._login_index_built)
+        offsets_path = users.file_path + '.offsets'
+        self.assertTrue(os.path.exists(offsets_path))
+
+        # Reading storage data closes offsets, writing removes offsets file
+        self.assertEqual(sorted(users.keys()), ['max', 'sepp'])
+        self.assertEqual(users._offsets, None)
+        users['sepp'].attrs['login'] = u'sepp@example.com'
+        ugm()
+        self.assertEqual(users._login_index_mapped, None)
+        self.assertEqual(logins._offsets, None)
+        ugm.users.passwd('sepp', None, 'secret')
+        self.assertFalse(os.path.exists(offsets_path))
+        ugm = self._create_ugm(mapped_read=True)
+        self.assertTrue(ugm.users.authenticate('sepp', 'secret'))
+
+        # Pending journal records are replayed
+        ugm = self._create_ugm(journal=True)
+        ugm.users.passwd('max', None, 'changed')
+        ugm = self._create_ugm(journal=True, mapped_read=True)
+        self.assertTrue(ugm.users.authenticate('max', 'changed'))
+        self.assertTrue(ugm.users._storage_data is not None)
+
+    def test_principal_records(self):
+        record = PrincipalRecord('max', [('fullname', u'Max'), ('mail', u'm')])
+        self.assertEqual(record.name, 'max')
+        self.assertTrue(record.attrs is record)
+        self.assertEqual(record['fullname'], 'Max')
+        self.assertEqual(record.get('inexistent'), None)
+        self.expectError(KeyError, record.__getitem__, 'inexistent')
+        self.assertEqual(list(record), ['fullname', 'mail'])
+        self.assertEqual(dict(record), {'fullname': 'Max', 'mail': 'm'})
+        self.assertEqual(repr(record), "<PrincipalRecord 'max'>")
+        self.assertFalse(hasattr(record, '__dict__'))
+        other = PrincipalRecord(
+            'sepp',
+            [('fullname', u'Sepp'), ('mail', u's')]
+        )
+        self.assertTrue(record._keys is other._keys)
+        self.assertNotEqual(record, other)
+        self.assertEqual(record, PrincipalRecord('max', record.items()))
+
+        ugm = self._create_ugm(user_index_attrs=('mail',))
+        ugm.users.create('max', fullname=u'Max', mail=u'max@example.com')
+        ugm.users.create('sepp', fullname=u'Sepp', mail=u'sepp@example.com')
+        ugm.groups.create('group1', description=u'Group 1')
+        ugm()
+
+        # Read paths do not create principal nodes
+        ugm = self._create_ugm(user_index_attrs=('mail',))
+        users = ugm.users
+        self.assertEqual(
+            users.search(criteria={'mail': 'max@example.com'}),
+            ['max']
+        )
+        self.assertEqual(
+            sorted(users.search(criteria={'fullname': '*'})),
+            ['max', 'sepp']
+        )
+        self.assertEqual(users.id_for_login('max'), 'max')
+        self.assertEqual(users._mem_storage, {})
+        self.assertEqual(sorted(users._records), ['max', 'sepp'])
+        self.assertEqual(users.record('max')['fullname'], 'Max')
+        self.expectError(KeyError, users.record, 'inexistent')
+        self.assertEqual(
+            ugm.groups.search(criteria={'description': 'Group*'}),
+            ['group1']
+        )
+        self.assertEqual(ugm.groups._mem_storage, {})
+
+        # Principal node reads from record until attributes change
+        user = users['max']
+        self.assertFalse('max' in users._records)
+        self.assertTrue(user.attrs._record is not None)
+        self.assertEqual(user.attrs['fullname'], 'Max')
+        self.assertEqual(sorted(user.attrs.keys()), ['fullname', 'mail'])
+        self.assertFalse(user.dirty)
+        user.attrs['fullname'] = u'Maximilian'
+        self.assertEqual(user.attrs._record, None)
+        self.assertTrue(user.dirty)
+        self.assertEqual(users.record('max')['fullname'], 'Maximilian')
+        self.assertEqual(
+            users.search(criteria={'fullname': 'Maxi*'}),
+            ['max']
+        )
+        ugm()
+        ugm = self._create_ugm()
+        self.assertEqual(
+            ugm.users.record('max')['fullname'],
+            'Maximilian'
+        )
+
+        # Records get dropped on invalidation
+        users = ugm.users
+        users.invalidate()
+        self.assertEqual(users._records, {})
+
+    def test_principal_cache(self):
+        cache = PrincipalCache()
+        for i in range(3):
+            cache[i] = object()
+        self.assertEqual(list(cache), [0, 1, 2])
+        cache.maxsize = 2
+        cache[0]
+        cache.trim()
+        self.assertEqual(list(cache), [2, 0])
+        self.assertEqual(cache.evictions, 1)
+        cache[3] = object()
+        self.assertEqual(list(cache), [0, 3])
+        self.assertEqual(cache.evictions, 2)
+        self.expectError(KeyError, cache.__getitem__, 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        ugm = self._create_ugm()
+        for id in ['max', 'sepp', 'hans']:
+            ugm.users.create(id, fullname=id.capitalize())
+        ugm()
+
+        ugm = self._create_ugm(cache_size=2)
+        users = ugm.users
+        self.assertEqual(users.cache_size, 2)
+        max = users['max']
+        users['sepp']
+        users['max']
+        users['hans']
+        self.assertEqual(list(users._mem_storage), ['max', 'hans'])
+        self.assertEqual(users.cache_stats, {
+            'size': 2,
+            'maxsize': 2,
+            'hits': 1,
+            'misses': 3,
+            'evictions': 1
+        })
+
+        # Reads of loaded principals are counted
+        self.assertEqual(users.record('hans')['fullname'], 'Hans')
+        self.assertEqual(users.cache_stats['hits'], 2)
+
+        # Evicted principals referenced elsewhere keep their identity, their
+        # changes get written
+        users['sepp']
+        users['hans']
+        self.assertEqual(list(users._mem_storage), ['sepp', 'hans'])
+        self.assertTrue(users['max'] is max)
+        users['sepp']
+        users['hans']
+        max.attrs['fullname'] = u'Maximilian'
+        hans = users['hans']
+        hans.attrs['fullname'] = u'Hansi'
+        users.cache_size = 1
+        self.assertEqual(list(users._mem_storage), ['hans'])
+        del max, hans
+        self.assertEqual(ugm(), 2)
+        self.assertEqual(ugm(), 0)
+        ugm = self._create_ugm()
+        self.assertEqual(ugm.users['max'].attrs['fullname'], 'Maximilian')
+        self.assertEqual(ugm.users['hans'].attrs['fullname'], 'Hansi')
+
+        # Concurrent readers reorder the cache
+        ugm = self._create_ugm(cache_size=2)
+        users = ugm.users
+        errors = []
+
+        def read():
+            try:
+                for _ in range(200):
+                    for id in ['max', 'sepp', 'hans']:
+                        self.assertEqual(users[id].name, id)
+                        users.record(id)
+            except Exception as e:  # pragma: no cover
+                errors.append(e)
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(users._mem_storage), 2)
+
+        # Records are bounded too
+        ugm = self._create_ugm(cache_size=2)
+        users = ugm.users
+        self.assertEqual(
+            sorted(users.search(criteria={'fullname': '*'})),
+            ['hans', 'max', 'sepp']
+        )
+        self.assertEqual(len(users._records), 2)
+        self.assertEqual(users._records.maxsize, 2)
+
+    def test_revalidate(self):
+        file_path = os.path.join(self.tempdir, 'filestorage')
+        writer = FileStorageNode(file_path)
+        writer['a'] = u'1'
+        writer()
+
+        reader = FileStorageNode(file_path)
+        reader.revalidate_interval = 3600
+        self.assertEqual(dict(reader), {'a': '1'})
+        writer['b'] = u'2'
+        writer()
+        # Not checked within interval
+        self.assertEqual(dict(reader), {'a': '1'})
+
+        # Changed file gets re-read
+        reader.revalidate_interval = 0
+        self.assertEqual(dict(reader), {'a': '1', 'b': '2'})
+        data = reader.storage
+        self.assertTrue(reader.storage is data)
+
+        # Unwritten local changes are kept
+        reader['c'] = u'3'
+        del reader['a']
+        writer['a'] = u'changed'
+        writer['d'] = u'4'
+        writer()
+        self.assertEqual(dict(reader), {'b': '2', 'd': '4', 'c': '3'})
+        self.assertEqual(reader.storage.changed, {'a', 'c'})
+        reader()
+        self.assertEqual(
+            sorted(self._read_file(file_path)),
+            ['b:2\n', 'c:3\n', 'd:4\n']
+        )
+        # Own writes do not cause re-read
+        data = reader.storage
+        self.assertTrue(reader.storage is data)
+
+        # Principals changed by another process
+        ugm = self._create_ugm(revalidate_interval=0)
+        ugm.users.create('max', login=u'max@example.com')
+        ugm.groups.create('group1')
+        ugm()
+        self.assertEqual(ugm.users.id_for_login('max@example.com'), 'max')
+
+        other = self._create_ugm()
+        other.users.create('sepp')
+        other.users.passwd('sepp', None, 'secret')
+        other.users['max'].attrs['login'] = u'maximilian'
+        other()
+
+        ugm.groups['group1'].add('max')
+        self.assertEqual(sorted(ugm.users.keys()), ['max', 'sepp'])
+        self.assertTrue(ugm.users.authenticate('sepp', 'secret'))
+        self.assertEqual(ugm.users.id_for_login('maximilian'), 'max')
+        self.assertEqual(ugm.users['max'].attrs['login'], 'maximilian')
+
+        # Unwritten membership changes survive re-read of groups file
+        other.groups['group1'].attrs['description'] = u'Group 1'
+        other.groups.create('group2')
+        other()
+        self.assertEqual(sorted(ugm.groups.keys()), ['group1', 'group2'])
+        self.assertEqual(ugm.groups['group1'].member_ids, ['max'])
+        ugm()
+        other = self._create_ugm()
+        self.assertEqual(other.groups['group1'].member_ids, ['max'])
+        self.assertEqual(
+            other.groups['group1'].attrs['description'],
+            'Group 1'
+        )
+
+        # Search index is kept if users file has been re-read, only added
+        # and removed users get reindexed. Attribute changes of loaded
+        # users get reindexed when their attribute file is re-read.
+        ugm = self._create_ugm(
+            revalidate_interval=0,
+            user_index_attrs=('fullname',)
+        )
+        users = ugm.users
+        users.create('hans', fullname=u'Hans')
+        ugm()
+        self.assertEqual(users.search(criteria={'fullname': 'Hans'}), ['hans'])
+        index = users._search_index
+        hans = users['hans']
+        other = self._create_ugm()
+        other.users.passwd('max', None, 'changed')
+        other.users.create('otto', fullname=u'Otto')
+        del other.users['sepp']
+        other.users['hans'].attrs['fullname'] = u'Johann'
+        other()
+        self.assertEqual(sorted(users.keys()), ['hans', 'max', 'otto'])
+        self.assertTrue(users._search_index is index)
+        self.assertEqual(users.search(criteria={'fullname': 'Otto'}), ['otto'])
+        self.assertEqual(users.search(criteria={'id': 'sepp*'}), [])
+        self.assertEqual(hans.attrs['fullname'], 'Johann')
+        self.assertEqual(
+            users.search(criteria={'fullname': 'Johann'}),
+            ['hans']
+        )
+        self.assertEqual(users.search(criteria={'fullname': 'Hans'}), [])
+
+        # File changed by another process is re-read after interval
+        ugm = self._create_ugm(revalidate_interval=0.05)
+        self.assertEqual(sorted(ugm.users.keys()), ['hans', 'max', 'otto'])
+        other = self._create_ugm()
+        other.users.create('moritz')
+        other()
+        time.sleep(0.1)
+        self.assertEqual(
+            sorted(ugm.users.keys()),
+            ['hans', 'max', 'moritz', 'otto']
+        )
+
+    def test_directory_locking(self):
+        ugm = self._create_ugm()
+        self.assertEqual(ugm.directory_lock, None)
+
+        ugm = self._create_ugm(locking=True, lock_timeout=0.05)
+        lock = ugm.directory_lock
+        self.assertEqual(
+            lock.path,
+            os.path.join(self.tempdir, 'principal_data', '.lock')
+        )
+        self.assertTrue(ugm.directory_lock is lock)
+        other = self._create_ugm(locking=True, lock_timeout=0.05)
+
+        # Concurrent writers do not overwrite changes of each other
+        ugm.users.create('max')
+        ugm.add_role('manager', ugm.users['max'])
+        ugm.groups.create('group1')
+        other.users.create('sepp')
+        other.add_role('editor', other.users['sepp'])
+        other.groups.create('group2')
+        ugm()
+        other()
+        ugm.users.create('moritz')
+        ugm()
+
+        ugm = self._create_ugm()
+        self.assertEqual(
+            sorted(ugm.users.keys()),
+            ['max', 'moritz', 'sepp']
+        )
+        self.assertEqual(sorted(ugm.groups.keys()), ['group1', 'group2'])
+        self.assertEqual(ugm.roles(ugm.users['max']), ['manager'])
+        self.assertEqual(ugm.roles(ugm.users['sepp']), ['editor'])
+
+        # Files are persisted with the exclusive lock held
+        self.assertTrue(lock.metrics['exclusive']['acquired'] > 0)
+        other.users.create('hans')
+        with lock.shared():
+            self.expectError(TimeoutError, other)
+        other()
+        metrics = other.directory_lock.metrics
+        self.assertEqual(metrics['exclusive']['timeouts'], 1)
+
+    def test_password_hasher(self):
+        # Legacy hashes created with default hasher
+        ugm = self._create_ugm()
+        ugm.users.create('max')
+        ugm.users.passwd('max', None, 'secret')
+        legacy = 'oBmrdHcA6OZEkkCLeXh71YAerbvhXz1qqwjrPsXmEtNzYWx0c2FsdA=='
+        ugm.users.storage['sepp'] = legacy
+        ugm()
+        pw_hash = ugm.users.storage['max']
+        self.assertTrue(pw_hash.startswith('$sha256$$'))
+        self.assertTrue(ugm.users.authenticate('max', 'secret'))
+        self.assertTrue(ugm.users.authenticate('sepp', 'secret'))
+        # Not rehashed if hasher not changed
+        self.assertEqual(ugm.users.storage['max'], pw_hash)
+        self.assertEqual(ugm.users.storage['sepp'], legacy)
+
+        # Rehash on login if hasher or cost changed
+        ugm = self._create_ugm(password_hasher=PBKDF2Hasher(iterations=1000))
+        self.assertFalse(ugm.users.authenticate('sepp', 'wrong'))
+        self.assertEqual(ugm.users.storage['sepp'], legacy)
+        self.assertTrue(ugm.users.authenticate('sepp', 'secret'))
+        self.assertTrue(ugm.users.authenticate('max', 'secret'))
+        with open(os.path.join(self.tempdir, 'users')) as f:
+            lines = sorted(f.readlines())
+        self.assertTrue(lines[0].startswith('max:$pbkdf2-sha256$i=1000$'))
+        self.assertTrue(lines[1].startswith('sepp:$pbkdf2-sha256$i=1000$'))
+
+        ugm = self._create_ugm(password_hasher=PBKDF2Hasher(iterations=2000))
+        self.assertTrue(ugm.users.authenticate('max', 'secret'))
+        self.assertTrue(
+            ugm.users.storage['max'].startswith('$pbkdf2-sha256$i=2000$')
+        )
+        ugm.users.passwd('sepp', 'secret', 'changed')
+        self.assertTrue(
+            ugm.users.storage['sepp'].startswith('$pbkdf2-sha256$i=2000$')
+        )
+
+        # Hashes of other hashers keep verifying
+        ugm = self._create_ugm()
+        self.assertTrue(ugm.users.authenticate('sepp', 'changed'))
+        self.assertTrue(ugm.users.storage['sepp'].startswith('$sha256$$'))
+
+        # Rehash on login only persists the password hash of the user
+        for journal in (False, True):
+            ugm = self._create_ugm(
+                journal=journal,
+                password_hasher=PBKDF2Hasher(iterations=3000 + journal)
+            )
+            users = ugm.users
+            users.create('hans', fullname=u'Hans')
+            users.storage['sepp'] = legacy
+            self.assertTrue(users.authenticate('max', 'secret'))
+            other = self._create_ugm(journal=journal)
+            self.assertEqual(sorted(other.users.keys()), ['max', 'sepp'])
+            self.assertTrue(
+                other.users.storage['max'].startswith(
+                    '$pbkdf2-sha256$i={}$'.format(3000 + journal)
+                )
+            )
+            self.assertTrue(other.users.authenticate('sepp', 'changed'))
+            # pending changes are written on flush
+            ugm()
+            other = self._create_ugm(journal=journal)
+            self.assertEqual(
+                sorted(other.users.keys()),
+                ['hans', 'max', 'sepp']
+            )
+            self.assertTrue(other.users.authenticate('sepp', 'secret'))
+            self.assertTrue(other.users.authenticate('max', 'secret'))
+            self.assertEqual(other.users['hans'].attrs['fullname'], 'Hans')
+            del other.users['hans']
+            other.users.passwd('sepp', None, 'changed')
+            other()
+
+        # Rehash on login keeps users written by other processes
+        ugm = self._create_ugm(
+            locking=True,
+            password_hasher=PBKDF2Hasher(iterations=4000)
+        )
+        users = ugm.users
+        self.assertEqual(sorted(users.keys()), ['max', 'sepp'])
+        other = self._create_ugm(locking=True)
+        other.users.create('otto')
+        other()
+        self.assertTrue(users.authenticate('max', 'secret'))
+        users.create('willi')
+        ugm()
+        other = self._create_ugm()
+        self.assertEqual(
+            sorted(other.users.keys()),
+            ['max', 'otto', 'sepp', 'willi']
+        )
+        self.assertTrue(
+            other.users.storage['max'].startswith('$pbkdf2-sha256$i=4000$')
+        )
+
+        # Legacy hashes with custom salt length and hash function
+        ugm = self._create_ugm(password_hasher=PBKDF2Hasher(iterations=1000))
+        users = ugm.users
+        users.salt_len = 4
+        users.hash_func = hashlib.sha512
+        users.storage['otto'] = base64.b64encode(
+            hashlib.sha512(b'secret' + b'salt').digest() + b'salt'
+        ).decode()
+        self.assertFalse(users.authenticate('otto', 'wrong'))
+        self.assertTrue(users.authenticate('otto', 'secret'))
+        self.assertTrue(
+            users.storage['otto'].startswith('$pbkdf2-sha256$i=1000$')
+        )
+
+    def test_auth_cache(self):
+        cache = AuthCache(60, maxsize=2)
+        self.assertFalse(cache.get('max', 'secret', 'hash'))
+        cache.add('max', 'secret', 'hash')
+        self.assertTrue(cache.get('max', 'secret', 'hash'))
+        self.assertFalse(cache.get('max', 'wrong', 'hash'))
+        # Password plain text is not kept
+        self.assertFalse('secret' in repr(cache._entries))
+        # Password hash changed
+        self.assertFalse(cache.get('max', 'secret', 'other'))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+        # Least recently used entries get evicted
+        cache.add('max', 'secret', 'hash')
+        cache.add('sepp', 'secret', 'hash')
+        cache.get('max', 'secret', 'hash')
+        cache.add('moritz', 'secret', 'hash')
+        self.assertEqual(len(cache), 2)
+        self.assertFalse(cache.get('sepp', 'secret', 'hash'))
+        self.assertTrue(cache.get('max', 'secret', 'hash'))
+
+        cache.invalidate('max')
+        self.assertFalse(cache.get('max', 'secret', 'hash'))
+        self.assertEqual(sorted(cache._ids), ['moritz'])
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache._ids, {})
+
+        # Entries do not live beyond ttl and expiration
+        cache.ttl = 0
+        cache.add('max', 'secret', 'hash')
+        self.assertFalse(cache.get('max', 'secret', 'hash'))
+        cache.ttl = 60
+        cache.add('max', 'secret', 'hash', expires=datetime.now())
+        self.assertFalse(cache.get('max', 'secret', 'hash'))
+        cache.add(
+            'max',
+            'secret',
+            'hash',
+            expires=datetime.now() + timedelta(hours=1)
+        )
+        self.assertTrue(cache.get('max', 'secret', 'hash'))
+
+    def test_authenticate_cached(self):
+        ugm = self._create_ugm()
+        self.assertEqual(ugm.users._auth_cache, None)
+
+        ugm = self._create_ugm(
+            user_expires_attr='expires',
+            auth_cache_ttl=60
+        )
+        users = ugm.users
+        users.create('max')
+        users.passwd('max', None, 'secret')
+        cache = users._auth_cache
+        self.assertTrue(users._auth_cache is cache)
+        self.assertEqual(cache.maxsize, 1000)
+
+        calls = []
+        chk_pw = users._chk_pw
+
+        def _chk_pw(plain, hashed):
+            calls.append(plain)
+            return chk_pw(plain, hashed)
+        users._chk_pw = _chk_pw
+
+        self.assertTrue(users.authenticate('max', 'secret'))
+        self.assertTrue(users.authenticate('max', 'secret'))
+        self.assertFalse(users.authenticate('max', 'wrong'))
+        self.assertFalse(users.authenticate('inexistent', 'secret'))
+        self.assertEqual(calls, ['secret', 'wrong'])
+
+        # Password change invalidates cache
+        users.passwd('max', 'secret', 'changed')
+        self.assertFalse(users.authenticate('max', 'secret'))
+        self.assertTrue(users.authenticate('max', 'changed'))
+        self.assertTrue(users.authenticate('max', 'changed'))
+        self.assertEqual(
+            calls,
+            ['secret', 'wrong', 'secret', 'secret', 'changed']
+        )
+
+        # Password changed by another instance
+        other = self._create_ugm()
+        other.users.passwd('max', None, 'other')
+        users.invalidate()
+        self.assertFalse(users.authenticate('max', 'changed'))
+        self.assertTrue(users.authenticate('max', 'other'))
+
+        # Expiration change invalidates cache
+        del calls[:]
+        user = users['max']
+        user.expires = datetime.now() - timedelta(hours=1)
+        self.assertFalse(users.authenticate('max', 'other'))
+        user.expires = None
+        self.assertTrue(users.authenticate('max', 'other'))
+        self.assertTrue(users.authenticate('max', 'other'))
+        self.assertEqual(calls, ['other'])
+
+        # No user nodes are created on authentication
+        sepp = users.create('sepp')
+        users.passwd('sepp', None, 'secret')
+        sepp.expires = datetime.now() - timedelta(hours=1)
+        del sepp
+        ugm()
+        other = self._create_ugm(
+            user_expires_attr='expires',
+            auth_cache_ttl=60
+        )
+        self.assertTrue(other.users.authenticate('max', 'other'))
+        self.assertFalse(other.users.authenticate('sepp', 'secret'))
+        self.assertEqual(len(other.users._mem_storage), 0)
+        self.assertEqual(len(other.users._principal_refs), 0)
+
+        # User deletion invalidates cache
+        del users['max']
+        self.assertFalse(users.authenticate('max', 'other'))
+        self.assertEqual(len(cache), 0)
+
+    def test_search_iter(self):
+        for index_attrs in [(), ('mail',)]:
+            for name in os.listdir(self.tempdir):
+                path = os.path.join(self.tempdir, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            ugm = self._create_ugm(user_index_attrs=index_attrs)
+            users = ugm.users
+            for i in [3, 1, 4, 0, 2]:
+                users.create(
+                    'user{}'.format(i),
+                    mail=u'user{}@{}.com'.format(i, 'a' if i % 2 else 'b'),
+                    fullname=u'User {}'.format(i)
+                )
+            ugm()
+
+            # Ordered by id
+            result = users.search_iter(criteria={'id': '*'})
+            self.assertTrue(iter(result) is result)
+            self.assertEqual(
+                list(result),
+                ['user0', 'user1', 'user2', 'user3', 'user4']
+            )
+            self.assertEqual(
+                users.search(criteria={'id': '*'}),
+                ['user0', 'user1', 'user2', 'user3', 'user4']
+            )
+            self.assertEqual(
+                list(users.search_iter()),
+                ['user0', 'user1', 'user2', 'user3', 'user4']
+            )
+
+            # Limit and offset
+            self.assertEqual(
+                list(users.search_iter(limit=2, offset=1)),
+                ['user1', 'user2']
+            )
+            self.assertEqual(
+                list(users.search_iter(
+                    criteria={'mail': '*@b.com'},
+                    limit=2,
+                    offset=1
+                )),
+                ['user2', 'user4']
+            )
+            self.assertEqual(list(users.search_iter(limit=0)), [])
+            self.assertEqual(list(users.search_iter(offset=10)), [])
+
+            # Cursor
+            self.assertEqual(
+                list(users.search_iter(
+                    criteria={'mail': '*@b.com'},
+                    after='user0'
+                )),
+                ['user2', 'user4']
+            )
+            self.assertEqual(
+                list(users.search_iter(after='user4')),
+                []
+            )
+
+            # Attribute list and or search
+            self.assertEqual(
+                list(users.search_iter(
+                    criteria={'mail': 'user1@a.com', 'fullname': 'User 3'},
+                    attrlist=['id', 'fullname'],
+                    or_search=True
+                )),
+                [
+                    ('user1', {'id': 'user1', 'fullname': 'User 1'}),
+                    ('user3', {'id': 'user3', 'fullname': 'User 3'})
+                ]
+            )
+
+            # Principals are read lazily
+            read = []
+            read_principal = users._read_principal
+
+            def _read_principal(id):
+                read.append(id)
+                return read_principal(id)
+            users._read_principal = _read_principal
+            result = users.search_iter(limit=2, offset=2)
+            self.assertEqual(next(result), 'user2')
+            self.assertEqual(read, ['user2'])
+            self.assertEqual(list(result), ['user3'])
+            self.assertEqual(read, ['user2', 'user3'])
+            del users._read_principal
+
+            # Principals deleted while iterating are skipped
+            result = users.search_iter()
+            self.assertEqual(next(result), 'user0')
+            del users['user1']
+            self.assertEqual(list(result), ['user2', 'user3', 'user4'])
+
+    def test_search_sorted(self):
+        for index_attrs in [(), ('fullname', 'mail')]:
+            for name in os.listdir(self.tempdir):
+                path = os.path.join(self.tempdir, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            ugm = self._create_ugm(user_index_attrs=index_attrs)
+            users = ugm.users
+            for id, fullname in [
+                ('max', u'Max'),
+                ('sepp', u'Anton'),
+                ('moritz', u'Zeno'),
+                ('otto', None),
+                ('hans', u'Anton')
+            ]:
+                user = users.create(id, mail=u'{}@example.com'.format(id))
+                if fullname:
+                    user.attrs['fullname'] = fullname
+            ugm()
+
+            # Principals without value last, ties ordered by id
+            self.assertEqual(
+                users.search(sort_on='fullname'),
+                ['hans', 'sepp', 'max', 'moritz', 'otto']
+            )
+            self.assertEqual(
+                users.search(sort_on='fullname', reverse=True),
+                ['moritz', 'max', 'sepp', 'hans', 'otto']
+            )
+            self.assertEqual(
+                users.search(sort_on='fullname', limit=3),
+                ['hans', 'sepp', 'max']
+            )
+            self.assertEqual(
+                users.search(sort_on='fullname', reverse=True, limit=2),
+                ['moritz', 'max']
+            )
+            self.assertEqual(
+                users.search(sort_on='fullname', limit=10)[-1],
+                'otto'
+            )
+            self.assertEqual(
+                users.search(sort_on='id', limit=2),
+                ['hans', 'max']
+            )
+
+            # Combined with criteria and attrlist
+            self.assertEqual(
+                users.search(
+                    criteria={'mail': 'm*'},
+                    attrlist=['fullname'],
+                    sort_on='fullname',
+                    reverse=True
+                ),
+                [
+                    ('moritz', {'fullname': 'Zeno'}),
+                    ('max', {'fullname': 'Max'})
+                ]
+            )
+            self.assertEqual(
+                users.search(
+                    criteria={'id': '*o*'},
+                    sort_on='fullname',
+                    limit=2
+                ),
+                ['moritz', 'otto']
+            )
+            # Fewer candidates than distinct values are sorted directly
+            self.assertEqual(
+                users.search(
+                    criteria={'id': 's*'},
+                    sort_on='fullname',
+                    reverse=True
+                ),
+                ['sepp']
+            )
+            self.assertEqual(
+                users.search(
+                    criteria={'id': 'm*'},
+                    sort_on='fullname',
+                    reverse=True,
+                    limit=1
+                ),
+                ['moritz']
+            )
+
+            # Limit without sorting
+            self.assertEqual(users.search(limit=2), ['hans', 'max'])
+            self.assertEqual(
+                users.search(limit=2, reverse=True),
+                ['sepp', 'otto']
+            )
+
+    def test_principals_with_role(self):
+        ugm = self._create_ugm()
+        users = ugm.users
+        groups = ugm.groups
+        for id in ['max', 'sepp', 'moritz']:
+            users.create(id)
+        groups.create('group1')
+        groups.create('group2')
+        self.assertEqual(ugm.principals_with_role('manager'), ([], []))
+        users['sepp'].add_role('manager')
+        users['max'].add_role('manager')
+        users['max'].add_role('editor')
+        groups['group1'].add_role('manager')
+        ugm()
+        self.assertEqual(
+            ugm.principals_with_role('manager'),
+            (['max', 'sepp'], ['group1'])
+        )
+        self.assertEqual(ugm.principals_with_role('editor'), (['max'], []))
+
+        # Index is kept in sync by role changes
+        users['max'].remove_role('manager')
+        groups['group2'].add_role('editor')
+        self.assertEqual(
+            ugm.principals_with_role('manager'),
+            (['sepp'], ['group1'])
+        )
+        self.assertEqual(
+            ugm.principals_with_role('editor'),
+            (['max'], ['group2'])
+        )
+        users['max'].remove_role('editor')
+        self.assertEqual(ugm.principals_with_role('editor'), ([], ['group2']))
+        self.assertEqual(ugm._role_index_map['editor'], {'group:group2'})
+
+        # and by principal deletion
+        del users['sepp']
+        del groups['group1']
+        self.assertEqual(ugm.principals_with_role('manager'), ([], []))
+        self.assertFalse('manager' in ugm._role_index_map)
+        ugm()
+
+        # Index gets built from roles file
+        ugm = self._create_ugm()
+        self.assertEqual(ugm.principals_with_role('editor'), ([], ['group2']))
+
+        # and rebuilt if roles file has been re-read
+        index = ugm._role_index
+        ugm.attrs.invalidate()
+        self.assertEqual(ugm.principals_with_role('editor'), ([], ['group2']))
+        self.assertFalse(ugm._role_index is index)
+
+    def test_effective_roles(self):
+        ugm = self._create_ugm()
+        users = ugm.users
+        groups = ugm.groups
+        max = users.create('max')
+        sepp = users.create('sepp')
+        group1 = groups.create('group1')
+        group2 = groups.create('group2')
+        group1.add('max')
+        group1.add('sepp')
+        group2.add('max')
+        max.add_role('viewer')
+        group1.add_role('editor')
+        group2.add_role('manager')
+        group2.add_role('viewer')
+        ugm()
+
+        self.assertEqual(
+            ugm.effective_roles(max),
+            ['editor', 'manager', 'viewer']
+        )
+        self.assertEqual(ugm.effective_roles(sepp), ['editor'])
+        self.assertTrue(ugm.has_role(max, 'manager'))
+        self.assertFalse(ugm.has_role(sepp, 'manager'))
+        cache = ugm._effective_roles_map
+        self.assertEqual(sorted(cache), ['max', 'sepp'])
+
+        # Role change of user
+        sepp.add_role('admin')
+        self.assertEqual(sorted(cache), ['max'])
+        self.assertTrue(ugm.has_role(sepp, 'admin'))
+
+        # Role change of group drops cached roles of members only
+        group2.remove_role('manager')
+        self.assertEqual(sorted(cache), ['sepp'])
+        self.assertFalse(ugm.has_role(max, 'manager'))
+
+        # Membership changes
+        ugm.effective_roles(max)
+        del group1['sepp']
+        self.assertEqual(sorted(cache), ['max'])
+        self.assertEqual(ugm.effective_roles(sepp), ['admin'])
+        group2.add('sepp')
+        self.assertEqual(sorted(cache), ['max'])
+        self.assertEqual(ugm.effective_roles(sepp), ['admin', 'viewer'])
+
+        # Principal deletion
+        del groups['group1']
+        self.assertEqual(ugm.effective_roles(max), ['viewer'])
+        ugm.effective_roles(sepp)
+        users.create('moritz')
+        ugm.effective_roles(users['moritz'])
+        del users['moritz']
+        self.assertEqual(sorted(cache), ['max', 'sepp'])
+        ugm()
+
+        # Cache is reset if storage data has been re-read
+        groups.invalidate()
+        self.assertEqual(ugm.effective_roles(max), ['viewer'])
+        self.assertFalse(ugm._effective_roles_map is cache)
+
+    def test_nested_groups(self):
+        ugm = self._create_ugm()
+        users = ugm.users
+        groups = ugm.groups
+        for id in ['max', 'sepp', 'moritz']:
+            users.create(id)
+        company = groups.create('company')
+        dev = groups.create('dev')
+        backend = groups.create('backend')
+        company.add('max')
+        dev.add('sepp')
+        backend.add('moritz')
+        company.add('group:dev')
+        dev.add('group:backend')
+        company.add_role('employee')
+        backend.add_role('deployer')
+
+        # Groups as members
+        self.assertEqual(company.member_ids, ['max'])
+        self.assertEqual(company.group_member_ids, ['dev'])
+        self.assertEqual(list(company), ['max'])
+        self.assertEqual(list(company.keys()), ['max'])
+        self.assertFalse('group:dev' in company)
+        self.expectError(KeyError, company.__getitem__, 'group:dev')
+        self.assertEqual(
+            company.get_member_ids(recursive=True),
+            ['max', 'moritz', 'sepp']
+        )
+        self.assertEqual(
+            [user.name for user in dev.get_users(recursive=True)],
+            ['moritz', 'sepp']
+        )
+        self.assertEqual(
+            [user.name for user in backend.get_users(recursive=True)],
+            ['moritz']
+        )
+
+        # Inherited group membership
+        moritz = users['moritz']
+        self.assertEqual(moritz.group_ids, ['backend'])
+        self.assertEqual(
+            moritz.get_group_ids(inherited=True),
+            ['backend', 'company', 'dev']
+        )
+        self.assertEqual(
+            [group.name for group in moritz.get_groups(inherited=True)],
+            ['backend', 'company', 'dev']
+        )
+        self.assertEqual(
+            ugm.effective_roles(moritz),
+            ['deployer', 'employee']
+        )
+
+        # Cycles and inexistent groups
+        err = self.expectError(ValueError, backend.add, 'group:company')
+        self.assertEqual(
+            str(err),
+            "Adding group 'company' to group 'backend' creates a cycle"
+        )
+        self.expectError(ValueError, backend.add, 'group:backend')
+        self.expectError(KeyError, backend.add, 'group:inexistent')
+        ugm()
+
+        # Persisted in groups file
+        self.assertEqual(
+            sorted(self._read_file(os.path.join(self.tempdir, 'groups'))),
+            [
+                'backend:moritz\n',
+                'company:group:dev,max\n',
+                'dev:group:backend,sepp\n'
+            ]
+        )
+        ugm = self._create_ugm()
+        users = ugm.users
+        groups = ugm.groups
+        self.assertEqual(
+            users['moritz'].get_group_ids(inherited=True),
+            ['backend', 'company', 'dev']
+        )
+
+        # Removing group member
+        self.assertTrue(ugm.has_role(users['moritz'], 'employee'))
+        self.expectError(KeyError, groups['dev'].__delitem__, 'group:backend')
+        self.expectError(KeyError, groups['dev'].remove, 'group:inexistent')
+        groups['dev'].remove('group:backend')
+        self.assertEqual(
+            users['moritz'].get_group_ids(inherited=True),
+            ['backend']
+        )
+        self.assertFalse(ugm.has_role(users['moritz'], 'employee'))
+        self.assertEqual(
+            groups['company'].get_member_ids(recursive=True),
+            ['max', 'sepp']
+        )
+        groups['backend'].add('group:company')
+        self.assertEqual(
+            users['max'].get_group_ids(inherited=True),
+            ['backend', 'company']
+        )
+        self.assertEqual(
+            ugm.effective_roles(users['sepp']),
+            ['deployer', 'employee']
+        )
+
+        # Deleting group removes it from containing groups
+        del groups['company']
+        self.assertEqual(groups['backend'].group_member_ids, [])
+        self.assertEqual(users['sepp'].get_group_ids(inherited=True), ['dev'])
+        self.assertEqual(ugm.effective_roles(users['sepp']), [])
+        ugm()
+        self.assertEqual(
+            sorted(self._read_file(os.path.join(self.tempdir, 'groups'))),
+            ['backend:moritz\n', 'dev:sepp\n']
+        )
+
+        # Cycles in groups file do not break closure
+        with open(os.path.join(self.tempdir, 'groups'), 'w') as f:
+            f.write('a:group:b,max\nb:group:a,group:missing\n')
+        ugm = self._create_ugm()
+        self.assertEqual(
+            ugm.users['max'].get_group_ids(inherited=True),
+            ['a', 'b']
+        )
+        self.assertEqual(
+            ugm.groups['b'].get_member_ids(recursive=True),
+            ['max']
+        )
+
+        # Create many with group members
+        self.assertEqual(ugm.groups.create_many([
+            ('c', {}, ['group:a', 'sepp']),
+            ('d', {}, ['group:inexistent'])
+        ])[0][0], 'd')
+        self.assertEqual(ugm.groups['c'].group_member_ids, ['a'])
+
+    def test_group_closure(self):
+        ugm = self._create_ugm()
+        groups = ugm.groups
+        for id in ['a', 'b', 'c', 'd', 'e']:
+            groups.create(id)
+        groups['a'].add('group:b')
+        groups['c'].add('group:d')
+        closure = groups._group_closure
+
+        def rebuilt():
+            descendants, ancestors = groups._group_closure
+            groups._closure_data = None
+            self.assertEqual(groups._group_closure, (descendants, ancestors))
+            return groups._group_closure
+
+        # Adding and removing groups updates closure instead of rebuilding
+        groups['b'].add('group:c')
+        groups['e'].add('group:d')
+        self.assertTrue(groups._group_closure is closure)
+        self.assertEqual(closure, (
+            {
+                'a': {'b', 'c', 'd'},
+                'b': {'c', 'd'},
+                'c': {'d'},
+                'e': {'d'}
+            },
+            {
+                'b': {'a'},
+                'c': {'a', 'b'},
+                'd': {'a', 'b', 'c', 'e'}
+            }
+        ))
+        closure = rebuilt()
+
+        groups['b'].remove('group:c')
+        self.assertTrue(groups._group_closure is closure)
+        self.assertEqual(closure, (
+            {'a': {'b'}, 'c': {'d'}, 'e': {'d'}},
+            {'b': {'a'}, 'd': {'c', 'e'}}
+        ))
+        closure = rebuilt()
+
+        # Group reachable on several paths is kept
+        groups['a'].add('group:c')
+        groups['b'].add('group:c')
+        groups['b'].remove('group:c')
+        self.assertEqual(closure[0]['a'], {'b', 'c', 'd'})
+        self.assertEqual(closure[1]['c'], {'a'})
+        closure = rebuilt()
+
+        # Deleting a group removes it from closure
+        del groups['c']
+        self.assertTrue(groups._group_closure is closure)
+        self.assertEqual(closure, (
+            {'a': {'b'}, 'e': {'d'}},
+            {'b': {'a'}, 'd': {'e'}}
+        ))
+        rebuilt()
+
+    def test_merge_memberships(self):
+        ugm = self._create_ugm()
+        for id in ['x', 'y', 'z']:
+            ugm.users.create(id)
+        group = ugm.groups.create('g')
+        group.add('z')
+        ugm.add_role('editor', group)
+        ugm()
+
+        # Members and roles changed by other processes are kept on write
+        a = self._create_ugm(locking=True)
+        b = self._create_ugm(locking=True)
+        a_group = a.groups['g']
+        b_group = b.groups['g']
+        a_group.add('x')
+        a.add_role('viewer', a_group)
+        a()
+        b_group.add('y')
+        del b_group['z']
+        b.add_role('manager', b_group)
+        b.remove_role('editor', b_group)
+        b()
+        self.assertEqual(
+            self._read_file(os.path.join(self.tempdir, 'groups')),
+            ['g:x,y\n']
+        )
+        self.assertEqual(
+            self._read_file(os.path.join(self.tempdir, 'roles')),
+            ['group:g::manager,viewer\n']
+        )
+
+        # Unwritten changes are replayed if file gets re-read
+        a = self._create_ugm(revalidate_interval=0)
+        b = self._create_ugm()
+        a_group = a.groups['g']
+        a_group.add('z')
+        a.add_role('editor', a_group)
+        b_group = b.groups['g']
+        del b_group['x']
+        b.remove_role('viewer', b_group)
+        b()
+        self.assertEqual(a.groups['g'].member_ids, ['y', 'z'])
+        self.assertEqual(a.roles(a_group), ['editor', 'manager'])
+        a()
+        other = self._create_ugm()
+        self.assertEqual(other.groups['g'].member_ids, ['y', 'z'])
+        self.assertEqual(
+            other.roles(other.groups['g']),
+            ['editor', 'manager']
+        )
+
+    def test_concurrent_changes(self):
+        ugm = self._create_ugm(user_index_attrs=('fullname',))
+        users = ugm.users
+        group = ugm.groups.create('group1')
+        users.create('max')
+        group.add('max')
+        errors = []
+        done = threading.Event()
+
+        def write():
+            try:
+                for i in range(200):
+                    id = 'user{}'.format(i)
+                    users.create(id, fullname=u'User')
+                    group.add(id)
+                    users[id].attrs['fullname'] = u'Changed'
+            except Exception as e:  # pragma: no cover
+                errors.append(e)
+            finally:
+                done.set()
+
+        def read():
+            try:
+                while not done.is_set():
+                    group.member_ids
+                    users['max'].get_group_ids(inherited=True)
+                    users.search(criteria={'fullname': 'User'})
+            except Exception as e:  # pragma: no cover
+                errors.append(e)
+
+        threads = [threading.Thread(target=read) for _ in range(3)]
+        threads.append(threading.Thread(target=write))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(group.member_ids), 201)
+        self.assertEqual(users.search(criteria={'fullname': 'User'}), [])
+
+    def test_flush_changed_principals(self):
+        ugm = self._create_ugm()
+        for i in range(10):
+            ugm.users.create('user{}'.format(i), fullname=u'User')
+            ugm.groups.create('group{}'.format(i))
+        ugm()
+
+        ugm = self._create_ugm()
+        users = ugm.users
+        groups = ugm.groups
+        users['user1'].attrs['fullname']
+        self.assertEqual(ugm(), 0)
+
+        # Only changed principals get written
+        users['user3'].attrs['fullname'] = u'Changed'
+        groups['group5'].add('user3')
+        self.assertEqual(ugm(), 2)
+        self.assertEqual(ugm(), 0)
+        ugm = self._create_ugm()
+        self.assertEqual(ugm.users['user3'].attrs['fullname'], 'Changed')
+        self.assertEqual(ugm.users['user2'].attrs['fullname'], 'User')
+        self.assertEqual(ugm.groups['group5'].member_ids, ['user3'])
+
+        # Changes of principals evicted from cache get written
+        ugm = self._create_ugm(cache_size=1)
+        users = ugm.users
+        user1 = users['user1']
+        users['user2'].attrs['fullname'] = u'Two'
+        user1.attrs['fullname'] = u'One'
+        group1 = ugm.groups['group1']
+        ugm.groups['group2'].attrs['description'] = u'Group 2'
+        group1.attrs['description'] = u'Group 1'
+        del user1, group1
+        self.assertEqual(ugm(), 4)
+        self.assertEqual(ugm(), 0)
+        ugm = self._create_ugm()
+        self.assertEqual(ugm.users['user1'].attrs['fullname'], 'One')
+        self.assertEqual(ugm.users['user2'].attrs['fullname'], 'Two')
+        self.assertEqual(
+            ugm.groups['group1'].attrs['description'],
+            'Group 1'
+        )
+        self.assertEqual(
+            ugm.groups['group2'].attrs['description'],
+            'Group 2'
+        )
@@ -0,0 +1,97 @@
+from node.ext.ugm import hashing
+from node.tests import NodeTestCase
+import base64
+import hashlib
+
+
+class TestHashing(NodeTestCase):
+
+    def test_legacy(self):
+        salt = b'saltsalt'
+        legacy = base64.b64encode(
+            hashlib.sha256(b'secret' + salt).digest() + salt
+        ).decode()
+        self.assertEqual(
+            hashing.identify(legacy),
+            (hashing.SHA256Hasher, None)
+        )
+        hasher = hashing.SHA256Hasher()
+        self.assertTrue(hasher.verify('secret', legacy))
+        self.assertFalse(hasher.verify('wrong', legacy))
+        self.assertFalse(hasher.needs_rehash(legacy))
+        # Legacy hashes are verified if another hasher is configured
+        pbkdf2 = hashing.PBKDF2Hasher(iterations=1000)
+        self.assertTrue(hashing.verify('secret', legacy, pbkdf2))
+        self.assertTrue(pbkdf2.needs_rehash(legacy))
+        # Legacy hashes with custom settings
+        salt = b'salt'
+        legacy = base64.b64encode(
+            hashlib.sha512(b'secret' + salt).digest() + salt
+        ).decode()
+        self.assertFalse(hashing.verify('secret', legacy, pbkdf2))
+        sha512 = hashing.SHA256Hasher(salt_len=4, hash_func=hashlib.sha512)
+        self.assertTrue(hashing.verify('secret', legacy, pbkdf2, [sha512]))
+        self.assertFalse(hashing.verify('wrong', legacy, pbkdf2, [sha512]))
+
+    def test_hashers(self):
+        hashers = [
+            hashing.SHA256Hasher(),
+            hashing.PBKDF2Hasher(iterations=1000),
+            hashing.ScryptHasher(n=2 ** 4)
+        ]
+        for hasher in hashers:
+            hashed = hasher.hash(u'sëcret')
+            self.assertTrue(hashed.startswith('${}$'.format(hasher.name)))
+            self.assertEqual(hashing.identify(hashed)[0], hasher.__class__)
+            self.assertTrue(hasher.verify(u'sëcret', hashed))
+            self.assertFalse(hasher.verify(u'secret', hashed))
+            self.assertFalse(hasher.needs_rehash(hashed))
+            # Random salt
+            self.assertNotEqual(hasher.hash(u'sëcret'), hashed)
+            for other in hashers:
+                self.assertTrue(hashing.verify(u'sëcret', hashed, other))
+                self.assertEqual(
+                    other.needs_rehash(hashed),
+                    other is not hasher
+                )
+
+        hasher = hashing.PBKDF2Hasher(iterations=1000)
+        hashed = hasher.hash('secret')
+        self.assertEqual(hashed.split('$')[2], 'i=1000')
+        # Cost changed
+        hasher = hashing.PBKDF2Hasher(iterations=2000)
+        self.assertTrue(hasher.needs_rehash(hashed))
+        # Verified with parameters stored in hash
+        self.assertTrue(hasher.verify('secret', hashed))
+
+        hashed = hashing.ScryptHasher(n=2 ** 4).hash('secret')
+        self.assertEqual(hashed.split('$')[2], 'n=16,p=1,r=8')
+        self.assertTrue(hashing.ScryptHasher().verify('secret', hashed))
+        self.assertTrue(hashing.ScryptHasher(n=2 ** 5).needs_rehash(hashed))
+
+    def test_identify(self):
+        err = self.expectError(ValueError, hashing.identify, '$foo$$a$b')
+        self.assertEqual(str(err), "Unknown password hasher 'foo'")
+        err = self.expectError(ValueError, hashing.identify, '$sha256$a')
+        self.assertEqual(str(err), 'Invalid password hash')
+
+        @hashing.register_hasher
+        class Hasher(hashing.Hasher):
+            name = 'plain'
+
+            def digest(self, pw, salt, params):
+                return pw
+
+        try:
+            hashed = Hasher().hash('secret')
+            self.assertEqual(hashing.identify(hashed), (Hasher, {}))
+            self.assertTrue(hashing.verify('secret', hashed, Hasher()))
+        finally:
+            del hashing.HASHERS['plain']
+        self.expectError(
+            NotImplementedError,
+            hashing.Hasher().digest,
+            b'secret',
+            b'salt',
+            {}
+        )
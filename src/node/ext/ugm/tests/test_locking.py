@@ -0,0 +1,199 @@
+from node.ext.ugm.locking import DirectoryLock
+from node.ext.ugm.locking import ReadWriteLock
+from node.ext.ugm.locking import readlocktree
+from node.ext.ugm.locking import tree_rwlock
+from node.ext.ugm.locking import writelocktree
+from node.tests import NodeTestCase
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+
+class TestLocking(NodeTestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_directory_lock(self):
+        # Each instance uses its own file descriptor and behaves like a lock
+        # held by another process
+        lock = DirectoryLock(self.tempdir)
+        other = DirectoryLock(self.tempdir, timeout=0.05)
+        self.assertEqual(lock.path, os.path.join(self.tempdir, '.lock'))
+
+        # Shared locks do not block each other
+        with lock.shared():
+            with other.shared():
+                pass
+            err = self.expectError(TimeoutError, other.acquire, True)
+            self.assertTrue(str(err).startswith('Cannot acquire lock'))
+
+        # Exclusive lock blocks readers and writers
+        with lock.exclusive():
+            self.expectError(TimeoutError, other.acquire, False)
+            self.expectError(TimeoutError, other.acquire, True)
+            # Nested acquisitions join the lock held
+            with lock.shared():
+                with lock.exclusive():
+                    pass
+            self.assertTrue(lock._fd is not None)
+        self.assertTrue(lock._fd is None)
+
+        with other.exclusive():
+            pass
+
+        # Shared lock gets converted if exclusive lock is acquired
+        with lock.shared():
+            with lock.exclusive():
+                self.expectError(TimeoutError, other.acquire, False)
+            # Lock stays exclusive until released completely
+            self.expectError(TimeoutError, other.acquire, False)
+        with other.shared():
+            pass
+
+        # Failed conversion keeps shared lock
+        with other.shared():
+            lock.timeout = 0.05
+            self.expectError(TimeoutError, lock.acquire, True)
+            self.assertEqual(lock._shared, 0)
+            self.assertEqual(lock._exclusive, 0)
+            with lock.shared():
+                self.expectError(TimeoutError, lock.acquire, True)
+                self.assertEqual(lock._shared, 1)
+                self.assertEqual(lock._exclusive, 0)
+                self.expectError(TimeoutError, other.acquire, True)
+
+        metrics = other.metrics
+        self.assertEqual(sorted(metrics), ['exclusive', 'shared'])
+        self.assertEqual(metrics['shared']['acquired'], 3)
+        self.assertEqual(metrics['shared']['timeouts'], 3)
+        self.assertEqual(metrics['exclusive']['acquired'], 1)
+        self.assertEqual(metrics['exclusive']['timeouts'], 3)
+        self.assertTrue(metrics['exclusive']['max_wait'] >= 0.05)
+        self.assertTrue(
+            metrics['exclusive']['wait_time']
+            >= metrics['exclusive']['max_wait']
+        )
+
+    def test_blocking(self):
+        lock = DirectoryLock(self.tempdir)
+        other = DirectoryLock(self.tempdir)
+        acquired = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with other.exclusive():
+                acquired.set()
+                release.wait()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        acquired.wait()
+        timer = threading.Timer(0.05, release.set)
+        timer.start()
+        # Waits until the lock gets released
+        with lock.shared():
+            self.assertTrue(release.is_set())
+        thread.join()
+        self.assertTrue(lock.metrics['shared']['max_wait'] > 0.)
+
+    def _run(self, func):
+        # run func in thread, return thread and event set when finished
+        done = threading.Event()
+
+        def run():
+            func()
+            done.set()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread, done
+
+    def test_read_write_lock(self):
+        lock = ReadWriteLock()
+        order = []
+
+        def write():
+            with lock.write():
+                order.append('write')
+
+        def read():
+            with lock.read():
+                order.append('read')
+
+        # Readers do not block each other
+        with lock.read():
+            thread, done = self._run(read)
+            self.assertTrue(done.wait(1))
+            thread.join()
+        del order[:]
+
+        # Writer waits for readers, new readers wait for waiting writer
+        with lock.read():
+            writer, writer_done = self._run(write)
+            while not lock._waiting_writers:
+                time.sleep(0.001)
+            reader, reader_done = self._run(read)
+            self.assertFalse(writer_done.wait(0.02))
+            self.assertFalse(reader_done.is_set())
+            # reentrant read is not blocked by waiting writer
+            with lock.read():
+                order.append('nested read')
+        writer.join()
+        reader.join()
+        self.assertEqual(order, ['nested read', 'write', 'read'])
+
+        # Write lock is reentrant and allows reading
+        with lock.write():
+            with lock.write():
+                with lock.read():
+                    pass
+            thread, done = self._run(read)
+            self.assertFalse(done.wait(0.02))
+        thread.join()
+        self.assertEqual(lock._writer, None)
+
+        # Upgrade from read to write lock
+        with lock.read():
+            with lock.write():
+                self.assertEqual(lock._writer, threading.get_ident())
+        self.assertEqual(lock._readers, {})
+
+        # Concurrent upgrades fail
+        lock._upgrading = -1
+        with lock.read():
+            err = self.expectError(RuntimeError, lock.acquire_write)
+            self.assertEqual(
+                str(err),
+                'Concurrent upgrade from read to write lock'
+            )
+        lock._upgrading = None
+
+        err = self.expectError(RuntimeError, lock.release_write)
+        self.assertEqual(str(err), 'Write lock not held by current thread')
+
+    def test_tree_rwlock(self):
+        class Node(object):
+            root = None
+
+            @readlocktree
+            def read(self):
+                return tree_rwlock(self)._readers.copy()
+
+            @writelocktree
+            def write(self):
+                return tree_rwlock(self)._writer
+
+        node = Node()
+        node.root = node
+        lock = tree_rwlock(node)
+        self.assertTrue(tree_rwlock(node) is lock)
+        self.assertEqual(node.read(), {threading.get_ident(): 1})
+        self.assertEqual(node.write(), threading.get_ident())
+        self.assertEqual(lock._readers, {})
+        self.assertEqual(lock._writer, None)
@@ -0,0 +1,215 @@
+from node.ext.ugm import file
+from node.ext.ugm import sqlite
+from node.ext.ugm.hashing import PBKDF2Hasher
+from node.tests import NodeTestCase
+import os
+import shutil
+import sqlite3
+import tempfile
+
+
+class TestSqlite(NodeTestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tempdir, 'ugm.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _create_ugm(self, **kw):
+        return sqlite.Ugm(name='ugm', db_path=self.db_path, **kw)
+
+    def _rows(self, query):
+        connection = sqlite3.connect(self.db_path)
+        try:
+            return sorted(connection.execute(query).fetchall())
+        finally:
+            connection.close()
+
+    def test_ugm(self):
+        ugm = self._create_ugm()
+        self.assertEqual(ugm.users.__class__, sqlite.Users)
+        self.assertEqual(ugm.groups.__class__, sqlite.Groups)
+
+        user = ugm.users.create('max', fullname=u'Max Mustermann')
+        self.assertEqual(user.__class__, sqlite.User)
+        ugm.users.passwd('max', None, 'secret')
+        group = ugm.groups.create('group1', description=u'Group 1')
+        self.assertEqual(group.__class__, sqlite.Group)
+        group.add('max')
+        ugm.add_role('manager', user)
+        ugm.add_role('editor', group)
+        ugm()
+
+        self.assertEqual(self._rows('SELECT key FROM users'), [('max',)])
+        self.assertEqual(
+            self._rows('SELECT * FROM groups'),
+            [('group1', 'max')]
+        )
+        self.assertEqual(self._rows('SELECT * FROM roles'), [
+            ('group:group1', 'editor'),
+            ('max', 'manager')
+        ])
+        self.assertEqual(self._rows('SELECT * FROM attributes'), [
+            ('groups/group1', 'description', 'Group 1'),
+            ('users/max', 'fullname', 'Max Mustermann')
+        ])
+
+        ugm = self._create_ugm()
+        self.assertTrue(ugm.users.authenticate('max', 'secret'))
+        self.assertFalse(ugm.users.authenticate('max', 'wrong'))
+        # Single lookups select single rows
+        self.assertEqual(ugm.users._storage_data, None)
+        user = ugm.users['max']
+        self.assertEqual(user.attrs['fullname'], 'Max Mustermann')
+        self.assertEqual(user.group_ids, ['group1'])
+        self.assertEqual(ugm.groups['group1'].member_ids, ['max'])
+        self.assertEqual(ugm.roles(user), ['manager'])
+        self.assertEqual(ugm.roles(ugm.groups['group1']), ['editor'])
+        self.assertEqual(
+            ugm.principals_with_role('manager'),
+            (['max'], [])
+        )
+        self.assertEqual(
+            ugm.principals_with_role('editor'),
+            ([], ['group1'])
+        )
+
+        # Nothing changed, nothing written
+        self.assertEqual(ugm(), 0)
+
+        # Delete principals
+        del ugm.users['max']
+        del ugm.groups['group1']
+        ugm()
+        self.assertEqual(self._rows('SELECT * FROM users'), [])
+        self.assertEqual(self._rows('SELECT * FROM groups'), [])
+        self.assertEqual(self._rows('SELECT * FROM roles'), [])
+        self.assertEqual(self._rows('SELECT * FROM attributes'), [])
+        ugm.close()
+
+    def test_login_and_search(self):
+        ugm = self._create_ugm(user_index_attrs=('mail',))
+        ugm.users.create('max', login=u'max@example.com', mail=u'max@x.com')
+        ugm.users.create('sepp', mail=u'sepp@x.com')
+        ugm()
+        self.assertEqual(
+            self._rows('SELECT * FROM logins'),
+            [('max@example.com', 'max')]
+        )
+
+        ugm = self._create_ugm(user_index_attrs=('mail',))
+        self.assertEqual(ugm.users.id_for_login('max@example.com'), 'max')
+        self.assertEqual(
+            ugm.users.search(criteria={'mail': 'sepp@x.com'}),
+            ['sepp']
+        )
+        err = self.expectError(
+            ValueError,
+            ugm.users.create,
+            'max@example.com'
+        )
+        self.assertEqual(
+            str(err),
+            "Login 'max@example.com' is already used by user 'max'"
+        )
+
+    def test_rehash(self):
+        ugm = self._create_ugm()
+        ugm.users.create('max')
+        ugm.users.passwd('max', None, 'secret')
+        ugm.close()
+
+        # Rehash on login only persists the password hash of the user
+        ugm = self._create_ugm(password_hasher=PBKDF2Hasher(iterations=1000))
+        ugm.users.create('sepp')
+        self.assertTrue(ugm.users.authenticate('max', 'secret'))
+        rows = self._rows('SELECT * FROM users')
+        self.assertEqual([row[0] for row in rows], ['max'])
+        self.assertTrue(rows[0][1].startswith('$pbkdf2-sha256$i=1000$'))
+        ugm()
+        self.assertEqual(
+            [row[0] for row in self._rows('SELECT * FROM users')],
+            ['max', 'sepp']
+        )
+        ugm.close()
+
+    def test_transaction(self):
+        ugm = self._create_ugm()
+        ugm.users.create('max')
+        ugm()
+
+        # Failing flush is rolled back as a whole
+        ugm.users.create('sepp', fullname=u'Sepp')
+        ugm.groups.create('group1')
+
+        def fail(id):
+            raise RuntimeError('Failure')
+        ugm.groups._remove_principal_data = fail
+        ugm.groups._group_data_to_remove.append('group1')
+        self.expectError(RuntimeError, ugm)
+        self.assertEqual(self._rows('SELECT key FROM users'), [('max',)])
+        self.assertEqual(self._rows('SELECT key FROM groups'), [])
+
+        # Changes of failed flush get written on retry
+        del ugm.groups._remove_principal_data
+        ugm.groups._group_data_to_remove = list()
+        self.assertTrue(ugm() > 0)
+        self.assertEqual(
+            self._rows('SELECT key FROM users'),
+            [('max',), ('sepp',)]
+        )
+        self.assertEqual(self._rows('SELECT key FROM groups'), [('group1',)])
+        self.assertEqual(
+            self._rows('SELECT * FROM attributes'),
+            [('users/sepp', 'fullname', 'Sepp')]
+        )
+        self.assertEqual(ugm(), 0)
+
+        # Nested transactions join the outer one
+        with ugm.transaction() as connection:
+            with ugm.transaction():
+                connection.execute(
+                    'INSERT INTO roles (key, value) VALUES (?, ?)',
+                    ('max', 'manager')
+                )
+            self.assertEqual(self._rows('SELECT * FROM roles'), [])
+        self.assertEqual(
+            self._rows('SELECT * FROM roles'),
+            [('max', 'manager')]
+        )
+        ugm.close()
+
+    def test_migrate(self):
+        datadir = os.path.join(self.tempdir, 'principal_data')
+        os.mkdir(datadir)
+        source = file.Ugm(
+            name='ugm',
+            users_file=os.path.join(self.tempdir, 'users'),
+            groups_file=os.path.join(self.tempdir, 'groups'),
+            roles_file=os.path.join(self.tempdir, 'roles'),
+            data_directory=datadir
+        )
+        user = source.users.create('max', login=u'max@example.com')
+        source.users.passwd('max', None, 'secret')
+        group = source.groups.create('group1', description=u'Group 1')
+        group.add('max')
+        source.add_role('manager', user)
+        source.add_role('editor', group)
+        source()
+
+        target = self._create_ugm()
+        sqlite.migrate(source, target)
+
+        target = self._create_ugm()
+        self.assertEqual(list(target.users.keys()), ['max'])
+        self.assertTrue(target.users.authenticate('max', 'secret'))
+        self.assertEqual(target.users.id_for_login('max@example.com'), 'max')
+        self.assertEqual(
+            target.groups['group1'].attrs['description'],
+            'Group 1'
+        )
+        self.assertEqual(target.users['max'].group_ids, ['group1'])
+        self.assertEqual(target.roles(target.users['max']), ['manager'])
+        self.assertEqual(target.roles(target.groups['group1']), ['editor'])